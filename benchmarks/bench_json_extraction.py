@@ -0,0 +1,62 @@
+"""
+Mikrobenchmark für extract_json_from_string: typische LLM-Antwort (großes, eingerücktes JSON im
+```json-Block) und pathologische Eingaben mit vielen ungeschlossenen Klammern, jeweils gegen die frühere
+Regex-Extraktion. Aufruf aus dem Projektverzeichnis: python -m benchmarks.bench_json_extraction
+"""
+import json
+import re
+import time
+
+from services.utils import extract_json_from_string, loads_json
+
+REPEATS = 20
+
+
+def regex_extract(text):
+    # Frühere Implementierung: nicht-gieriges Klammerpaar (bricht bei "}" in Strings, quadratisch ohne Treffer)
+    match = re.search(r"```json\s*(\{.*?})\s*```", text, re.DOTALL)
+    if match:
+        return match.group(1)
+    match = re.search(r"(\{.*?})", text, re.DOTALL)
+    return match.group(1) if match else None
+
+
+def _insight(index: int) -> dict:
+    return {
+        "insight_id": f"insight_{index}", "title": "Retouren {DE} \"hoch\" }", "type": "Anomalie",
+        "description": "x { y } " * 50,
+        "supporting_data_points": [{"row_reference": "Country 'DE' {x}", "column_reference": "Return Rate", "value": "0.4"}],
+    }
+
+
+def _parses(result) -> bool:
+    try:
+        return isinstance(loads_json(result), dict)
+    except (TypeError, ValueError):
+        return False
+
+
+def _measure(fn, text: str, repeats: int) -> tuple:
+    started = time.perf_counter()
+    for _ in range(repeats):
+        result = fn(text)
+    return (time.perf_counter() - started) / repeats * 1000, _parses(result)
+
+
+def main():
+    answer = {"insights": [_insight(index) for index in range(400)], "overall_summary": "s"}
+    cases = {
+        "fenced_indented": ("Einleitung {kurz}\n```json\n" + json.dumps(answer, indent=2) + "\n```\n", REPEATS),
+        "bare_with_preamble_brace": ("Hinweis: Werte in {EUR gerundet.\n" + json.dumps(answer), REPEATS),
+        "truncated_fenced": ("```json\n" + json.dumps(answer, indent=2)[:-200], REPEATS),
+        "unclosed_braces": ("{" * 2000 + " text " * 20000, 1),
+    }
+    print(f"{'Fall':<26} {'Zeichen':>9} {'Verfahren':>9} {'ms':>10}  Ergebnis")
+    for name, (text, repeats) in cases.items():
+        for label, fn in (("regex", regex_extract), ("scanner", extract_json_from_string)):
+            milliseconds, parses = _measure(fn, text, repeats)
+            print(f"{name:<26} {len(text):>9} {label:>9} {milliseconds:>10.2f}  {'JSON' if parses else '-'}")
+
+
+if __name__ == "__main__":
+    main()
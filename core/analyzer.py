@@ -1,14 +1,36 @@
 # llm_analyzer.py
 import os
+import io
 import json
-import streamlit as st
+import time
 import pandas as pd
 from openai import OpenAI
 
 
-from services.utils import extract_json_from_string, get_basic_dataframe_summary, \
-                           add_calculated_kpis_to_df, get_higher_level_aggregations, get_top_n_anomalies
-from services.db import save_insight, get_similar_insights
+from services.utils import extract_json_from_string, loads_json, validate_insight_results, IncrementalInsightParser, \
+                           get_basic_dataframe_summary, add_calculated_kpis_to_df, get_higher_level_aggregations, \
+                           get_top_n_anomalies, get_statistical_anomalies, ANOMALY_TOP_K_CELLS
+from services.db import get_similar_insights, save_raw_data_summary, get_raw_data_snapshot
+from services.stage_cache import dataframe_fingerprint, run_cached_stage, get_stage_cache_stats
+from services.llm_cache import cached_chat_completion
+from services.fact_check import aggregate_fact_check_cells, build_fact_check_index, check_insights, annotate_insights, \
+                                tag_insight_dimensions, disputed_insights, FACT_CHECK_DIMENSIONS, merge_corrected_insights
+from services.prompt_budget import build_prompt_sections, format_token_report
+from services.comparison import compute_comparison_stages, COMPARISON_MIN_SALES_SHARE
+from services.prompt_registry import get_prompt_template, combined_prompt_version
+from core.pipeline import run_stage_graph
+from core.reporting import StreamlitReporter
+
+# Anzahl Zeilen pro Anomalie-Tabelle; N kann angepasst werden, um Token zu sparen
+TOP_N_ANOMALIES = 7
+# "full": Review mit vollständigem Kontext; "delta": lokale Prüfung der Datenpunkte,
+# LLM-Review nur für strittige Erkenntnisse
+LLM_REVIEW_MODE = os.getenv("LLM_REVIEW_MODE", "full")
+# Version der Datenstufen (KPIs, Übersicht, Aggregationen, Anomalien); bei inhaltlichen Änderungen erhöhen,
+# damit gespeicherte Analyse-Snapshots nicht mehr verwendet werden
+PIPELINE_VERSION = "2"
+# Stufenergebnisse, die als Snapshot pro Dateiinhalt in MongoDB gespeichert werden
+SNAPSHOT_STAGES = ["summary", "aggregations", "anomalies", "statistical_anomalies", "fact_check_cells"]
 
 
 def get_openai_client_internal():
@@ -24,6 +46,266 @@ def get_openai_client_internal():
     except Exception:
         return None
 
+def _analysis_stage_graph(dataframe: pd.DataFrame) -> dict:
+    """
+    Deklariert KPIs, Daten-Summary, Aggregationen, Top-N- und statistische Anomalien sowie den
+    Index für die Prüfung zitierter Datenpunkte als Abhängigkeitsgraph für run_stage_graph. Nach den KPIs laufen die übrigen Stufen gleichzeitig.
+    Alle Stufen werden über den Fingerabdruck des DataFrames gecached, sodass Folgeanalysen
+    und erneute Läufe auf unveränderten Daten direkt zur Prompt-Erstellung springen.
+    """
+    def kpis(data_fingerprint):
+        return run_cached_stage("kpis", data_fingerprint, lambda: add_calculated_kpis_to_df(dataframe))
+
+    def summary(data_fingerprint, df_with_kpis):
+        return run_cached_stage("summary", data_fingerprint, lambda: get_basic_dataframe_summary(df_with_kpis))
+
+    def aggregations(data_fingerprint, df_with_kpis):
+        return run_cached_stage("aggregations", data_fingerprint, lambda: get_higher_level_aggregations(df_with_kpis))
+
+    def anomalies(data_fingerprint, df_with_kpis):
+        return run_cached_stage(
+            "anomalies", data_fingerprint,
+            lambda: get_top_n_anomalies(df_with_kpis, n=TOP_N_ANOMALIES), params={"n": TOP_N_ANOMALIES}
+        )
+
+    def statistical_anomalies(data_fingerprint, df_with_kpis):
+        return run_cached_stage(
+            "statistical_anomalies", data_fingerprint,
+            lambda: get_statistical_anomalies(df_with_kpis, top_k=ANOMALY_TOP_K_CELLS), params={"top_k": ANOMALY_TOP_K_CELLS}
+        )
+
+    def fact_check_cells(data_fingerprint, df_with_kpis):
+        return run_cached_stage("fact_check_cells", data_fingerprint, lambda: aggregate_fact_check_cells(df_with_kpis))
+
+    def fact_check_index(data_fingerprint, cell_sums):
+        return run_cached_stage("fact_check_index", data_fingerprint, lambda: build_fact_check_index(cell_sums))
+
+    return {
+        "fingerprint": ((), lambda: dataframe_fingerprint(dataframe)),
+        "kpis": (("fingerprint",), kpis),
+        "summary": (("fingerprint", "kpis"), summary),
+        "aggregations": (("fingerprint", "kpis"), aggregations),
+        "anomalies": (("fingerprint", "kpis"), anomalies),
+        "statistical_anomalies": (("fingerprint", "kpis"), statistical_anomalies),
+        "fact_check_cells": (("fingerprint", "kpis"), fact_check_cells),
+        "fact_check_index": (("fingerprint", "fact_check_cells"), fact_check_index),
+    }
+
+def compute_analysis_stages(dataframe: pd.DataFrame) -> tuple:
+    """
+    Berechnet nur die Datenstufen (ohne LLM) und gibt (stufenergebnisse, laufzeiten) zurück; die
+    Stufenergebnisse enthalten die Keys aus SNAPSHOT_STAGES und können als precomputed_stages an
+    perform_llm_analysis übergeben werden (z.B. aus einem Worker-Prozess im Batch-Betrieb).
+    """
+    stage_results, stage_timings = run_stage_graph(_analysis_stage_graph(dataframe))
+    return {name: stage_results[name] for name in SNAPSHOT_STAGES}, stage_timings
+
+def _precomputed_stage_graph(precomputed_stages: dict) -> dict:
+    """
+    Stellt bereits berechnete Stufenergebnisse (z.B. aus dem Streaming-Modus) als Stufen ohne Abhängigkeiten bereit.
+    """
+    values = {
+        "summary": precomputed_stages["summary"],
+        "aggregations": precomputed_stages["aggregations"],
+        "anomalies": precomputed_stages["anomalies"],
+        "statistical_anomalies": precomputed_stages.get("statistical_anomalies", {}),
+    }
+    stages = {name: ((), lambda value=value: value) for name, value in values.items()}
+    if precomputed_stages.get("fact_check_cells") is not None:
+        stages["fact_check_cells"] = ((), lambda: precomputed_stages["fact_check_cells"])
+        stages["fact_check_index"] = (("fact_check_cells",), build_fact_check_index)
+    return stages
+
+def _snapshot_version() -> str:
+    return f"{PIPELINE_VERSION}-n{TOP_N_ANOMALIES}-k{ANOMALY_TOP_K_CELLS}"
+
+def save_analysis_snapshot(mongo_client, filename: str, content_hash: str, stage_values: dict):
+    """
+    Speichert die Stufenergebnisse aus SNAPSHOT_STAGES unter Inhalts-Hash und Pipeline-Version in MongoDB
+    (Zellsummen für die Datenpunkt-Prüfung als CSV).
+    """
+    snapshot = {name: value for name, value in stage_values.items() if name in SNAPSHOT_STAGES and name != "fact_check_cells"}
+    if stage_values.get("fact_check_cells") is not None:
+        snapshot["fact_check_cells"] = stage_values["fact_check_cells"].to_csv(index=False)
+    return save_raw_data_summary(mongo_client, filename, snapshot, content_hash=content_hash, pipeline_version=_snapshot_version())
+
+def load_analysis_snapshot(mongo_client, content_hash: str):
+    """
+    Lädt einen Analyse-Snapshot für den Dateiinhalt. Gibt die Stufenergebnisse (wie precomputed_stages von
+    perform_llm_analysis, mit "from_snapshot": True) zurück oder None, wenn kein passender Snapshot existiert.
+    """
+    document = get_raw_data_snapshot(mongo_client, content_hash, _snapshot_version())
+    if not document or not all(name in document.get("summary", {}) for name in SNAPSHOT_STAGES[:4]):
+        return None
+    stages = dict(document["summary"])
+    if stages.get("fact_check_cells"):
+        stages["fact_check_cells"] = pd.read_csv(
+            io.StringIO(stages["fact_check_cells"]), keep_default_na=False, na_values=[""],
+            dtype={dim: str for dim in FACT_CHECK_DIMENSIONS}
+        )
+    stages["from_snapshot"] = True
+    return stages
+
+def _load_prompt_templates(is_follow_up: bool) -> dict:
+    """
+    Holt System- und User-Prompt (Erst- oder Folgeanalyse) sowie die Prompts für das vollständige und das
+    Delta-Review aus der Prompt-Registry (Dateien werden nur bei Änderung neu gelesen).
+    """
+    names = {
+        "system": "system_follow_up" if is_follow_up else "system_initial",
+        "user": "user_follow_up" if is_follow_up else "user_initial",
+        "review_system": "review_system",
+        "review_user": "review_user",
+        "review_delta_system": "review_delta_system",
+        "review_delta_user": "review_delta_user",
+    }
+    return {key: get_prompt_template(name) for key, name in names.items()}
+
+def _load_comparison_prompt_templates() -> dict:
+    return {key: get_prompt_template(name) for key, name in (("system", "system_comparison"), ("user", "user_comparison"))}
+
+def _prompt_versions(prompt_templates: dict) -> dict:
+    """
+    Versionen der verwendeten Vorlagen plus Gesamtversion ("combined") für Cache-Schlüssel und gespeicherte Insights.
+    """
+    versions = {key: template.version for key, template in prompt_templates.items()}
+    return {**versions, "combined": combined_prompt_version(versions)}
+
+def _lookup_historical_insights(mongo_client, detailed_data_summary_dict: dict):
+    """
+    Fragt ähnliche historische Erkenntnisse aus MongoDB ab, beschränkt auf Erkenntnisse zu den
+    häufigsten Ländern bzw. Zahlungsmethoden der aktuellen Daten. Gibt (abfrage, erkenntnisse) zurück.
+    """
+    query_for_similar_insights = ""
+    if isinstance(detailed_data_summary_dict.get('column_names'), list) and isinstance(detailed_data_summary_dict.get('numerical_summary'), dict):
+        query_for_similar_insights = f"DataFrame overview: columns {detailed_data_summary_dict['column_names']}, rows {detailed_data_summary_dict['num_rows']}. Focus on numerical data: {detailed_data_summary_dict['numerical_summary']}"
+    if not query_for_similar_insights:
+        return query_for_similar_insights, []
+    categorical_summary = detailed_data_summary_dict.get("categorical_summary") or {}
+    top_values = {
+        col: list((categorical_summary.get(col) or {}).get("top_values") or {})
+        for col in ("Country", "Payment Method")
+    }
+    return query_for_similar_insights, get_similar_insights(
+        mongo_client, query_for_similar_insights, limit=5,
+        countries=top_values["Country"], payment_methods=top_values["Payment Method"]
+    )
+
+def _format_stage_timings(timings: dict) -> str:
+    stage_parts = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings["stages"].items())
+    return (
+        f"Laufzeiten: {stage_parts} | gesamt {timings['wall_seconds']:.2f}s "
+        f"(Summe der Stufen {timings['sum_seconds']:.2f}s)"
+    )
+
+def _insight_stream_handler(on_insight, phase: str):
+    """
+    Erzeugt einen on_delta-Callback, der die gestreamte LLM-Antwort inkrementell parst
+    und jede vollständig empfangene Erkenntnis an on_insight(insight, phase) übergibt.
+    """
+    if on_insight is None:
+        return None
+    parser = IncrementalInsightParser()
+
+    def on_delta(text: str):
+        for insight in parser.feed(text):
+            on_insight(insight, phase)
+    return on_delta
+
+def _parse_llm_json(content: str):
+    json_string = extract_json_from_string(content or "")
+    if json_string is None:
+        return None
+    try:
+        return loads_json(json_string)
+    except json.JSONDecodeError:
+        return None
+
+def _check_insight_schema(parsed_results, raw_response: str, reporter):
+    """
+    Prüft die geparste Antwort gegen das Insight-Schema (services/utils.validate_insight_results).
+    Gibt None zurück, wenn die Antwort verwendbar ist (Abweichungen stehen dann in "schema_issues"),
+    sonst das Fehlerergebnis für den Aufrufer.
+    """
+    try:
+        schema_problems = validate_insight_results(parsed_results)
+    except ValueError as e:
+        reporter.error(str(e))
+        reporter.write("Rohantwort der LLM-Anfrage (zur Fehlerbehebung):")
+        reporter.code(raw_response)
+        return {"error": str(e), "raw_response": raw_response}
+    if schema_problems:
+        reporter.warning(
+            f"Die LLM-Antwort weicht in {len(schema_problems)} Punkten vom Insight-Schema ab: "
+            f"{'; '.join(schema_problems[:3])}{' ...' if len(schema_problems) > 3 else ''}"
+        )
+        parsed_results["schema_issues"] = schema_problems
+    return None
+
+def _run_delta_review(openai_client, initial_llm_response_content: str, fact_check_index: dict,
+                      prompt_templates: dict, llm_cache_hits: dict, reporter, on_insight=None):
+    """
+    Delta-Review: prüft die supporting_data_points der ersten Antwort lokal gegen die Daten und
+    sendet nur Erkenntnisse mit abweichenden Werten (samt tatsächlichen Werten) zur Korrektur an das LLM.
+    Gibt (finale_antwort, prüfbericht) zurück; (None, None), wenn die erste Antwort kein lesbares JSON
+    enthält oder die lokale Prüfung fehlschlägt und daher das vollständige Review nötig ist.
+    """
+    first_results = _parse_llm_json(initial_llm_response_content)
+    if not isinstance(first_results, dict) or not isinstance(first_results.get("insights"), list):
+        return None, None
+    insights = first_results["insights"]
+    for index, insight in enumerate(insights):
+        if isinstance(insight, dict):
+            insight.setdefault("insight_id", f"insight_{index + 1}")
+
+    try:
+        fact_check_report = check_insights(fact_check_index, insights)
+        disputed = disputed_insights(insights, fact_check_report)
+    except Exception as e:
+        reporter.warning(f"Lokale Prüfung der Datenpunkte fehlgeschlagen ({e}).")
+        return None, None
+    reporter.info(
+        f"Lokale Prüfung der Datenpunkte: {fact_check_report['verified']} bestätigt, "
+        f"{fact_check_report['mismatch']} abweichend, {fact_check_report['unresolved']} nicht prüfbar."
+    )
+    final_results = first_results
+    if not disputed:
+        reporter.success("Keine abweichenden Werte gefunden. Selbstüberprüfung durch das LLM wird übersprungen.")
+    else:
+        reporter.info(f"Sende {len(disputed)} strittige Erkenntnisse zur Korrektur an das LLM...")
+        review_user_content = prompt_templates["review_delta_user"].render(
+            num_checked=fact_check_report["checked"],
+            num_disputed=len(disputed),
+            disputed_items_json=json.dumps(disputed, ensure_ascii=False, default=str),
+        )
+        messages_review = [
+            {"role": "system", "content": prompt_templates["review_delta_system"].render()},
+            {"role": "user", "content": review_user_content}
+        ]
+        try:
+            review_content, llm_cache_hits["review"] = cached_chat_completion(
+                openai_client,
+                messages_review,
+                cache_tag=_prompt_versions(prompt_templates)["combined"],
+                model=os.getenv("OPENAI_MODEL", "gpt-4o"),
+                temperature=0.0,
+                seed=123,
+                max_tokens=3000
+            )
+            corrections = _parse_llm_json(review_content)
+            if isinstance(corrections, dict) and isinstance(corrections.get("insights"), list):
+                final_results = merge_corrected_insights(first_results, corrections["insights"])
+                reporter.success(f"Delta-Review abgeschlossen: {len(corrections['insights'])} Erkenntnisse korrigiert oder verworfen.")
+            else:
+                reporter.warning("Korrekturen des Delta-Reviews konnten nicht gelesen werden. Verwende die erste Analyse.")
+        except Exception as e:
+            reporter.warning(f"Fehler beim Delta-Review ({e}). Verwende die erste Analyse.")
+
+    if on_insight is not None:
+        for insight in final_results["insights"]:
+            on_insight(insight, "review")
+    return f"```json\n{json.dumps(final_results, ensure_ascii=False, indent=2)}\n```", fact_check_report
+
 def perform_llm_analysis(
     dataframe: pd.DataFrame,
     openai_client: OpenAI,
@@ -31,46 +313,79 @@ def perform_llm_analysis(
     additional_context_text: str = "",
     filename: str = "",
     follow_up_question: str = None,
-    previous_analysis_results: dict = None
+    previous_analysis_results: dict = None,
+    precomputed_stages: dict = None,
+    on_insight=None,
+    review_mode: str = None,
+    content_hash: str = None,
+    snapshot_client=None,
+    reporter=None
 ):
     """
     Führt eine LLM-Analyse (Initial- oder Folgeanalyse) auf Basis eines DataFrames durch.
-    Nutzt OpenAI und optional MongoDB für historischen Kontext.
+    Nutzt OpenAI und optional MongoDB für historischen Kontext; identische LLM-Anfragen werden aus dem
+    lokalen Antwort-Cache (services/llm_cache.py) bedient.
+    Mit precomputed_stages (Keys "summary", "aggregations", "anomalies", "statistical_anomalies", optional
+    "fact_check_cells", z.B. aus dem Streaming-Modus für große CSV-Dateien) werden die Datenstufen nicht neu berechnet.
+    Die Datenpunkte der finalen Erkenntnisse werden lokal geprüft und mit "verification" markiert.
+    Mit on_insight(insight, phase) werden beide LLM-Antworten gestreamt; jede Erkenntnis wird
+    übergeben, sobald sie vollständig empfangen ist (phase "analysis" bzw. "review").
+    review_mode ("full" oder "delta", Standard LLM_REVIEW_MODE) wählt die Art der Selbstüberprüfung.
+    Mit content_hash und snapshot_client (MongoDB, unabhängig von der Nutzung historischer Erkenntnisse) werden
+    neu berechnete Stufenergebnisse als Snapshot gespeichert (siehe load_analysis_snapshot).
+    reporter (core/reporting.py, Standard: StreamlitReporter) nimmt alle Status- und Fehlermeldungen entgegen,
+    sodass die Analyse auch ohne Streamlit-Oberfläche läuft.
     """
+    reporter = reporter or StreamlitReporter()
     if openai_client is None:
         return {"error": "OpenAI Client ist nicht initialisiert. Bitte API-Schlüssel prüfen."}
 
-    # Datenzusammenfassung für das LLM
-    # 1. Berechne KPIs und füge sie als neue Spalten zum DataFrame hinzu
-    st.info("Schritt 1/4: Berechne Performance-Indikatoren (KPIs) pro Zeile...")
-    df_with_kpis = add_calculated_kpis_to_df(dataframe.copy())
+    is_follow_up = bool(follow_up_question and previous_analysis_results)
+    if precomputed_stages and precomputed_stages.get("from_snapshot"):
+        reporter.info("Verwende den gespeicherten Analyse-Snapshot dieser Datei (Datenübersicht, Aggregationen und Auffälligkeiten)...")
+        stage_graph = _precomputed_stage_graph(precomputed_stages)
+    elif precomputed_stages:
+        reporter.info("Verwende die beim chunkweisen Einlesen berechnete Datenübersicht, Aggregationen und Auffälligkeiten...")
+        stage_graph = _precomputed_stage_graph(precomputed_stages)
+    else:
+        reporter.info("Berechne KPIs, Datenübersicht, globale Aggregationen und Auffälligkeiten (unabhängige Stufen parallel)...")
+        stage_graph = _analysis_stage_graph(dataframe)
+    # Prompt-Dateien und MongoDB-Abfrage laufen gleichzeitig mit den Datenstufen
+    stage_graph["prompts"] = ((), lambda: _load_prompt_templates(is_follow_up))
+    if mongo_client:
+        stage_graph["historical_insights"] = (("summary",), lambda summary: _lookup_historical_insights(mongo_client, summary))
+    if snapshot_client is not None and content_hash and not (precomputed_stages and precomputed_stages.get("from_snapshot")):
+        # Snapshot speichern, sobald die Datenstufen fertig sind (parallel zu Prompt- und MongoDB-Abfragen)
+        snapshot_dependencies = tuple(name for name in SNAPSHOT_STAGES if name in stage_graph)
+        stage_graph["snapshot"] = (snapshot_dependencies, lambda *values: save_analysis_snapshot(
+            snapshot_client, filename, content_hash, dict(zip(snapshot_dependencies, values))
+        ))
+    stage_results, stage_timings = run_stage_graph(stage_graph)
+
+    if not precomputed_stages:
+        stage_cache_stats = get_stage_cache_stats()
+        reporter.caption(
+            f"Stufen-Cache: {stage_cache_stats['hits']} Treffer, {stage_cache_stats['misses']} Neuberechnungen "
+            f"({stage_cache_stats['entries']} Einträge im Cache)."
+        )
+    reporter.caption(_format_stage_timings(stage_timings))
 
-    # 2. Erzeuge eine Basis-Zusammenfassung des angereicherten DataFrames
-    st.info("Schritt 2/4: Erstelle eine detaillierte Datenübersicht...")
-    detailed_data_summary_dict = get_basic_dataframe_summary(df_with_kpis)
+    detailed_data_summary_dict = stage_results["summary"]
+    higher_level_aggs_dict = stage_results["aggregations"]
+    anomalies_csvs = {**stage_results["anomalies"], "statistical_anomalies": stage_results["statistical_anomalies"]}
+    prompt_templates = stage_results["prompts"]
+    prompt_versions = _prompt_versions(prompt_templates)
 
-    # 3. Erzeuge höhere Aggregationen (für globale Vergleiche)
-    st.info("Schritt 3/4: Erstelle globale Aggregationen für übergeordnete Trends...")
-    higher_level_aggs_dict = get_higher_level_aggregations(df_with_kpis) # Ist jetzt ein Dict
     global_agg_country_pm_csv = higher_level_aggs_dict.get("by_country_payment_method", "Keine Aggregation nach Land & Zahlungsmethode verfügbar.")
     global_agg_country_csv = higher_level_aggs_dict.get("by_country", "Keine Aggregation nach Land verfügbar.") # NEU
     global_agg_pm_csv = higher_level_aggs_dict.get("by_payment_method", "Keine Aggregation nach Zahlungsmethode verfügbar.") # NEU
-
-
-    # 4. Extrahiere Top N/Auffälligkeiten aus den ursprünglichen Zeilen
-    st.info("Schritt 4/4: Extrahiere spezifische Auffälligkeiten und Extremwerte...")
-    anomalies_csvs = get_top_n_anomalies(df_with_kpis, n=7) # N kann angepasst werden, um Token zu sparen
+    statistical_anomalies_csv = anomalies_csvs["statistical_anomalies"].get("scored_cells", "Nicht verfügbar.")
 
     # Historische Insights aus MongoDB
     retrieved_historical_insights = []
     historical_insights_context = ""
     if mongo_client:
-        st.info("Suche nach ähnlichen historischen Erkenntnissen (falls MongoDB verbunden)...")
-        query_for_similar_insights = ""
-        if isinstance(detailed_data_summary_dict.get('column_names'), list) and isinstance(detailed_data_summary_dict.get('numerical_summary'), dict):
-            query_for_similar_insights = f"DataFrame overview: columns {detailed_data_summary_dict['column_names']}, rows {detailed_data_summary_dict['num_rows']}. Focus on numerical data: {detailed_data_summary_dict['numerical_summary']}"
-        if query_for_similar_insights:
-            retrieved_historical_insights = get_similar_insights(mongo_client, query_for_similar_insights, limit=5)
+        query_for_similar_insights, retrieved_historical_insights = stage_results["historical_insights"]
         if retrieved_historical_insights:
             historical_insights_context = "\n\n**Historische und ähnliche Erkenntnisse (zum Kontext und Vergleich):**\n"
             for insight in retrieved_historical_insights:
@@ -84,11 +399,24 @@ def perform_llm_analysis(
                     f"  **Quantitativer Impact:** {insight.get('quantitative_impact', 'N/A')}\n"
                     f"  **Confidence Level:** {insight.get('confidence_level', 'N/A')}\n\n"
                 )
-            st.info(f"Es wurden {len(retrieved_historical_insights)} ähnliche historische Erkenntnisse gefunden und dem Kontext hinzugefügt.")
+            reporter.info(f"Es wurden {len(retrieved_historical_insights)} ähnliche historische Erkenntnisse gefunden und dem Kontext hinzugefügt.")
         elif query_for_similar_insights:
-            st.info("Keine ähnlichen historischen Erkenntnisse in MongoDB gefunden oder Abfragefehler.")
+            reporter.info("Keine ähnlichen historischen Erkenntnisse in MongoDB gefunden oder Abfragefehler.")
     else:
-        st.info("MongoDB ist nicht verbunden (oder Nutzung nicht ausgewählt), daher keine Abfrage historischer Erkenntnisse für diese Analyse.")
+        reporter.info("MongoDB ist nicht verbunden (oder Nutzung nicht ausgewählt), daher keine Abfrage historischer Erkenntnisse für diese Analyse.")
+
+    # Datenabschnitte token-budgetiert aufbereiten (kompaktes JSON, Tabellen nach Priorität gekürzt);
+    # Analyse- und Review-Prompt verwenden dieselben Abschnitte
+    prompt_sections, prompt_token_report = build_prompt_sections({
+        "data_summary": detailed_data_summary_dict,
+        "statistical_anomalies": statistical_anomalies_csv,
+        "agg_country_payment_method": global_agg_country_pm_csv,
+        "agg_country": global_agg_country_csv,
+        "agg_payment_method": global_agg_pm_csv,
+        "write_offs": anomalies_csvs.get("all_write_offs_gt_0", "Nicht verfügbar."),
+        "historical_insights": historical_insights_context,
+    })
+    reporter.caption(format_token_report(prompt_token_report))
 
     # Kontext vorheriger Analysen
     previous_insights_summary_for_prompt = "Keine vorherige Analyse als direkter Kontext übergeben."
@@ -107,34 +435,23 @@ def perform_llm_analysis(
         )
 
     # Prompt-Handling
-    if follow_up_question and previous_analysis_results:
-        st.info(f"Führe fokussierte Folgeanalyse für die Frage durch: '{follow_up_question}'...")
-        # KORREKTUR: Pfad zur system_prompt_follow_up.txt angepasst
-        system_prompt_follow_up_path = os.path.join(os.path.dirname(__file__), '../prompts/system_prompt_follow_up.txt')
-        with open(system_prompt_follow_up_path, "r", encoding="utf-8") as f:
-            system_prompt = f.read() # system_prompt holds the content of system_prompt_follow_up.txt
-
-        user_content_path = os.path.join(os.path.dirname(__file__), '../prompts/user_content.txt')
-        with open(user_content_path, "r", encoding="utf-8") as f:
-            user_content = f.read()
+    system_prompt = prompt_templates["system"].render()
+    if is_follow_up:
+        reporter.info(f"Führe fokussierte Folgeanalyse für die Frage durch: '{follow_up_question}'...")
 
         template_ctx = {
-            "data_summary_json": json.dumps(detailed_data_summary_dict, indent=2, ensure_ascii=False),
-            "agg_country_payment_csv": global_agg_country_pm_csv,
-            "top_n": anomalies_csvs.get("n", 5),
-            "top_gross_sales_csv": anomalies_csvs.get("top_gross_sales", "Nicht verfügbar."),
-            "top_return_rate_csv": anomalies_csvs.get("top_return_rate_eur", "Nicht verfügbar."),
-            "all_write_offs_csv": anomalies_csvs.get("all_write_offs_gt_0", "Nicht verfügbar."),
-            "top_chargeback_rate_csv": anomalies_csvs.get("top_chargeback_rate_eur", "Nicht verfügbar."),
-            "top_dunning_level2_csv": anomalies_csvs.get("top_dunning_level2_eur", "Nicht verfügbar."),
+            "data_summary_json": prompt_sections["data_summary"],
+            "agg_country_payment_csv": prompt_sections["agg_country_payment_method"],
+            "statistical_anomalies_csv": prompt_sections["statistical_anomalies"],
+            "all_write_offs_csv": prompt_sections["write_offs"],
             "prev_insights_summary": previous_insights_summary_for_prompt,
             "follow_up_question": follow_up_question,
         }
 
-        user_content = user_content.format(**template_ctx)
+        user_content = prompt_templates["user"].render(**template_ctx)
         if additional_context_text:
             user_content += f"\n\n**Ursprünglicher zusätzlicher Kontext/Anweisungen vom Benutzer (für den Gesamtkontext relevant):**\n{additional_context_text}"
-        user_content += historical_insights_context
+        user_content += prompt_sections["historical_insights"]
 
         messages_for_llm = [
             {"role": "system", "content": system_prompt},
@@ -142,140 +459,181 @@ def perform_llm_analysis(
         ]
 
     else: # Initial analysis
-        st.info("Bereite Daten für die Erst-Analyse vor...")
-        system_prompt_initial_path = os.path.join(os.path.dirname(__file__), '../prompts/system_prompt_initial.txt')
-        with open(system_prompt_initial_path, 'r', encoding='utf-8') as f:
-            system_prompt = f.read()
-        
-        user_content_path = os.path.join(os.path.dirname(__file__), '../prompts/user_content_init.txt')
-        with open(user_content_path, "r", encoding="utf-8") as f:
-            user_content = f.read()
+        reporter.info("Bereite Daten für die Erst-Analyse vor...")
 
         template_ctx = {
-            "detailed_data_summary_dict": json.dumps(detailed_data_summary_dict, indent=2, ensure_ascii=False),
-            "global_agg_country_pm_csv": global_agg_country_pm_csv,
-            "global_agg_country_csv": global_agg_country_csv,
-            "top_gross_sales": anomalies_csvs.get('top_gross_sales', 'Nicht verfügbar.'),
-            "global_agg_pm_csv": global_agg_pm_csv,
+            "detailed_data_summary_dict": prompt_sections["data_summary"],
+            "global_agg_country_pm_csv": prompt_sections["agg_country_payment_method"],
+            "global_agg_country_csv": prompt_sections["agg_country"],
+            "global_agg_pm_csv": prompt_sections["agg_payment_method"],
+            "statistical_anomalies_csv": prompt_sections["statistical_anomalies"],
+            "all_write_offs_csv": prompt_sections["write_offs"],
         }
 
-        user_content = user_content.format(**template_ctx)
+        user_content = prompt_templates["user"].render(**template_ctx)
 
         if additional_context_text:
             user_content += f"\n\n**Zusätzlicher Kontext/Anweisungen vom Benutzer:**\n{additional_context_text}"
-        user_content += historical_insights_context
+        user_content += prompt_sections["historical_insights"]
         messages_for_llm = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_content}
         ]
-        st.info("Führe erste LLM-Analyse durch...")
+        reporter.info("Führe erste LLM-Analyse durch...")
 
     # LLM-Analyse durchführen
     initial_llm_response_content = None
+    llm_cache_hits = {"analysis": False, "review": False}
+    llm_started = time.perf_counter()
     try:
-        completion = openai_client.chat.completions.create(
+        initial_llm_response_content, llm_cache_hits["analysis"] = cached_chat_completion(
+            openai_client,
+            messages_for_llm,
+            on_delta=_insight_stream_handler(on_insight, "analysis"),
+            cache_tag=prompt_versions["combined"],
             model=os.getenv("OPENAI_MODEL", "gpt-4o"),
-            messages=messages_for_llm, 
             temperature=0.0,
             seed=123,
             max_tokens=3000
         )
-        initial_llm_response_content = completion.choices[0].message.content
-        st.success("Analyse vom LLM empfangen." if not follow_up_question else "Folgeanalyse vom LLM empfangen.")
+        stage_timings["stages"]["llm_analysis"] = round(time.perf_counter() - llm_started, 3)
+        if llm_cache_hits["analysis"]:
+            reporter.info("Analyse-Antwort aus dem lokalen LLM-Cache geladen (kein API-Aufruf).")
+        reporter.success("Analyse vom LLM empfangen." if not follow_up_question else "Folgeanalyse vom LLM empfangen.")
     except Exception as e:
         error_message = f"Fehler bei der API-Anfrage an OpenAI: {e}"
-        st.error(error_message)
+        reporter.error(error_message)
         return {"error": error_message}
 
-    # Selbstüberprüfung durch das LLM
-    st.info("Führe Selbstüberprüfung der Analyse durch...")
-    with open("prompts/review_system_prompt.txt", "r", encoding="utf-8") as f:
-        review_system_prompt = f.read()
-
-    review_user_prompt_content_path = os.path.join(os.path.dirname(__file__), '../prompts/review_user_prompt_content.txt')
-    with open(review_user_prompt_content_path, "r", encoding="utf-8") as f:
-            review_user_prompt_content = f.read()
-
-    template_ctx = {
-        "detailed_data_summary_dict": json.dumps(detailed_data_summary_dict, indent=2, ensure_ascii=False),
-        "global_agg_country_pm_csv": global_agg_country_pm_csv,
-        "global_agg_country_csv": global_agg_country_csv,
-        "global_agg_pm_csv": global_agg_pm_csv,
-        "n": anomalies_csvs.get('n', 5),
-        "top_gross_sales": anomalies_csvs.get('top_gross_sales', 'Nicht verfügbar.'),
-        "top_return_rate_eur": anomalies_csvs.get('top_return_rate_eur', 'Nicht verfügbar.'),
-        "all_write_offs_gt_0": anomalies_csvs.get('all_write_offs_gt_0', 'Nicht verfügbar.'),
-        "top_chargeback_rate_eur": anomalies_csvs.get('top_chargeback_rate_eur', 'Nicht verfügbar.'),
-        "top_dunning_level2_eur": anomalies_csvs.get('top_dunning_level2_eur', 'Nicht verfügbar.'),
-    }
+    # Selbstüberprüfung: im Delta-Modus lokale Prüfung der Datenpunkte und LLM-Review nur für strittige Erkenntnisse
+    final_llm_response_content = None
+    fact_check_report = None
+    review_mode = review_mode or LLM_REVIEW_MODE
+    if review_mode == "delta":
+        if "fact_check_index" not in stage_results:
+            reporter.info("Für das Delta-Review fehlt der Prüfindex der Daten. Führe vollständige Selbstüberprüfung durch...")
+        else:
+            llm_started = time.perf_counter()
+            final_llm_response_content, fact_check_report = _run_delta_review(
+                openai_client, initial_llm_response_content, stage_results["fact_check_index"],
+                prompt_templates, llm_cache_hits, reporter, on_insight
+            )
+            stage_timings["stages"]["delta_review"] = round(time.perf_counter() - llm_started, 3)
+            if final_llm_response_content is None:
+                reporter.warning("Delta-Review nicht möglich (kein lesbares JSON oder lokale Prüfung fehlgeschlagen). Führe vollständige Selbstüberprüfung durch...")
 
-    review_user_prompt_content = review_user_prompt_content.format(**template_ctx)
+    if final_llm_response_content is None:
+        # Vollständige Selbstüberprüfung durch das LLM (auch Rückfall für das Delta-Review)
+        reporter.info("Führe Selbstüberprüfung der Analyse durch...")
+        review_system_prompt = prompt_templates["review_system"].render()
+
+        template_ctx = {
+            "detailed_data_summary_dict": prompt_sections["data_summary"],
+            "global_agg_country_pm_csv": prompt_sections["agg_country_payment_method"],
+            "global_agg_country_csv": prompt_sections["agg_country"],
+            "global_agg_pm_csv": prompt_sections["agg_payment_method"],
+            "statistical_anomalies_csv": prompt_sections["statistical_anomalies"],
+            "all_write_offs_gt_0": prompt_sections["write_offs"],
+        }
+
+        review_user_prompt_content = prompt_templates["review_user"].render(**template_ctx)
     
-    if follow_up_question:
+        if follow_up_question:
+            review_user_prompt_content += (
+                "Die KI hat eine **Folgeanalyse** zu folgender spezifischen Frage durchgeführt:\n"
+                f"**Folgefrage:** '{follow_up_question}'\n\n"
+                "Kontext der direkt vorhergehenden Analyse (Zusammenfassung):\n"
+                f"{previous_insights_summary_for_prompt}\n\n"
+            )
         review_user_prompt_content += (
-            "Die KI hat eine **Folgeanalyse** zu folgender spezifischen Frage durchgeführt:\n"
-            f"**Folgefrage:** '{follow_up_question}'\n\n"
-            "Kontext der direkt vorhergehenden Analyse (Zusammenfassung):\n"
-            f"{previous_insights_summary_for_prompt}\n\n"
+            "Hier ist die Analyse (oder Folgeanalyse), die zuvor generiert wurde und nun überprüft werden soll:\n\n"
+            f"{initial_llm_response_content}\n\n"
+            "Bitte überprüfe diese Analyse gründlich anhand der oben genannten Kriterien und der bereitgestellten Daten. "
+            "Wenn es eine Folgeanalyse war, stelle besonders sicher, dass die spezifische Frage umfassend und korrekt beantwortet wurde. "
+            "Korrigiere die Analyse, falls notwendig, und gib die finale, korrigierte (oder bestätigte) JSON-Antwort aus. "
+            "Stelle sicher, dass die Ausgabe dem vorgegebenen JSON-Schema entspricht und alle Details wie 'supporting_data_points' korrekt und nachvollziehbar auf die bereitgestellten Datenabschnitte bezogen sind."
         )
-    review_user_prompt_content += (
-        "Hier ist die Analyse (oder Folgeanalyse), die zuvor generiert wurde und nun überprüft werden soll:\n\n"
-        f"{initial_llm_response_content}\n\n"
-        "Bitte überprüfe diese Analyse gründlich anhand der oben genannten Kriterien und der bereitgestellten Daten. "
-        "Wenn es eine Folgeanalyse war, stelle besonders sicher, dass die spezifische Frage umfassend und korrekt beantwortet wurde. "
-        "Korrigiere die Analyse, falls notwendig, und gib die finale, korrigierte (oder bestätigte) JSON-Antwort aus. "
-        "Stelle sicher, dass die Ausgabe dem vorgegebenen JSON-Schema entspricht und alle Details wie 'supporting_data_points' korrekt und nachvollziehbar auf die bereitgestellten Datenabschnitte bezogen sind."
-    )
-    if additional_context_text:
-        review_user_prompt_content += f"\n\n**Ursprünglicher zusätzlicher Kontext/Anweisungen vom Benutzer (relevant für den Gesamtkontext):**\n{additional_context_text}"
-    review_user_prompt_content += historical_insights_context
+        if additional_context_text:
+            review_user_prompt_content += f"\n\n**Ursprünglicher zusätzlicher Kontext/Anweisungen vom Benutzer (relevant für den Gesamtkontext):**\n{additional_context_text}"
+        review_user_prompt_content += prompt_sections["historical_insights"]
 
-    messages_review = [
-        {"role": "system", "content": review_system_prompt},
-        {"role": "user", "content": review_user_prompt_content}
-    ]
+        messages_review = [
+            {"role": "system", "content": review_system_prompt},
+            {"role": "user", "content": review_user_prompt_content}
+        ]
 
-    final_llm_response_content = None
-    try:
-        completion_review = openai_client.chat.completions.create(
-            model=os.getenv("OPENAI_MODEL", "gpt-4o"),
-            messages=messages_review,
-            temperature=0.0,
-            seed=123,
-            max_tokens=3000
-        )
-        final_llm_response_content = completion_review.choices[0].message.content
-        st.success("Selbstüberprüfung abgeschlossen. Finale Analyse empfangen.")
-    except Exception as e:
-        st.error(f"Fehler bei der zweiten API-Anfrage (Selbstüberprüfung) an OpenAI: {e}")
-        st.warning("Fehler bei der Selbstüberprüfung. Versuche, die vorherige Analyse (vor Review) zu verwenden.")
-        final_llm_response_content = initial_llm_response_content
+        llm_started = time.perf_counter()
+        try:
+            final_llm_response_content, llm_cache_hits["review"] = cached_chat_completion(
+                openai_client,
+                messages_review,
+                on_delta=_insight_stream_handler(on_insight, "review"),
+                cache_tag=prompt_versions["combined"],
+                model=os.getenv("OPENAI_MODEL", "gpt-4o"),
+                temperature=0.0,
+                seed=123,
+                max_tokens=3000
+            )
+            stage_timings["stages"]["llm_review"] = round(time.perf_counter() - llm_started, 3)
+            if llm_cache_hits["review"]:
+                reporter.info("Review-Antwort aus dem lokalen LLM-Cache geladen (kein API-Aufruf).")
+            reporter.success("Selbstüberprüfung abgeschlossen. Finale Analyse empfangen.")
+        except Exception as e:
+            reporter.error(f"Fehler bei der zweiten API-Anfrage (Selbstüberprüfung) an OpenAI: {e}")
+            reporter.warning("Fehler bei der Selbstüberprüfung. Versuche, die vorherige Analyse (vor Review) zu verwenden.")
+            final_llm_response_content = initial_llm_response_content
 
     # Parsing der LLM-Antwort
     if final_llm_response_content is None:
-        st.error("Keine Antwort vom LLM erhalten (final_llm_response_content is None).")
+        reporter.error("Keine Antwort vom LLM erhalten (final_llm_response_content is None).")
         return {"error": "Keine Antwort vom LLM erhalten.", "raw_response": "None"}
 
     try:
         json_string_extracted = extract_json_from_string(final_llm_response_content)
         if json_string_extracted is None:
-            st.error("Konnte keinen JSON-Block in der LLM-Antwort finden.")
-            st.write("Rohantwort der LLM-Anfrage (zur Fehlerbehebung):")
-            st.code(final_llm_response_content)
+            reporter.error("Konnte keinen JSON-Block in der LLM-Antwort finden.")
+            reporter.write("Rohantwort der LLM-Anfrage (zur Fehlerbehebung):")
+            reporter.code(final_llm_response_content)
             return {"error": "Kein JSON-Block in LLM-Antwort gefunden.", "raw_response": final_llm_response_content}
-        parsed_results = json.loads(json_string_extracted)
+        parsed_results = loads_json(json_string_extracted)
     except json.JSONDecodeError as e:
-        st.error(f"Fehler beim Parsen des JSON-Blocks aus der LLM-Antwort: {e}")
-        st.write("Extrahierter JSON-String (Versuch):")
-        st.code(json_string_extracted if 'json_string_extracted' in locals() else "Konnte keinen String extrahieren")
-        st.write("Rohantwort der LLM-Anfrage (zur Fehlerbehebung):")
-        st.code(final_llm_response_content)
+        reporter.error(f"Fehler beim Parsen des JSON-Blocks aus der LLM-Antwort: {e}")
+        reporter.write("Extrahierter JSON-String (Versuch):")
+        reporter.code(json_string_extracted if 'json_string_extracted' in locals() else "Konnte keinen String extrahieren")
+        reporter.write("Rohantwort der LLM-Anfrage (zur Fehlerbehebung):")
+        reporter.code(final_llm_response_content)
         return {"error": "LLM-Antwort konnte nicht als JSON geparst werden.", "raw_response": final_llm_response_content}
     except Exception as e:
-        st.error(f"Unerwarteter Fehler beim Verarbeiten der LLM-Antwort: {e}")
+        reporter.error(f"Unerwarteter Fehler beim Verarbeiten der LLM-Antwort: {e}")
         return {"error": f"Unerwarteter Fehler: {e}", "raw_response": final_llm_response_content}
 
+    schema_error = _check_insight_schema(parsed_results, final_llm_response_content, reporter)
+    if schema_error is not None:
+        return schema_error
+
     if parsed_results:
+        parsed_results["llm_cache_hits"] = llm_cache_hits
+        parsed_results["stage_timings"] = stage_timings
+        parsed_results["prompt_token_report"] = prompt_token_report
+        parsed_results["review_mode"] = review_mode
+        parsed_results["prompt_versions"] = prompt_versions
+        if fact_check_report is not None:
+            parsed_results["delta_review_check"] = {key: value for key, value in fact_check_report.items() if key != "items"}
+        if "fact_check_index" in stage_results and isinstance(parsed_results.get("insights"), list):
+            # Finale Erkenntnisse lokal prüfen und jede Erkenntnis bzw. jeden Datenpunkt mit dem Ergebnis markieren;
+            # ein Fehler der lokalen Prüfung darf das LLM-Ergebnis nicht verwerfen
+            try:
+                final_check_report = check_insights(stage_results["fact_check_index"], parsed_results["insights"])
+                annotate_insights(parsed_results["insights"], final_check_report)
+                tag_insight_dimensions(stage_results["fact_check_index"], parsed_results["insights"])
+            except Exception as e:
+                reporter.warning(f"Lokale Prüfung der Datenpunkte fehlgeschlagen ({e}). Erkenntnisse werden ungeprüft angezeigt.")
+            else:
+                parsed_results["fact_check"] = {key: value for key, value in final_check_report.items() if key != "items"}
+                reporter.caption(
+                    f"Datenpunkt-Prüfung: {final_check_report['verified']} bestätigt, {final_check_report['mismatch']} abweichend, "
+                    f"{final_check_report['unresolved']} nicht prüfbar ({final_check_report['latency']['verify_ms']} ms)."
+                )
         if follow_up_question:
             parsed_results["is_follow_up"] = True
             parsed_results["answered_question"] = follow_up_question
@@ -283,5 +641,112 @@ def perform_llm_analysis(
             parsed_results["is_follow_up"] = False
         return parsed_results
     else:
-        st.error("Es wurden keine gültigen Analyseergebnisse vom LLM zurückgegeben, obwohl kein expliziter Fehler aufgetreten ist.")
-        return {"error": "Keine gültigen Analyseergebnisse erhalten (parsed_results is None).", "raw_response": final_llm_response_content}
\ No newline at end of file
+        reporter.error("Es wurden keine gültigen Analyseergebnisse vom LLM zurückgegeben, obwohl kein expliziter Fehler aufgetreten ist.")
+        return {"error": "Keine gültigen Analyseergebnisse erhalten (parsed_results is None).", "raw_response": final_llm_response_content}
+
+
+def perform_comparison_analysis(
+    frames: dict,
+    openai_client: OpenAI,
+    additional_context_text: str = "",
+    on_insight=None,
+    reporter=None
+):
+    """
+    Vergleicht mehrere Datensätze (Quellname -> DataFrame, die erste Datei ist die Referenz) in einer
+    einzigen LLM-Anfrage. KPIs und Rollups aller Dateien entstehen in einem Durchlauf über den
+    zusammengeführten DataFrame (services/comparison.py); der Prompt enthält nur die Delta-Tabellen
+    gegenüber der Referenz. Ergebnis wie bei perform_llm_analysis, zusätzlich mit "compared_sources"
+    und "comparison_deltas" (CSV je Ebene).
+    """
+    reporter = reporter or StreamlitReporter()
+    if openai_client is None:
+        return {"error": "OpenAI Client ist nicht initialisiert. Bitte API-Schlüssel prüfen."}
+    if len(frames) < 2:
+        return {"error": "Für einen Vergleich werden mindestens zwei Dateien benötigt."}
+
+    reporter.info(f"Berechne KPIs und Rollups für {len(frames)} Dateien in einem gemeinsamen Durchlauf...")
+    fingerprint = "+".join(dataframe_fingerprint(df) for df in frames.values())
+    params = {"sources": tuple(frames), "min_sales_share": COMPARISON_MIN_SALES_SHARE}
+    try:
+        stage_results, stage_timings = run_stage_graph({
+            "comparison": ((), lambda: run_cached_stage("comparison", fingerprint, lambda: compute_comparison_stages(frames), params=params)),
+            "prompts": ((), _load_comparison_prompt_templates),
+        })
+    except ValueError as e:
+        reporter.error(str(e))
+        return {"error": str(e)}
+    reporter.caption(_format_stage_timings(stage_timings))
+
+    comparison = stage_results["comparison"]
+    prompt_templates = stage_results["prompts"]
+    prompt_versions = _prompt_versions(prompt_templates)
+    prompt_sections, prompt_token_report = build_prompt_sections({
+        "comparison_sources": comparison["sources"],
+        "comparison_totals": comparison["rollups"]["by_source"],
+        "delta_total": comparison["deltas"]["by_source"],
+        "delta_by_country": comparison["deltas"]["by_country"],
+        "delta_by_payment_method": comparison["deltas"]["by_payment_method"],
+        "delta_by_country_payment_method": comparison["deltas"]["by_country_payment_method"],
+    })
+    reporter.caption(format_token_report(prompt_token_report))
+
+    user_content = prompt_templates["user"].render(
+        reference_source=comparison["reference"],
+        comparison_sources_json=prompt_sections["comparison_sources"],
+        comparison_totals_csv=prompt_sections["comparison_totals"],
+        delta_total_csv=prompt_sections["delta_total"],
+        delta_country_csv=prompt_sections["delta_by_country"],
+        delta_pm_csv=prompt_sections["delta_by_payment_method"],
+        delta_country_pm_csv=prompt_sections["delta_by_country_payment_method"],
+    )
+    if additional_context_text:
+        user_content += f"\n\n**Zusätzlicher Kontext/Anweisungen vom Benutzer:**\n{additional_context_text}"
+    messages_for_llm = [
+        {"role": "system", "content": prompt_templates["system"].render()},
+        {"role": "user", "content": user_content}
+    ]
+
+    reporter.info("Führe Vergleichsanalyse durch...")
+    llm_cache_hits = {"analysis": False}
+    llm_started = time.perf_counter()
+    try:
+        llm_response_content, llm_cache_hits["analysis"] = cached_chat_completion(
+            openai_client,
+            messages_for_llm,
+            on_delta=_insight_stream_handler(on_insight, "analysis"),
+            cache_tag=prompt_versions["combined"],
+            model=os.getenv("OPENAI_MODEL", "gpt-4o"),
+            temperature=0.0,
+            seed=123,
+            max_tokens=3000
+        )
+        stage_timings["stages"]["llm_analysis"] = round(time.perf_counter() - llm_started, 3)
+        if llm_cache_hits["analysis"]:
+            reporter.info("Vergleichsanalyse aus dem lokalen LLM-Cache geladen (kein API-Aufruf).")
+        reporter.success("Vergleichsanalyse vom LLM empfangen.")
+    except Exception as e:
+        error_message = f"Fehler bei der API-Anfrage an OpenAI: {e}"
+        reporter.error(error_message)
+        return {"error": error_message}
+
+    parsed_results = _parse_llm_json(llm_response_content)
+    if parsed_results is None:
+        reporter.error("Die Antwort der Vergleichsanalyse enthält kein lesbares JSON.")
+        reporter.write("Rohantwort der LLM-Anfrage (zur Fehlerbehebung):")
+        reporter.code(llm_response_content)
+        return {"error": "LLM-Antwort konnte nicht als JSON geparst werden.", "raw_response": llm_response_content}
+    schema_error = _check_insight_schema(parsed_results, llm_response_content, reporter)
+    if schema_error is not None:
+        return schema_error
+
+    parsed_results["llm_cache_hits"] = llm_cache_hits
+    parsed_results["stage_timings"] = stage_timings
+    parsed_results["prompt_token_report"] = prompt_token_report
+    parsed_results["prompt_versions"] = prompt_versions
+    parsed_results["compared_sources"] = comparison["sources"]
+    parsed_results["comparison_reference"] = comparison["reference"]
+    parsed_results["comparison_deltas"] = comparison["deltas"]
+    parsed_results["is_follow_up"] = False
+    parsed_results["is_comparison"] = True
+    return parsed_results
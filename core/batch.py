@@ -0,0 +1,269 @@
+import argparse
+import json
+import multiprocessing
+import os
+import threading
+import time
+import types
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import pandas as pd
+from dotenv import load_dotenv
+
+from core.analyzer import perform_llm_analysis, get_openai_client_internal, compute_analysis_stages, \
+                          load_analysis_snapshot, TOP_N_ANOMALIES
+from core.reporting import ConsoleReporter
+from services.db import get_mongo_client, ensure_indexes
+from services.incremental import analyze_incrementally, INCREMENTAL_MODE
+from services.loader import load_tabular_file, get_file_extension, sniff_csv_delimiter, compute_stream_content_hash, \
+                            SUPPORTED_TABULAR_EXTENSIONS
+from services.streaming import analyze_csv_in_chunks, CSV_STREAMING_THRESHOLD_MB
+
+# Anzahl Prozesse für die Datenstufen (Parsen, KPIs, Aggregationen, Anomalien)
+BATCH_CPU_WORKERS = int(os.getenv("BATCH_CPU_WORKERS", str(os.cpu_count() or 2)))
+# Maximale Anzahl gleichzeitiger LLM-Anfragen
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "4"))
+# Maximale Anzahl gestarteter LLM-Anfragen pro Minute (0 = unbegrenzt)
+BATCH_LLM_REQUESTS_PER_MINUTE = int(os.getenv("BATCH_LLM_REQUESTS_PER_MINUTE", "60"))
+MANIFEST_FILENAME = "manifest.json"
+
+
+class RateLimitedChatClient:
+    """
+    Hülle um einen OpenAI-Client: chat.completions.create wartet auf einen von `max_concurrent` Plätzen
+    und hält zwischen zwei Anfragestarts mindestens 60 / requests_per_minute Sekunden Abstand.
+    Bei stream=True bleibt der Platz belegt, bis der Stream vollständig gelesen ist.
+    """
+
+    def __init__(self, openai_client, max_concurrent: int, requests_per_minute: int = 0):
+        self._client = openai_client
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create))
+
+    def _wait_for_start_slot(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+
+    def _release_after_stream(self, stream):
+        try:
+            yield from stream
+        finally:
+            self._semaphore.release()
+
+    def _create(self, **kwargs):
+        self._semaphore.acquire()
+        try:
+            self._wait_for_start_slot()
+            response = self._client.chat.completions.create(**kwargs)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        if kwargs.get("stream"):
+            return self._release_after_stream(response)
+        self._semaphore.release()
+        return response
+
+
+def _file_content_hash(path: str) -> str:
+    # Entspricht compute_content_hash über die Dateibytes, ohne die Datei vollständig zu laden
+    with open(path, "rb") as f:
+        return compute_stream_content_hash(f)
+
+
+def compute_file_stages(path: str, incremental: bool = False, months: list = None, countries: list = None) -> dict:
+    """
+    Berechnet die Datenstufen einer Datei (läuft in einem Worker-Prozess). Große CSV-Dateien werden
+    chunkweise verarbeitet, mit incremental=True werden nur neue oder geänderte Monate neu berechnet.
+    Mit `months`/`countries` werden nur die passenden Partitionen aus dem Parquet-Speicher gelesen;
+    der Inhalts-Hash entfällt dann, da Snapshots immer für die vollständige Datei gelten.
+    Gibt Stufenergebnisse, Inhalts-Hash, Modus und Laufzeit zurück.
+    """
+    started = time.perf_counter()
+    filtered = months is not None or countries is not None
+    if not filtered and get_file_extension(path) == "csv" and os.path.getsize(path) > CSV_STREAMING_THRESHOLD_MB * 1024 * 1024:
+        with open(path, "rb") as f:
+            delimiter = sniff_csv_delimiter(f.read(2048))
+        stages = analyze_csv_in_chunks(path, delimiter, n=TOP_N_ANOMALIES)
+        stages.pop("preview", None)
+        content_hash, mode = _file_content_hash(path), "streaming"
+    else:
+        with open(path, "rb") as f:
+            df = load_tabular_file(f.read(), os.path.basename(path), months=months, countries=countries)
+        if df is None or df.empty:
+            raise ValueError("Keine Zeilen für die gewählten Monate/Länder.")
+        if incremental:
+            stages, mode = analyze_incrementally(df, n=TOP_N_ANOMALIES), "incremental"
+        else:
+            (stages, _), mode = compute_analysis_stages(df), "in_memory"
+        content_hash = None if filtered else df.attrs["content_hash"]
+    return {"stages": stages, "content_hash": content_hash, "mode": mode, "cpu_seconds": round(time.perf_counter() - started, 3)}
+
+
+def _output_filename(path: str) -> str:
+    stem, extension = os.path.splitext(os.path.basename(path))
+    return f"{stem}_{extension.lstrip('.')}_ergebnisse.json"
+
+
+def _analyze_with_llm(path: str, computed: dict, llm_client, mongo_client, use_history: bool, args, output_dir: str) -> dict:
+    filename = os.path.basename(path)
+    started = time.perf_counter()
+    results = perform_llm_analysis(
+        None,
+        llm_client,
+        mongo_client if use_history else None,
+        args.context,
+        filename,
+        precomputed_stages=computed["stages"],
+        review_mode=args.review_mode,
+        content_hash=computed["content_hash"],
+        snapshot_client=mongo_client,
+        reporter=ConsoleReporter(filename, verbose=args.verbose),
+    )
+    output_path = os.path.join(output_dir, _output_filename(path))
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False, default=str)
+    return {
+        "status": "error" if results.get("error") else "ok",
+        "error": results.get("error"),
+        "output": os.path.basename(output_path),
+        "insights": len(results.get("insights") or []),
+        "fact_check": results.get("fact_check"),
+        "llm_cache_hits": results.get("llm_cache_hits"),
+        "llm_seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def _write_manifest(manifest: dict, output_dir: str):
+    with open(os.path.join(output_dir, MANIFEST_FILENAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False, default=str)
+
+
+def run_batch(input_dir: str, output_dir: str, args) -> dict:
+    """
+    Analysiert alle unterstützten Dateien in `input_dir`: Datenstufen parallel in einem Prozess-Pool,
+    LLM-Analysen in Threads mit begrenzter Parallelität und Anfragerate. Schreibt pro Datei ein
+    Ergebnis-JSON sowie ein Manifest des Laufs nach `output_dir` und gibt das Manifest zurück.
+    """
+    reporter = ConsoleReporter("batch")
+    os.makedirs(output_dir, exist_ok=True)
+    paths = sorted(
+        os.path.join(input_dir, name) for name in os.listdir(input_dir)
+        if os.path.isfile(os.path.join(input_dir, name)) and get_file_extension(name) in SUPPORTED_TABULAR_EXTENSIONS
+    )
+    manifest = {
+        "started_at": pd.Timestamp.now().isoformat(),
+        "input_dir": os.path.abspath(input_dir),
+        "settings": {
+            "cpu_workers": args.cpu_workers, "llm_concurrency": args.llm_concurrency,
+            "llm_requests_per_minute": args.llm_rpm, "review_mode": args.review_mode, "use_mongodb": args.use_mongodb,
+            "incremental": args.incremental, "months": args.months, "countries": args.countries,
+        },
+        "files": {os.path.basename(path): {"status": "pending"} for path in paths},
+    }
+    filtered = args.months is not None or args.countries is not None
+    openai_client = get_openai_client_internal()
+    if openai_client is None:
+        reporter.error("OpenAI Client ist nicht initialisiert. Bitte OPENAI_API_KEY prüfen.")
+        manifest["error"] = "OpenAI Client ist nicht initialisiert."
+        _write_manifest(manifest, output_dir)
+        return manifest
+    llm_client = RateLimitedChatClient(openai_client, args.llm_concurrency, args.llm_rpm)
+    mongo_client = None
+    if args.use_mongodb:
+        mongo_client = get_mongo_client(os.getenv("MONGO_URI"), os.getenv("MONGO_DB_NAME", "attention_guiding_db"), reporter)
+        if mongo_client is None:
+            # --use-mongodb ausdrücklich angefordert: nicht still ohne Historie und Snapshots weiterlaufen
+            manifest["error"] = "MongoDB-Verbindung fehlgeschlagen (MONGO_URI prüfen, Details in der Konsolenausgabe)."
+            _write_manifest(manifest, output_dir)
+            return manifest
+        ensure_indexes(mongo_client)
+    reporter.info(f"{len(paths)} Dateien gefunden. Starte Datenstufen mit {args.cpu_workers} Prozessen...")
+
+    started = time.perf_counter()
+    # "spawn", da im Hauptprozess bereits Threads (LLM-Anfragen) laufen, wenn weitere Worker starten
+    with ProcessPoolExecutor(args.cpu_workers, mp_context=multiprocessing.get_context("spawn")) as process_pool, \
+            ThreadPoolExecutor(max(1, 2 * args.llm_concurrency), thread_name_prefix="batch-llm") as llm_pool:
+        cpu_futures, llm_futures = {}, {}
+        for path in paths:
+            content_hash = _file_content_hash(path) if mongo_client and not filtered else None
+            snapshot = load_analysis_snapshot(mongo_client, content_hash) if content_hash else None
+            if snapshot:
+                # Bereits analysierter Dateiinhalt: Datenstufen aus dem Snapshot, direkt zur LLM-Analyse
+                manifest["files"][os.path.basename(path)].update(mode="snapshot", cpu_seconds=0.0, content_hash=content_hash)
+                computed = {"stages": snapshot, "content_hash": content_hash}
+                llm_futures[llm_pool.submit(_analyze_with_llm, path, computed, llm_client, mongo_client, args.use_mongodb, args, output_dir)] = path
+            else:
+                cpu_futures[process_pool.submit(compute_file_stages, path, args.incremental, args.months, args.countries)] = path
+
+        for future in as_completed(cpu_futures):
+            path = cpu_futures[future]
+            entry = manifest["files"][os.path.basename(path)]
+            try:
+                computed = future.result()
+            except Exception as e:
+                entry.update(status="error", error=f"Datenstufen fehlgeschlagen: {e}")
+                reporter.error(f"{os.path.basename(path)}: {entry['error']}")
+                continue
+            entry.update(mode=computed["mode"], cpu_seconds=computed["cpu_seconds"], content_hash=computed["content_hash"])
+            if computed["mode"] == "incremental":
+                entry["incremental"] = computed["stages"]["summary"]["incremental"]
+            llm_futures[llm_pool.submit(_analyze_with_llm, path, computed, llm_client, mongo_client, args.use_mongodb, args, output_dir)] = path
+
+        for future in as_completed(llm_futures):
+            path = llm_futures[future]
+            entry = manifest["files"][os.path.basename(path)]
+            try:
+                entry.update(future.result())
+            except Exception as e:
+                entry.update(status="error", error=f"LLM-Analyse fehlgeschlagen: {e}")
+            if entry["status"] == "ok":
+                reporter.success(f"{os.path.basename(path)}: {entry['insights']} Erkenntnisse -> {entry['output']}")
+            else:
+                reporter.error(f"{os.path.basename(path)}: {entry['error']}")
+
+    statuses = [entry["status"] for entry in manifest["files"].values()]
+    manifest.update(
+        finished_at=pd.Timestamp.now().isoformat(),
+        wall_seconds=round(time.perf_counter() - started, 3),
+        succeeded=statuses.count("ok"),
+        failed=len(statuses) - statuses.count("ok"),
+    )
+    _write_manifest(manifest, output_dir)
+    reporter.info(f"Fertig: {manifest['succeeded']} erfolgreich, {manifest['failed']} fehlgeschlagen ({manifest['wall_seconds']} s).")
+    return manifest
+
+
+def _comma_list(value: str) -> list:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Analysiert alle Exporte eines Verzeichnisses ohne Streamlit-Oberfläche.")
+    parser.add_argument("input_dir", help="Verzeichnis mit .csv- und .xlsx-Exporten")
+    parser.add_argument("output_dir", help="Zielverzeichnis für Ergebnis-JSONs und manifest.json")
+    parser.add_argument("--cpu-workers", type=int, default=BATCH_CPU_WORKERS)
+    parser.add_argument("--llm-concurrency", type=int, default=BATCH_LLM_CONCURRENCY)
+    parser.add_argument("--llm-rpm", type=int, default=BATCH_LLM_REQUESTS_PER_MINUTE, help="LLM-Anfragen pro Minute (0 = unbegrenzt)")
+    parser.add_argument("--review-mode", choices=["full", "delta"], default=None)
+    parser.add_argument("--context", default="", help="Zusätzlicher Kontext für alle Analysen")
+    parser.add_argument("--use-mongodb", action="store_true", help="Historische Erkenntnisse und Snapshots aus MongoDB nutzen")
+    parser.add_argument("--incremental", action="store_true", default=INCREMENTAL_MODE,
+                        help="Nur neue oder geänderte Monate neu berechnen (Monats-Teilaggregate auf der Platte)")
+    parser.add_argument("--months", type=_comma_list, default=None, help="Nur diese Monate analysieren, z.B. 2024-11,2024-12")
+    parser.add_argument("--countries", type=_comma_list, default=None, help="Nur diese Länder analysieren, z.B. DE,AT")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    load_dotenv()
+    manifest = run_batch(args.input_dir, args.output_dir, args)
+    return 0 if manifest.get("failed") == 0 and "error" not in manifest else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
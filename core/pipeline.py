@@ -0,0 +1,73 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Anzahl Worker-Threads für unabhängige Pipeline-Stufen
+PIPELINE_MAX_WORKERS = int(os.getenv("PIPELINE_MAX_WORKERS", "4"))
+
+
+def _topological_order(stages: dict) -> list:
+    """
+    Prüft den Abhängigkeitsgraphen (unbekannte Stufen, Zyklen) und gibt eine gültige Ausführungsreihenfolge zurück.
+    """
+    order = []
+    state = {}
+
+    def visit(name, path):
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "active":
+            raise ValueError(f"Zyklische Abhängigkeit zwischen Pipeline-Stufen: {' -> '.join(path + [name])}")
+        state[name] = "active"
+        for dependency in stages[name][0]:
+            if dependency not in stages:
+                raise ValueError(f"Pipeline-Stufe '{name}' hängt von unbekannter Stufe '{dependency}' ab.")
+            visit(dependency, path + [name])
+        state[name] = "done"
+        order.append(name)
+
+    for name in stages:
+        visit(name, [])
+    return order
+
+
+async def _run_stage_graph_async(stages: dict, order: list, max_workers: int):
+    loop = asyncio.get_running_loop()
+    durations = {}
+    tasks = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis-stage") as executor:
+        async def run_stage(name):
+            dependencies, fn = stages[name]
+            dependency_results = [await tasks[dependency] for dependency in dependencies]
+            started = time.perf_counter()
+            result = await loop.run_in_executor(executor, fn, *dependency_results)
+            durations[name] = round(time.perf_counter() - started, 3)
+            return result
+
+        for name in order:
+            tasks[name] = asyncio.ensure_future(run_stage(name))
+        results = await asyncio.gather(*tasks.values())
+    return dict(zip(tasks, results)), durations
+
+
+def run_stage_graph(stages: dict, max_workers: int = None):
+    """
+    Führt Pipeline-Stufen entlang ihres Abhängigkeitsgraphen aus.
+    `stages` bildet Stufennamen auf (abhängigkeiten, fn) ab; fn erhält die Ergebnisse seiner
+    Abhängigkeiten als Positionsargumente. Stufen ohne gegenseitige Abhängigkeit laufen gleichzeitig
+    in einem Thread-Pool (pandas/NumPy und I/O wie MongoDB-Abfragen geben dabei den GIL frei).
+    Die Stufenfunktionen laufen in Worker-Threads und dürfen daher keine st.*-Aufrufe enthalten.
+    Gibt (ergebnisse, laufzeiten) zurück; laufzeiten enthält die Dauer pro Stufe sowie die
+    Gesamtdauer ("wall_seconds") und die Summe der Stufendauern ("sum_seconds").
+    """
+    order = _topological_order(stages)
+    started = time.perf_counter()
+    results, durations = asyncio.run(_run_stage_graph_async(stages, order, max_workers or PIPELINE_MAX_WORKERS))
+    timings = {
+        "stages": {name: durations[name] for name in order},
+        "wall_seconds": round(time.perf_counter() - started, 3),
+        "sum_seconds": round(sum(durations.values()), 3),
+    }
+    return results, timings
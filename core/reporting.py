@@ -0,0 +1,98 @@
+import sys
+
+
+class NullReporter:
+    """
+    Fortschritts- und Statusmeldungen der Analyse verwerfen (z.B. in Tests oder Worker-Prozessen).
+    Alle Reporter bieten dieselben Methoden wie die entsprechenden st.*-Aufrufe.
+    """
+
+    def info(self, message):
+        pass
+
+    def success(self, message):
+        pass
+
+    def warning(self, message):
+        pass
+
+    def error(self, message):
+        pass
+
+    def caption(self, message):
+        pass
+
+    def write(self, message):
+        pass
+
+    def code(self, text):
+        pass
+
+
+class StreamlitReporter(NullReporter):
+    """
+    Gibt Meldungen in der Streamlit-Oberfläche aus (Standard für perform_llm_analysis).
+    """
+
+    def __init__(self):
+        import streamlit as st
+        self.st = st
+
+    def info(self, message):
+        self.st.info(message)
+
+    def success(self, message):
+        self.st.success(message)
+
+    def warning(self, message):
+        self.st.warning(message)
+
+    def error(self, message):
+        self.st.error(message)
+
+    def caption(self, message):
+        self.st.caption(message)
+
+    def write(self, message):
+        self.st.write(message)
+
+    def code(self, text):
+        self.st.code(text)
+
+
+class ConsoleReporter(NullReporter):
+    """
+    Gibt Meldungen zeilenweise auf der Konsole aus, optional mit Präfix (z.B. Dateiname im Batch-Lauf).
+    Warnungen und Fehler gehen nach stderr; Codeblöcke (Rohantworten) nur mit verbose=True.
+    """
+
+    def __init__(self, prefix: str = "", verbose: bool = False):
+        self.prefix = f"[{prefix}] " if prefix else ""
+        self.verbose = verbose
+
+    def _print(self, level: str, message, stream=None):
+        print(f"{self.prefix}{level}: {message}", file=stream or sys.stdout, flush=True)
+
+    def info(self, message):
+        self._print("Info", message)
+
+    def success(self, message):
+        self._print("OK", message)
+
+    def warning(self, message):
+        self._print("Warnung", message, sys.stderr)
+
+    def error(self, message):
+        self._print("Fehler", message, sys.stderr)
+
+    def caption(self, message):
+        if self.verbose:
+            self._print("Info", message)
+
+    def write(self, message):
+        if self.verbose:
+            self._print("Info", message)
+
+    def code(self, text):
+        if self.verbose:
+            print(text, flush=True)
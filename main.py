@@ -3,10 +3,16 @@ import pandas as pd
 import os
 from dotenv import load_dotenv
 import json
-import csv
+import io
 
-from core.analyzer import perform_llm_analysis, get_openai_client_internal
-from services.db import get_mongo_client, save_insight
+from core.analyzer import perform_llm_analysis, perform_comparison_analysis, get_openai_client_internal, load_analysis_snapshot, TOP_N_ANOMALIES
+from services.db import get_mongo_client, ensure_indexes, InsightWriteQueue
+from services.loader import load_tabular_file, load_stored_dataset, get_file_extension, compute_stream_content_hash, \
+                           SUPPORTED_TABULAR_EXTENSIONS
+from services.dataset_store import list_stored_datasets
+from services.streaming import analyze_csv_stream_in_chunks, read_csv_preview, CSV_STREAMING_THRESHOLD_MB
+from services.incremental import analyze_incrementally, INCREMENTAL_MODE
+from services.prompt_registry import load_prompt_templates
 
 st.set_page_config(layout="wide", page_title="Attention Guiding App", page_icon="📊")
 
@@ -21,15 +27,131 @@ openai_client = _get_openai_client_cached()
 
 @st.cache_resource
 def _get_mongo_client_cached():
-    return get_mongo_client(mongo_uri, mongo_db_name)
+    client = get_mongo_client(mongo_uri, mongo_db_name)
+    # Indizes einmal pro Prozess sicherstellen
+    ensure_indexes(client)
+    return client
 mongo_client = _get_mongo_client_cached()
 
+@st.cache_resource
+def _get_insight_write_queue(_mongo_client):
+    return InsightWriteQueue(_mongo_client) if _mongo_client is not None else None
+insight_write_queue = _get_insight_write_queue(mongo_client)
+
+# Prompt-Vorlagen einmal laden und Platzhalter prüfen; später nur bei Dateiänderung neu gelesen
+try:
+    load_prompt_templates()
+except (OSError, ValueError) as e:
+    st.error(f"Prompt-Vorlagen konnten nicht geladen werden: {e}")
+
+# Markierung der lokalen Prüfung zitierter Datenpunkte (services/fact_check.py)
+VERIFICATION_BADGES = {"verified": "✅ ", "mismatch": "⚠️ ", "unverified": "❔ ", "unresolved": "❔ "}
+
+def render_insight(insight: dict):
+    """
+    Zeigt eine einzelne Erkenntnis als aufklappbaren Abschnitt an.
+    """
+    verification = insight.get("verification") or {}
+    badge = VERIFICATION_BADGES.get(verification.get("status"), "")
+    with st.expander(f"{badge}**{insight.get('title', 'Kein Titel')}** (Typ: {insight.get('type', 'Unbekannt')})"):
+        st.write(f"**Beschreibung:** {insight.get('description', 'N/A')}")
+        st.write(f"**Betroffener Bereich:** {insight.get('affected_area', 'N/A')}")
+        st.write(f"**Zeitraum:** {insight.get('period', 'N/A')}")
+        st.write(f"**Quantitativer Impact:** {insight.get('quantitative_impact', 'N/A')}")
+        st.write(f"**Confidence Level:** {insight.get('confidence_level', 'N/A')}")
+        if verification:
+            st.caption(
+                f"Datenpunkt-Prüfung: {verification['verified']} bestätigt, {verification['mismatch']} abweichend, "
+                f"{verification['unresolved']} nicht prüfbar."
+            )
+        if insight.get('supporting_data_points'):
+            st.write("**Stützende Datenpunkte:**")
+            for dp_idx, dp in enumerate(insight['supporting_data_points']):
+                if isinstance(dp, dict): # Überprüfen, ob dp ein Dictionary ist
+                    dp_badge = VERIFICATION_BADGES.get(dp.get("verification_status"), "")
+                    actual_value = f" (lokal ermittelt: {dp['actual_value']})" if "actual_value" in dp else ""
+                    st.markdown(f"- {dp_badge}**Referenz {dp_idx+1}:** {dp.get('row_reference', 'N/A')}, **Spalte:** {dp.get('column_reference', 'N/A')}, **Wert:** {dp.get('value', 'N/A')}{actual_value}, **Erklärung:** {dp.get('explanation', 'N/A')}")
+                else:
+                    # Gibt den tatsächlichen Inhalt von dp aus, wenn es kein Dictionary ist
+                    st.markdown(f"- **Referenz {dp_idx+1} (Unerwartetes Format):** {str(dp)}")
+
+def make_live_insight_renderer(target):
+    """
+    Gibt einen on_insight-Callback für perform_llm_analysis zurück, der gestreamte Erkenntnisse
+    sofort in `target` anzeigt. Erkenntnisse der Erstanalyse werden als vorläufig markiert und
+    durch die überprüften Erkenntnisse ersetzt, sobald das Review zu streamen beginnt.
+    """
+    slot = target.empty()
+    state = {"phase": None, "container": None}
+
+    def on_insight(insight: dict, phase: str):
+        if phase != state["phase"]:
+            state["phase"] = phase
+            state["container"] = slot.container()
+            if phase == "analysis":
+                state["container"].caption("⏳ Vorläufige Erkenntnisse (werden noch überprüft):")
+            else:
+                state["container"].caption("🔎 Überprüfte Erkenntnisse (Analyse läuft noch):")
+        with state["container"]:
+            render_insight(insight)
+    return on_insight
+
+def lookup_analysis_snapshot(content_hash: str):
+    """
+    Gibt den in MongoDB gespeicherten Analyse-Snapshot für den Dateiinhalt zurück (oder None).
+    Pro Inhalt wird MongoDB nur einmal je Sitzung abgefragt.
+    """
+    if mongo_client is None or not content_hash:
+        return None
+    if st.session_state.snapshot_hash != content_hash:
+        st.session_state.snapshot_hash = content_hash
+        st.session_state.snapshot_stages = load_analysis_snapshot(mongo_client, content_hash)
+    return st.session_state.snapshot_stages
+
+def lookup_incremental_stages(df: pd.DataFrame, content_hash: str):
+    """
+    Berechnet die Datenstufen im inkrementellen Modus (nur neue oder geänderte Monate).
+    Pro Inhalt wird nur einmal je Sitzung gerechnet.
+    """
+    if st.session_state.incremental_hash != content_hash or not content_hash:
+        st.session_state.incremental_hash = content_hash
+        st.session_state.incremental_stages = analyze_incrementally(df, n=TOP_N_ANOMALIES)
+    return st.session_state.incremental_stages
+
+def select_precomputed_stages(df: pd.DataFrame):
+    """
+    Setzt Inhalts-Hash und vorberechnete Stufenergebnisse (Snapshot oder inkrementeller Modus) für einen geladenen DataFrame.
+    """
+    st.session_state.content_hash = df.attrs.get("content_hash")
+    # Bereits analysierter Dateiinhalt: Stufenergebnisse aus dem Snapshot statt Neuberechnung
+    st.session_state.streamed_stages = lookup_analysis_snapshot(st.session_state.content_hash)
+    if st.session_state.streamed_stages:
+        st.caption("Analyse-Snapshot dieser Datei aus MongoDB geladen; Datenstufen werden nicht neu berechnet.")
+    elif INCREMENTAL_MODE:
+        st.session_state.streamed_stages = lookup_incremental_stages(df, st.session_state.content_hash)
+        incremental_report = st.session_state.streamed_stages["summary"]["incremental"]
+        st.caption(
+            f"Inkrementeller Modus: {len(incremental_report['computed_months'])} von {incremental_report['months']} "
+            f"Monaten neu berechnet, {len(incremental_report['reused_months'])} aus Teilaggregaten übernommen."
+        )
+
+def stored_dataset_label(dataset: dict) -> str:
+    months = dataset.get("months") or []
+    period = f", {months[0]} bis {months[-1]}" if months else ""
+    return f"{dataset.get('filename') or dataset['key']} ({dataset['num_rows']} Zeilen{period})"
+
 # Session State Initialisierung
 session_defaults = {
     "analysis_results": None,
     "prompt_text_area_content": "",
     "last_analyzed_filename": "",
     "last_analyzed_dataframe": None,
+    "streamed_stages": None,
+    "content_hash": None,
+    "snapshot_hash": None,
+    "snapshot_stages": None,
+    "incremental_hash": None,
+    "incremental_stages": None,
     "use_mongodb_for_analysis": False,
     "use_mongodb_for_follow_up": False,
     "selected_follow_up_question": None,
@@ -101,23 +223,71 @@ with col1:
     df_to_analyze = None
     additional_context_from_txt_main_upload = ""
 
-    if uploaded_file is not None:
+    # Früher hochgeladene Datensätze liegen im Parquet-Speicher und lassen sich ohne erneuten Upload laden
+    stored_datasets = {dataset["key"]: dataset for dataset in list_stored_datasets()} if uploaded_file is None else {}
+    stored_dataset = None
+    if stored_datasets:
+        stored_key = st.selectbox(
+            "Oder einen gespeicherten Datensatz laden:",
+            [None] + list(stored_datasets),
+            format_func=lambda key: "–" if key is None else stored_dataset_label(stored_datasets[key]),
+            key="stored_dataset_select",
+        )
+        stored_dataset = stored_datasets.get(stored_key)
+
+    if stored_dataset is not None:
+        stored_name = stored_dataset.get("filename") or stored_dataset["key"]
+        if st.session_state.last_analyzed_filename != stored_name:
+            st.session_state.analysis_results = None
+            st.session_state.streamed_stages = None
+            st.session_state.content_hash = None
+            st.session_state.selected_follow_up_question = None
+            st.session_state.current_follow_up_question_for_saving = None
+        st.session_state.last_analyzed_filename = stored_name
+        df_to_analyze = load_stored_dataset(stored_dataset["key"])
+        if df_to_analyze is None:
+            st.error("Der gespeicherte Datensatz konnte nicht gelesen werden.")
+        else:
+            select_precomputed_stages(df_to_analyze)
+            st.session_state.last_analyzed_dataframe = df_to_analyze
+            st.subheader("Vorschau des gespeicherten Datensatzes:")
+            st.dataframe(df_to_analyze.head())
+            with st.expander("Ganze Tabelle anzeigen/ausblenden"):
+                st.dataframe(df_to_analyze)
+    elif uploaded_file is not None:
         if st.session_state.last_analyzed_filename != uploaded_file.name:
             st.session_state.analysis_results = None
             st.session_state.last_analyzed_dataframe = None
+            st.session_state.streamed_stages = None
+            st.session_state.content_hash = None
             st.session_state.selected_follow_up_question = None
             st.session_state.current_follow_up_question_for_saving = None
             st.info("Neue Datei erkannt. Analysekontext wurde zurückgesetzt.")
         st.session_state.last_analyzed_filename = uploaded_file.name
-        file_extension = uploaded_file.name.split('.')[-1].lower()
+        file_extension = get_file_extension(uploaded_file.name)
         try:
-            if file_extension == "xlsx":
-                df_to_analyze = pd.read_excel(uploaded_file)
-            elif file_extension == "csv":
-                sample = uploaded_file.read(2048).decode("utf-8")
-                uploaded_file.seek(0)
-                dialect = csv.Sniffer().sniff(sample)
-                df_to_analyze = pd.read_csv(uploaded_file, sep=dialect.delimiter)
+            if file_extension == "csv" and uploaded_file.size > CSV_STREAMING_THRESHOLD_MB * 1024 * 1024:
+                # Direkt aus dem Dateiobjekt lesen, ohne den Inhalt vorher als Bytes zu kopieren
+                st.session_state.content_hash = compute_stream_content_hash(uploaded_file)
+                snapshot = lookup_analysis_snapshot(st.session_state.content_hash)
+                if snapshot:
+                    # Bereits analysierter Dateiinhalt: gespeicherte Stufenergebnisse statt erneutem Streaming
+                    st.session_state.streamed_stages = {**snapshot, "preview": read_csv_preview(uploaded_file)}
+                    st.info("Analyse-Snapshot dieser Datei aus MongoDB geladen. Die Vorschau zeigt nur die ersten Zeilen.")
+                else:
+                    # Sehr große CSV-Dateien werden chunkweise gelesen; es bleibt nur eine Vorschau im Speicher
+                    st.session_state.streamed_stages = analyze_csv_stream_in_chunks(
+                        uploaded_file, st.session_state.content_hash, n=TOP_N_ANOMALIES
+                    )
+                    st.info(
+                        f"Große CSV-Datei (> {CSV_STREAMING_THRESHOLD_MB} MB) wurde im Streaming-Modus verarbeitet. "
+                        "Die Vorschau zeigt nur die ersten Zeilen."
+                    )
+                df_to_analyze = st.session_state.streamed_stages["preview"]
+            elif file_extension in SUPPORTED_TABULAR_EXTENSIONS:
+                # Geparste Daten werden über den Inhalts-Hash gecached, damit Reruns nicht neu parsen
+                df_to_analyze = load_tabular_file(uploaded_file.getvalue(), uploaded_file.name)
+                select_precomputed_stages(df_to_analyze)
             elif file_extension == "txt":
                 additional_context_from_txt_main_upload = uploaded_file.read().decode("utf-8")
                 st.success("Textdatei (als Hauptdatei) erfolgreich hochgeladen!")
@@ -133,6 +303,13 @@ with col1:
 
         if df_to_analyze is not None:
             st.session_state.last_analyzed_dataframe = df_to_analyze
+            schema_report = df_to_analyze.attrs.get("schema_report")
+            if schema_report:
+                st.caption(
+                    f"Spaltentypen beim Laden verdichtet: {schema_report['memory_before_bytes'] / 1024**2:.1f} MB → "
+                    f"{schema_report['memory_after_bytes'] / 1024**2:.1f} MB "
+                    f"({len(schema_report['converted_columns'])} Spalten umgewandelt)."
+                )
             st.subheader("Vorschau der hochgeladenen Daten:")
             st.dataframe(df_to_analyze.head())
             with st.expander("Ganze Tabelle anzeigen/ausblenden"):
@@ -173,16 +350,63 @@ with col1:
                         openai_client,
                         client_to_pass_main,
                         final_additional_context,
-                        st.session_state.last_analyzed_filename
+                        st.session_state.last_analyzed_filename,
+                        precomputed_stages=st.session_state.streamed_stages,
+                        on_insight=make_live_insight_renderer(col2),
+                        content_hash=st.session_state.content_hash,
+                        snapshot_client=mongo_client
                     )
                 st.rerun()
 
+    if openai_client is not None:
+        st.markdown("---")
+        # Mehrere Kunden- oder Zeitraumdateien in einem gemeinsamen Durchlauf und einer LLM-Anfrage vergleichen
+        with st.expander("📑 Mehrere Dateien vergleichen"):
+            comparison_files = st.file_uploader(
+                "Wählen Sie mindestens zwei Excel- oder CSV-Dateien aus",
+                type=list(SUPPORTED_TABULAR_EXTENSIONS),
+                accept_multiple_files=True,
+                key="comparison_uploader",
+                help="Die erste Datei dient als Referenz; alle weiteren werden mit ihr verglichen."
+            )
+            if st.button("🔀 Vergleichsanalyse starten", disabled=len(comparison_files or []) < 2):
+                comparison_frames = {}
+                try:
+                    for comparison_file in comparison_files:
+                        # Gleichnamige Dateien (z.B. aus verschiedenen Ordnern) erhalten einen Zähler, statt sich zu überschreiben
+                        source_name, suffix = comparison_file.name, 2
+                        while source_name in comparison_frames:
+                            source_name, suffix = f"{comparison_file.name} ({suffix})", suffix + 1
+                        comparison_frames[source_name] = load_tabular_file(comparison_file.getvalue(), comparison_file.name)
+                except Exception as e:
+                    st.error(f"Fehler beim Lesen der Datei '{comparison_file.name}': {e}")
+                    comparison_frames = {}
+                if comparison_frames:
+                    st.session_state.analysis_results = None
+                    st.session_state.selected_follow_up_question = None
+                    st.session_state.current_follow_up_question_for_saving = None
+                    final_additional_context = st.session_state.prompt_text_area_content
+                    if additional_context_from_txt_main_upload:
+                        final_additional_context += "\n\n--- Kontext aus Haupt-TXT-Upload ---\n" + additional_context_from_txt_main_upload
+                    with st.spinner(f"Vergleiche {len(comparison_frames)} Dateien..."):
+                        st.session_state.analysis_results = perform_comparison_analysis(
+                            comparison_frames,
+                            openai_client,
+                            final_additional_context,
+                            on_insight=make_live_insight_renderer(col2)
+                        )
+                    st.rerun()
+
 with col2:
     st.subheader("✨ Analyse Ergebnisse:")
     if st.session_state.analysis_results is not None:
         results = st.session_state.analysis_results
         filename_for_saving = st.session_state.last_analyzed_filename
+        if results.get("is_comparison"):
+            filename_for_saving = " vs. ".join(results.get("compared_sources", {}))
 
+        if results.get("is_comparison"):
+            st.info(f"Vergleichsanalyse von {len(results.get('compared_sources', {}))} Dateien (Referenz: {results.get('comparison_reference')}).")
         if results.get("is_follow_up"):
             st.info(f"Dies sind die Ergebnisse der Folgeanalyse zur Frage: \"{results.get('answered_question')}\"")
         if "error" in results:
@@ -195,21 +419,8 @@ with col2:
             st.markdown("---")
             st.subheader("💡 Kern-Erkenntnisse")
             if "insights" in results and results["insights"]:
-                for i, insight in enumerate(results["insights"]):
-                    with st.expander(f"**{insight.get('title', 'Kein Titel')}** (Typ: {insight.get('type', 'Unbekannt')})"):
-                        st.write(f"**Beschreibung:** {insight.get('description', 'N/A')}")
-                        st.write(f"**Betroffener Bereich:** {insight.get('affected_area', 'N/A')}")
-                        st.write(f"**Zeitraum:** {insight.get('period', 'N/A')}")
-                        st.write(f"**Quantitativer Impact:** {insight.get('quantitative_impact', 'N/A')}")
-                        st.write(f"**Confidence Level:** {insight.get('confidence_level', 'N/A')}")
-                        if insight.get('supporting_data_points'):
-                            st.write("**Stützende Datenpunkte:**")
-                            for dp_idx, dp in enumerate(insight['supporting_data_points']):
-                                if isinstance(dp, dict): # Überprüfen, ob dp ein Dictionary ist
-                                    st.markdown(f"- **Referenz {dp_idx+1}:** {dp.get('row_reference', 'N/A')}, **Spalte:** {dp.get('column_reference', 'N/A')}, **Wert:** {dp.get('value', 'N/A')}, **Erklärung:** {dp.get('explanation', 'N/A')}")
-                                else:
-                                    # Gibt den tatsächlichen Inhalt von dp aus, wenn es kein Dictionary ist
-                                    st.markdown(f"- **Referenz {dp_idx+1} (Unerwartetes Format):** {str(dp)}")
+                for insight in results["insights"]:
+                    render_insight(insight)
             else:
                 st.info("Keine spezifischen Kern-Erkenntnisse gefunden oder vom LLM generiert.")
 
@@ -221,7 +432,14 @@ with col2:
             st.subheader("📝 Gesamt-Zusammenfassung")
             st.write(results.get("overall_summary", "N/A"))
 
-            if results.get("potential_next_questions"):
+            if results.get("comparison_deltas"):
+                with st.expander("Abweichungstabellen gegenüber der Referenz anzeigen"):
+                    for level, deltas_csv in results["comparison_deltas"].items():
+                        st.caption(level)
+                        st.dataframe(pd.read_csv(io.StringIO(deltas_csv)))
+
+            # Folgeanalysen beziehen sich auf eine einzelne Datei und stehen nach einem Vergleich nicht zur Verfügung
+            if results.get("potential_next_questions") and not results.get("is_comparison"):
                 st.markdown("---")
                 st.subheader("🔍 Folgeanalyse starten")
                 options_for_selectbox = ["Bitte wählen Sie eine Frage..."] + [str(q) for q in results["potential_next_questions"]]
@@ -261,7 +479,9 @@ with col2:
                                 final_additional_context,
                                 st.session_state.last_analyzed_filename,
                                 follow_up_question=st.session_state.selected_follow_up_question,
-                                previous_analysis_results=results
+                                previous_analysis_results=results,
+                                precomputed_stages=st.session_state.streamed_stages,
+                                on_insight=make_live_insight_renderer(st.container())
                             )
                         st.rerun()
                     else:
@@ -273,32 +493,34 @@ with col2:
                 if mongo_client is not None:
                     if st.button("💾 Ergebnisse in MongoDB speichern", help="Speichert die angezeigten Analyseergebnisse."):
                         if "insights" in results and isinstance(results["insights"], list) and results["insights"]:
-                            saved_count = 0
-                            error_count = 0
+                            analysis_timestamp = pd.Timestamp.now().isoformat()
+                            insights_to_save = []
                             for insight in results["insights"]:
                                 insight_to_save = insight.copy()
-                                insight_to_save["analysis_timestamp"] = pd.Timestamp.now().isoformat()
+                                insight_to_save["analysis_timestamp"] = analysis_timestamp
                                 insight_to_save["source_filename"] = filename_for_saving
                                 insight_to_save["is_follow_up_insight"] = results.get("is_follow_up", False)
+                                insight_to_save["prompt_version"] = results.get("prompt_versions", {}).get("combined")
                                 if results.get("is_follow_up"):
                                     answered_question = st.session_state.get("current_follow_up_question_for_saving")
                                     if not answered_question:
                                         answered_question = results.get("answered_question")
                                     if answered_question:
                                         insight_to_save["answered_question_for_insight"] = answered_question
-                                inserted_id = save_insight(mongo_client, insight_to_save)
-                                if inserted_id:
-                                    saved_count += 1
-                                else:
-                                    error_count += 1
-                            if saved_count > 0:
-                                st.success(f"{saved_count} Insight(s) erfolgreich in MongoDB gespeichert.")
-                            if error_count > 0:
-                                st.error(f"{error_count} Insight(s) konnten nicht gespeichert werden.")
-                            if saved_count == 0 and error_count == 0:
-                                st.info("Keine neuen Insights zum Speichern vorhanden in den aktuellen Ergebnissen.")
+                                insights_to_save.append(insight_to_save)
+                            # Ein insert_many im Hintergrund statt eines Round-Trips pro Insight
+                            insight_write_queue.submit(insights_to_save)
+                            st.success(f"{len(insights_to_save)} Insight(s) zum Speichern in MongoDB eingereiht.")
                         else:
                             st.warning("Keine Insights in den aktuellen Ergebnissen zum Speichern gefunden.")
+                    write_stats = insight_write_queue.stats()
+                    if write_stats["batches"] or write_stats["pending"]:
+                        st.caption(
+                            f"MongoDB-Speicherung: {write_stats['saved']} gespeichert, {write_stats['pending']} ausstehend, "
+                            f"{write_stats['failed']} fehlgeschlagen."
+                        )
+                    if write_stats["last_errors"]:
+                        st.error(f"Insight(s) konnten nicht gespeichert werden: {write_stats['last_errors'][-1]}")
                 else:
                     st.info("Keine aktive MongoDB-Verbindung. Speichern ist nicht möglich.")
                     st.caption("Bitte stelle sicher, dass MONGO_URI korrekt konfiguriert ist und die Datenbank erreichbar ist.")
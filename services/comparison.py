@@ -0,0 +1,123 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from services.utils import add_calculated_kpis_to_df, aggregate_finest_grain, rollup_grouping_sets, \
+                           KPI_RATIOS, GROUPING_SETS, KPI_SOURCE_COLUMNS, ANOMALY_TIME_COLUMN
+
+# Quellschlüssel (Dateiname) im zusammengeführten DataFrame
+SOURCE_COLUMN = "Source"
+# Jede Ebene aus GROUPING_SETS zusätzlich nach Quelle, plus Gesamtwerte je Quelle; alle Ebenen
+# werden aus einer einzigen feinsten Aggregation über alle Dateien abgeleitet
+COMPARISON_GROUPING_SETS = {
+    "by_source": [SOURCE_COLUMN],
+    **{key: [SOURCE_COLUMN] + dims for key, dims in GROUPING_SETS.items()},
+}
+# Kennzahlen der Delta-Tabellen: Volumen plus alle Quoten aus KPI_RATIOS
+COMPARISON_METRICS = ["total_gross_sales", "total_orders"] + [f"global_{name}" for name in KPI_RATIOS]
+# Zellen, deren Bruttoumsatz in keiner Quelle diesen Anteil am Umsatz der Quelle erreicht, gehen nicht in die
+# Delta-Tabellen ein (prozentuale Abweichungen kleiner Zellen sind meist Rauschen)
+COMPARISON_MIN_SALES_SHARE = float(os.getenv("COMPARISON_MIN_SALES_SHARE", "0.005"))
+REQUIRED_COMPARISON_COLUMNS = ["Date"] + list(dict.fromkeys(dim for dims in GROUPING_SETS.values() for dim in dims)) + KPI_SOURCE_COLUMNS
+
+
+def combine_sources(frames: dict) -> pd.DataFrame:
+    """
+    Fügt mehrere Datensätze (Quellname -> DataFrame) zu einem DataFrame mit Quellspalte zusammen.
+    Die Quelle ist kategorisch in Eingabereihenfolge, sodass Tabellen nach Quelle in dieser Reihenfolge erscheinen.
+    """
+    for name, df in frames.items():
+        missing = [col for col in REQUIRED_COMPARISON_COLUMNS if col not in df.columns]
+        if missing:
+            raise ValueError(f"Datei '{name}' fehlen Spalten für den Vergleich: {', '.join(missing)}")
+    combined = pd.concat(
+        [df.assign(**{SOURCE_COLUMN: name}) for name, df in frames.items()], ignore_index=True, join="outer"
+    )
+    combined[SOURCE_COLUMN] = pd.Categorical(combined[SOURCE_COLUMN], categories=list(frames))
+    return combined
+
+
+def describe_sources(df_with_kpis: pd.DataFrame) -> dict:
+    """
+    Kurzbeschreibung je Quelle (Zeilen, Zeitraum, Anzahl Länder und Zahlungsmethoden) für den Prompt.
+    """
+    months = df_with_kpis[ANOMALY_TIME_COLUMN].where(df_with_kpis[ANOMALY_TIME_COLUMN] != "NaT")
+    grouped = df_with_kpis.assign(**{ANOMALY_TIME_COLUMN: months}).groupby(SOURCE_COLUMN, observed=True, sort=True)
+    overview = grouped.agg(
+        rows=(SOURCE_COLUMN, "size"),
+        first_month=(ANOMALY_TIME_COLUMN, "min"),
+        last_month=(ANOMALY_TIME_COLUMN, "max"),
+        countries=("Country", "nunique"),
+        payment_methods=("Payment Method", "nunique"),
+    )
+    return {str(source): {key: (value if not pd.isna(value) else None) for key, value in row.items()}
+            for source, row in overview.to_dict(orient="index").items()}
+
+
+def build_delta_table(rolled: pd.DataFrame, dims: list, reference: str,
+                      min_sales_share: float = COMPARISON_MIN_SALES_SHARE) -> pd.DataFrame:
+    """
+    Vergleicht eine Aggregationsebene (Quelle × dims) jeder Quelle mit der Referenzquelle.
+    Ergebnis im Langformat: dims, metric, source, value, reference_value, delta, delta_pct (ohne Zeilen mit
+    delta 0) – absteigend nach dem Betrag der relativen Abweichung sortiert (Zellen ohne Referenzwert zuletzt),
+    sodass ein Kürzen der Tabelle die größten Abweichungen behält.
+    """
+    if dims and min_sales_share > 0:
+        source_totals = rolled.groupby(SOURCE_COLUMN, observed=True)["total_gross_sales"].transform("sum")
+        share = pd.Series(
+            np.where(source_totals > 0, rolled["total_gross_sales"] / source_totals.where(source_totals > 0), 0.0),
+            index=rolled.index,
+        )
+        relevant = share.groupby([rolled[dim] for dim in dims], observed=True, dropna=False).transform("max") >= min_sales_share
+        rolled = rolled[relevant]
+
+    long = rolled.melt(id_vars=[SOURCE_COLUMN] + dims, value_vars=COMPARISON_METRICS, var_name="metric", value_name="value")
+    wide = long.pivot_table(index=dims + ["metric"], columns=SOURCE_COLUMN, values="value", observed=True, sort=False, dropna=False)
+    if reference not in wide.columns:
+        return pd.DataFrame(columns=dims + ["metric", "source", "value", "reference_value", "delta", "delta_pct"])
+
+    tables = []
+    for source in wide.columns:
+        if source == reference:
+            continue
+        values, reference_values = wide[source].to_numpy(dtype="float64"), wide[reference].to_numpy(dtype="float64")
+        delta = values - reference_values
+        delta_pct = np.full(len(delta), np.nan)
+        np.divide(delta, np.abs(reference_values), out=delta_pct, where=~np.isnan(reference_values) & (reference_values != 0))
+        table = wide.index.to_frame(index=False)
+        table["source"] = source
+        table["value"] = np.round(values, 4)
+        table["reference_value"] = np.round(reference_values, 4)
+        table["delta"] = np.round(delta, 4)
+        table["delta_pct"] = np.round(delta_pct, 4)
+        tables.append(table)
+    if not tables:
+        return pd.DataFrame(columns=dims + ["metric", "source", "value", "reference_value", "delta", "delta_pct"])
+    deltas = pd.concat(tables, ignore_index=True)
+    # Unveränderte Kennzahlen tragen keine Information und werden ausgelassen
+    deltas = deltas[(deltas["value"].notna() | deltas["reference_value"].notna()) & (deltas["delta"] != 0)]
+    order = np.argsort(-np.nan_to_num(deltas["delta_pct"].abs().to_numpy(), nan=-1.0), kind="stable")
+    return deltas.iloc[order].reset_index(drop=True)
+
+
+def compute_comparison_stages(frames: dict) -> dict:
+    """
+    Berechnet KPIs und Rollups aller Dateien in einem vektorisierten Durchlauf über den zusammengeführten
+    DataFrame (Quellspalte als zusätzliche Dimension) und leitet daraus Delta-Tabellen gegenüber der ersten
+    Datei (Referenz) ab. Gibt {"reference", "sources", "rollups", "deltas"} zurück (Tabellen als CSV).
+    """
+    reference = next(iter(frames))
+    df_with_kpis = add_calculated_kpis_to_df(combine_sources(frames))
+    finest_agg = aggregate_finest_grain(df_with_kpis, grouping_sets=COMPARISON_GROUPING_SETS)
+    rollups = rollup_grouping_sets(finest_agg, grouping_sets=COMPARISON_GROUPING_SETS)
+    deltas = {
+        key: build_delta_table(rollups[key], [dim for dim in dims if dim != SOURCE_COLUMN], reference)
+        for key, dims in COMPARISON_GROUPING_SETS.items()
+    }
+    return {
+        "reference": reference,
+        "sources": describe_sources(df_with_kpis),
+        "rollups": {key: rolled.to_csv(index=False) for key, rolled in rollups.items()},
+        "deltas": {key: table.to_csv(index=False) for key, table in deltas.items()},
+    }
@@ -0,0 +1,200 @@
+import json
+import os
+import shutil
+import time
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    from pyarrow import fs
+except ImportError:  # optional; ohne pyarrow werden geparste Dateien nicht auf der Platte abgelegt
+    pa = None
+
+# Anzahl Datensätze, die maximal im Spaltenspeicher auf der Platte vorgehalten werden
+DATASET_STORE_MAX_ENTRIES = int(os.getenv("DATASET_STORE_MAX_ENTRIES", "32"))
+DATASET_STORE_DIR = os.getenv(
+    "DATASET_STORE_DIR",
+    os.path.join(os.path.dirname(__file__), '../.cache/datasets')
+)
+
+# Partitionierung auf der Platte (Hive-Stil: partition_month=2024-06/Country=DE/part-0.parquet)
+PARTITION_MONTH_COLUMN = "partition_month"
+PARTITION_COUNTRY_COLUMN = "Country"
+DATE_COLUMN = "Date"
+# Ursprüngliche Zeilenposition, damit Reihenfolge und Index nach dem Lesen wiederhergestellt werden
+ROW_POSITION_COLUMN = "row_position"
+# Beginnt mit "_", damit die Dataset-Erkennung von pyarrow die Datei ignoriert
+METADATA_FILENAME = "_dataset.json"
+# Hochzählen, wenn sich Layout oder Metadaten ändern (ältere Datensätze werden dann ignoriert)
+DATASET_FORMAT_VERSION = "1"
+
+
+def store_available() -> bool:
+    return pa is not None
+
+
+def _dataset_dir(key: str) -> str:
+    return os.path.join(DATASET_STORE_DIR, key)
+
+
+def _read_metadata(key: str):
+    path = os.path.join(_dataset_dir(key), METADATA_FILENAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warnung: Metadaten des Datensatzes {key} konnten nicht gelesen werden: {e}")
+        return None
+    return metadata if metadata.get("format_version") == DATASET_FORMAT_VERSION else None
+
+
+def _partition_columns(df: pd.DataFrame) -> list:
+    columns = []
+    if DATE_COLUMN in df.columns and pd.api.types.is_datetime64_any_dtype(df[DATE_COLUMN]):
+        columns.append(PARTITION_MONTH_COLUMN)
+    if PARTITION_COUNTRY_COLUMN in df.columns:
+        columns.append(PARTITION_COUNTRY_COLUMN)
+    return columns
+
+
+def _partitioning(partition_columns: list):
+    if not partition_columns:
+        return None
+    return ds.partitioning(pa.schema([(col, pa.string()) for col in partition_columns]), flavor="hive")
+
+
+def write_partitioned_dataset(key: str, df: pd.DataFrame, filename: str = None) -> bool:
+    """
+    Schreibt einen normalisierten DataFrame als Parquet-Dataset, partitioniert nach Monat (aus Date)
+    und Land. Spaltentypen, Spaltenreihenfolge und df.attrs landen in den Metadaten. Fehler sind
+    unkritisch, da nur der Speicher betroffen ist; gibt zurück, ob der Datensatz geschrieben wurde.
+    """
+    if pa is None:
+        return False
+    path = _dataset_dir(key)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    partition_columns = _partition_columns(df)
+    try:
+        extra = {ROW_POSITION_COLUMN: range(len(df))}
+        if PARTITION_MONTH_COLUMN in partition_columns:
+            extra[PARTITION_MONTH_COLUMN] = df[DATE_COLUMN].dt.strftime("%Y-%m")
+        table = pa.Table.from_pandas(df.assign(**extra), preserve_index=False)
+        for col in partition_columns:
+            table = table.set_column(table.schema.get_field_index(col), col, table[col].cast(pa.string()))
+        ds.write_dataset(
+            table, tmp_path, format="parquet", partitioning=_partitioning(partition_columns),
+            max_partitions=100000, existing_data_behavior="delete_matching",
+        )
+        metadata = {
+            "format_version": DATASET_FORMAT_VERSION,
+            "filename": filename,
+            "num_rows": len(df),
+            "columns": [str(col) for col in df.columns],
+            "dtypes": {str(col): str(dtype) for col, dtype in df.dtypes.items()},
+            "partition_columns": partition_columns,
+            "months": sorted(extra[PARTITION_MONTH_COLUMN].dropna().unique().tolist()) if PARTITION_MONTH_COLUMN in extra else [],
+            "attrs": dict(df.attrs),
+            "stored_at": pd.Timestamp.now().isoformat(),
+        }
+        with open(os.path.join(tmp_path, METADATA_FILENAME), "w", encoding="utf-8") as f:
+            json.dump(metadata, f, ensure_ascii=False, default=str)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"Warnung: Datensatz konnte nicht im Parquet-Speicher abgelegt werden: {e}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return False
+    prune_dataset_store()
+    return True
+
+
+def read_partitioned_dataset(key: str, months: list = None, countries: list = None, columns: list = None):
+    """
+    Liest einen gespeicherten Datensatz memory-mapped über Arrow. Filter auf Monate ("2024-06") und
+    Länder werden als Prädikat an das Dataset übergeben, sodass nur passende Partitionen gelesen werden;
+    `columns` beschränkt die gelesenen Spalten. Ohne Filter entspricht das Ergebnis dem geschriebenen
+    DataFrame, mit Filtern tragen die Zeilen ihre ursprüngliche Position als Index.
+    Gibt None zurück, wenn der Datensatz nicht (mehr) existiert.
+    """
+    metadata = _read_metadata(key) if pa is not None else None
+    if metadata is None:
+        return None
+    partition_columns = metadata["partition_columns"]
+    predicate = None
+    for values, col in ((months, PARTITION_MONTH_COLUMN), (countries, PARTITION_COUNTRY_COLUMN)):
+        if values is None:
+            continue
+        if col not in partition_columns:
+            print(f"Warnung: Datensatz {key} ist nicht nach {col} partitioniert; Filter wird ignoriert.")
+            continue
+        condition = pc.field(col).isin([str(value) for value in values])
+        predicate = condition if predicate is None else predicate & condition
+    selected = [col for col in (columns or metadata["columns"]) if col in metadata["columns"]]
+
+    try:
+        path = _dataset_dir(key)
+        dataset = ds.dataset(
+            path, format="parquet", partitioning=_partitioning(partition_columns),
+            filesystem=fs.LocalFileSystem(use_mmap=True),
+        )
+        table = dataset.to_table(columns=selected + [ROW_POSITION_COLUMN], filter=predicate)
+        df = table.sort_by(ROW_POSITION_COLUMN).to_pandas()
+        os.utime(os.path.join(path, METADATA_FILENAME))  # mtime dient als LRU-Zeitstempel für das Aufräumen
+    except Exception as e:
+        print(f"Warnung: Datensatz {key} konnte nicht aus dem Parquet-Speicher gelesen werden: {e}")
+        return None
+
+    for col in selected:
+        # Partitionsspalten kommen als Text zurück, Kategorien ggf. mit anderer Kategorienliste
+        if metadata["dtypes"][col] == "category" and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype("category")
+    if predicate is None and len(df) == metadata["num_rows"]:
+        df = df.drop(columns=ROW_POSITION_COLUMN)
+    else:
+        df = df.set_index(ROW_POSITION_COLUMN)
+        df.index.name = None
+    df = df[selected]
+    df.attrs.update(metadata.get("attrs", {}))
+    return df
+
+
+def list_stored_datasets() -> list:
+    """
+    Gibt die Metadaten aller gespeicherten Datensätze (mit "key"), zuletzt genutzte zuerst, zurück.
+    """
+    if not os.path.isdir(DATASET_STORE_DIR):
+        return []
+    datasets = []
+    for key in os.listdir(DATASET_STORE_DIR):
+        metadata = _read_metadata(key)
+        if metadata is not None:
+            metadata["key"] = key
+            metadata["last_used"] = os.path.getmtime(os.path.join(_dataset_dir(key), METADATA_FILENAME))
+            datasets.append(metadata)
+    return sorted(datasets, key=lambda metadata: metadata["last_used"], reverse=True)
+
+
+def prune_dataset_store(max_entries: int = None):
+    max_entries = DATASET_STORE_MAX_ENTRIES if max_entries is None else max_entries
+    try:
+        keys = [key for key in os.listdir(DATASET_STORE_DIR) if os.path.isdir(_dataset_dir(key))]
+        # Verwaiste temporäre Verzeichnisse abgebrochener Schreibvorgänge (älter als eine Stunde)
+        for key in [key for key in keys if key.endswith(".tmp")]:
+            if time.time() - os.path.getmtime(_dataset_dir(key)) > 3600:
+                shutil.rmtree(_dataset_dir(key), ignore_errors=True)
+        keys = [key for key in keys if not key.endswith(".tmp")]
+
+        def last_used(key):
+            path = os.path.join(_dataset_dir(key), METADATA_FILENAME)
+            return os.path.getmtime(path) if os.path.exists(path) else 0.0
+
+        for key in sorted(keys, key=last_used, reverse=True)[max_entries:]:
+            shutil.rmtree(_dataset_dir(key), ignore_errors=True)
+    except OSError as e:
+        print(f"Warnung: Parquet-Speicher konnte nicht aufgeräumt werden: {e}")
@@ -1,83 +1,270 @@
 import os
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure, OperationFailure
+import queue
+import threading
+from pymongo import ASCENDING, DESCENDING, MongoClient
+from pymongo.errors import BulkWriteError, ConnectionFailure, OperationFailure
 import pandas as pd
 import certifi
-import streamlit as st
 
-def get_mongo_client(mongo_uri: str, db_name: str):
+from services.embeddings import embed_insight, InsightVectorIndex
+
+# Maximale Anzahl Insights pro insert_many der Schreibwarteschlange
+INSIGHT_WRITE_BATCH_SIZE = int(os.getenv("INSIGHT_WRITE_BATCH_SIZE", "500"))
+
+# Felder der Insights, die als historischer Kontext in die Prompts einfließen (Projektion bei Abfragen)
+HISTORICAL_INSIGHT_FIELDS = [
+    "insight_id", "title", "type", "description", "affected_area", "period", "quantitative_impact", "confidence_level",
+]
+# Collection-Umgebungsvariable -> (Standardname, Indizes als (Schlüssel, Name[, Optionen]))
+COLLECTION_INDEXES = {
+    "MONGO_COLLECTION_INSIGHTS": ("insights", [
+        ([("analysis_timestamp", DESCENDING)], "analysis_timestamp_desc"),
+        ([("source_filename", ASCENDING), ("analysis_timestamp", DESCENDING)], "source_filename_timestamp"),
+        ([("type", ASCENDING)], "type"),
+        ([("affected_area", ASCENDING)], "affected_area"),
+        ([("countries", ASCENDING), ("analysis_timestamp", DESCENDING)], "countries_timestamp"),
+        ([("payment_methods", ASCENDING), ("analysis_timestamp", DESCENDING)], "payment_methods_timestamp"),
+    ]),
+    "MONGO_COLLECTION_RAW_DATA": ("raw_data_summaries", [
+        ([("filename", ASCENDING), ("timestamp", DESCENDING)], "filename_timestamp"),
+        # Ein Snapshot pro Dateiinhalt und Pipeline-Version; ältere Dokumente ohne Hash sind ausgenommen
+        ([("content_hash", ASCENDING), ("pipeline_version", ASCENDING)], "content_hash_pipeline_version",
+         {"unique": True, "partialFilterExpression": {"content_hash": {"$exists": True}}}),
+    ]),
+}
+
+# (Client, Umgebungsvariable) -> Collection; wird beim ersten Zugriff aufgelöst (nach load_dotenv in main.py)
+_collections = {}
+_collections_lock = threading.Lock()
+# Client -> Vektorindex der gespeicherten Insights (für get_similar_insights)
+_vector_indexes = {}
+
+def get_mongo_client(mongo_uri: str, db_name: str, reporter=None):
     """
-    Initialisiert und gibt einen MongoDB-Client zurück.
+    Initialisiert und gibt einen MongoDB-Client zurück (None bei fehlender MONGO_URI oder Verbindungsfehler).
+    Meldungen gehen an `reporter` (z.B. ConsoleReporter im Batch-Lauf), ohne Reporter an Streamlit.
     """
+    if reporter is None:
+        # Erst hier importiert, damit der Batch-Lauf ohne Streamlit auskommt
+        import streamlit as st
+        reporter = st
     if not mongo_uri:
-        st.error("MONGO_URI nicht in Umgebungsvariablen gefunden. Datenbankverbindung nicht möglich.")
+        reporter.error("MONGO_URI nicht in Umgebungsvariablen gefunden. Datenbankverbindung nicht möglich.")
         return None
     try:
         client = MongoClient(mongo_uri, tlsCAFile=certifi.where())
         client.admin.command('ping')
-        st.success("✅ MongoDB Client erfolgreich initialisiert und verbunden!")
+        reporter.success("✅ MongoDB Client erfolgreich initialisiert und verbunden!")
         return client
     except ConnectionFailure as e:
-        st.error(f"❌ MongoDB Verbindungsfehler: {e}. Bitte überprüfe die MONGO_URI und IP-Whitelist.")
+        reporter.error(f"❌ MongoDB Verbindungsfehler: {e}. Bitte überprüfe die MONGO_URI und IP-Whitelist.")
         return None
     except OperationFailure as e:
-        st.error(f"❌ MongoDB Authentifizierungs-/Operationsfehler: {e}. Bitte überprüfe Benutzername und Passwort in der MONGO_URI.")
+        reporter.error(f"❌ MongoDB Authentifizierungs-/Operationsfehler: {e}. Bitte überprüfe Benutzername und Passwort in der MONGO_URI.")
         return None
     except Exception as e:
+        reporter.error(f"❌ MongoDB Client konnte nicht initialisiert werden: {e}")
         return None
 
+def _get_collection(mongo_client: MongoClient, collection_env: str, default_name: str):
+    """
+    Gibt die Collection zurück, deren Name in `collection_env` steht. Datenbank- und Collection-Namen
+    werden nur beim ersten Zugriff pro Client aus den Umgebungsvariablen gelesen.
+    """
+    key = (id(mongo_client), collection_env)
+    with _collections_lock:
+        if key not in _collections:
+            db_name = os.getenv("MONGO_DB_NAME", "attention_guiding_db")
+            _collections[key] = mongo_client[db_name][os.getenv(collection_env, default_name)]
+        return _collections[key]
+
+def ensure_indexes(mongo_client: MongoClient) -> list:
+    """
+    Legt die Indizes aus COLLECTION_INDEXES an (idempotent; bestehende Indizes bleiben unverändert).
+    Gibt die Namen der sichergestellten Indizes zurück.
+    """
+    ensured = []
+    if not mongo_client:
+        return ensured
+    for collection_env, (default_name, indexes) in COLLECTION_INDEXES.items():
+        collection = _get_collection(mongo_client, collection_env, default_name)
+        for keys, name, *options in indexes:
+            try:
+                ensured.append(collection.create_index(keys, name=name, **(options[0] if options else {})))
+            except Exception as e:
+                print(f"Warnung: Index {name} konnte nicht angelegt werden: {e}")
+    return ensured
+
 def save_insight(mongo_client: MongoClient, insight_data: dict):
     """
     Speichert ein Insight-Dokument in der MongoDB.
     """
     if mongo_client:
         try:
-            db_name = os.getenv("MONGO_DB_NAME", "attention_guiding_db")
-            collection_name = os.getenv("MONGO_COLLECTION_INSIGHTS", "insights")
-            db = mongo_client[db_name]
-            insights_collection = db[collection_name]
-            result = insights_collection.insert_one(insight_data)
+            insights_collection = _get_collection(mongo_client, "MONGO_COLLECTION_INSIGHTS", "insights")
+            result = insights_collection.insert_one({**insight_data, **embed_insight(insight_data)})
             return result.inserted_id
         except Exception:
             return None
     return None
 
-def get_similar_insights(mongo_client: MongoClient, query_text: str, limit: int = 5) -> list:
+def save_insights_bulk(mongo_client: MongoClient, insights: list) -> dict:
     """
-    Gibt die neuesten Insights aus der MongoDB zurück.
+    Speichert mehrere Insight-Dokumente mit einem einzigen insert_many (ungeordnet: ein fehlerhaftes
+    Dokument hält die übrigen nicht auf). Gibt {"inserted_ids": [...], "errors": [{"index", "message"}]} zurück;
+    "index" bezieht sich auf die Position in `insights`.
+    """
+    report = {"inserted_ids": [], "errors": []}
+    if not insights:
+        return report
+    if not mongo_client:
+        report["errors"] = [{"index": index, "message": "Keine MongoDB-Verbindung"} for index in range(len(insights))]
+        return report
+    documents = [{**insight, **embed_insight(insight)} for insight in insights]
+    try:
+        result = _get_collection(mongo_client, "MONGO_COLLECTION_INSIGHTS", "insights").insert_many(documents, ordered=False)
+        report["inserted_ids"] = list(result.inserted_ids)
+    except BulkWriteError as e:
+        write_errors = e.details.get("writeErrors", [])
+        failed = {error["index"] for error in write_errors}
+        report["errors"] = [{"index": error["index"], "message": error.get("errmsg", "")} for error in write_errors]
+        report["inserted_ids"] = [doc["_id"] for index, doc in enumerate(documents) if index not in failed and "_id" in doc]
+    except Exception as e:
+        report["errors"] = [{"index": index, "message": str(e)} for index in range(len(documents))]
+    return report
+
+class InsightWriteQueue:
+    """
+    Write-behind-Warteschlange für Insights: submit() kehrt sofort zurück, ein Hintergrund-Thread
+    fasst alle bis dahin eingereihten Dokumente zu einem save_insights_bulk-Aufruf zusammen.
+    Zähler und letzte Fehler sind über stats() abrufbar (ohne st.*-Aufrufe im Thread).
+    """
+
+    def __init__(self, mongo_client: MongoClient, batch_size: int = None):
+        self.mongo_client = mongo_client
+        self.batch_size = batch_size or INSIGHT_WRITE_BATCH_SIZE
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = {"pending": 0, "saved": 0, "failed": 0, "batches": 0, "last_errors": []}
+        self._worker = threading.Thread(target=self._run, name="insight-writer", daemon=True)
+        self._worker.start()
+
+    def submit(self, insights: list):
+        with self._lock:
+            self._stats["pending"] += len(insights)
+        for insight in insights:
+            self._queue.put(insight)
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Wartet, bis alle eingereihten Insights geschrieben sind. Gibt False zurück, wenn `timeout` abläuft.
+        """
+        done = threading.Event()
+        threading.Thread(target=lambda: (self._queue.join(), done.set()), daemon=True).start()
+        return done.wait(timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "last_errors": list(self._stats["last_errors"])}
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            report = save_insights_bulk(self.mongo_client, batch)
+            with self._lock:
+                self._stats["pending"] -= len(batch)
+                self._stats["saved"] += len(report["inserted_ids"])
+                self._stats["failed"] += len(report["errors"])
+                self._stats["batches"] += 1
+                self._stats["last_errors"] = (self._stats["last_errors"] + [e["message"] for e in report["errors"]])[-5:]
+            for _ in batch:
+                self._queue.task_done()
+
+def _get_vector_index(mongo_client: MongoClient) -> InsightVectorIndex:
+    with _collections_lock:
+        index = _vector_indexes.get(id(mongo_client))
+    if index is None:
+        index = InsightVectorIndex(_get_collection(mongo_client, "MONGO_COLLECTION_INSIGHTS", "insights"))
+        with _collections_lock:
+            index = _vector_indexes.setdefault(id(mongo_client), index)
+    return index
+
+def get_similar_insights(mongo_client: MongoClient, query_text: str, limit: int = 5,
+                         countries: list = None, payment_methods: list = None) -> list:
+    """
+    Gibt die `limit` Insights zurück, die `query_text` am ähnlichsten sind (Kosinus-Ähnlichkeit der
+    Hashing-Embeddings, Feld "similarity"). Ohne Abfragetext oder ohne Treffer: die neuesten Insights.
+    Mit countries/payment_methods werden nur Insights zu mindestens einem dieser Länder bzw. einer dieser
+    Zahlungsmethoden berücksichtigt (indexgestützt über die Array-Felder); ältere Insights ohne diese Felder
+    bleiben dabei Kandidaten. Es werden nur die Felder aus HISTORICAL_INSIGHT_FIELDS übertragen.
     """
     if mongo_client:
         try:
-            db_name = os.getenv("MONGO_DB_NAME", "attention_guiding_db")
-            collection_name = os.getenv("MONGO_COLLECTION_INSIGHTS", "insights")
-            db = mongo_client[db_name]
-            insights_collection = db[collection_name]
-            latest_insights = list(insights_collection.find().sort([('analysis_timestamp', -1)]).limit(limit))
-            for insight in latest_insights:
+            insights_collection = _get_collection(mongo_client, "MONGO_COLLECTION_INSIGHTS", "insights")
+            projection = {field: 1 for field in HISTORICAL_INSIGHT_FIELDS}
+            filters = {"countries": countries, "payment_methods": payment_methods}
+            # {"$in": [..., None]} trifft auch Dokumente, denen das Feld fehlt
+            conditions = [{field: {"$in": list(values) + [None]}} for field, values in filters.items() if values]
+            query_filter = {"$or": conditions} if conditions else {}
+            matches = []
+            if query_text:
+                matches = _get_vector_index(mongo_client).search(query_text, limit, filters)
+            if matches:
+                scores = dict(matches)
+                found = {doc["_id"]: doc for doc in insights_collection.find({"_id": {"$in": list(scores)}}, projection)}
+                similar_insights = [{**found[_id], "similarity": round(score, 4)} for _id, score in matches if _id in found]
+                # Inzwischen gelöschte Insights nicht erneut vorschlagen
+                _get_vector_index(mongo_client).remove([_id for _id in scores if _id not in found])
+            else:
+                similar_insights = list(insights_collection.find(query_filter, projection).sort([('analysis_timestamp', -1)]).limit(limit))
+            for insight in similar_insights:
                 if '_id' in insight:
                     insight['_id'] = str(insight['_id'])
-            return latest_insights
-        except Exception:
+            return similar_insights
+        except Exception as e:
+            print(f"Warnung: Ähnliche Insights konnten nicht abgefragt werden: {e}")
             return []
     return []
 
-def save_raw_data_summary(mongo_client: MongoClient, filename: str, summary_data: dict):
+def save_raw_data_summary(mongo_client: MongoClient, filename: str, summary_data: dict,
+                          content_hash: str = None, pipeline_version: str = None):
     """
-    Speichert eine Zusammenfassung der Rohdaten in der MongoDB.
+    Speichert eine Zusammenfassung der Rohdaten in der MongoDB. Mit content_hash wird sie als Snapshot
+    für diesen Dateiinhalt und diese Pipeline-Version gespeichert (ein bestehender Snapshot wird ersetzt).
     """
     if mongo_client:
         try:
-            db_name = os.getenv("MONGO_DB_NAME", "attention_guiding_db")
-            collection_name = os.getenv("MONGO_COLLECTION_RAW_DATA", "raw_data_summaries")
-            db = mongo_client[db_name]
-            raw_data_collection = db[collection_name]
+            raw_data_collection = _get_collection(mongo_client, "MONGO_COLLECTION_RAW_DATA", "raw_data_summaries")
             doc_to_insert = {
                 "filename": filename,
                 "timestamp": pd.Timestamp.now().isoformat(),
                 "summary": summary_data
             }
+            if content_hash:
+                key = {"content_hash": content_hash, "pipeline_version": pipeline_version}
+                raw_data_collection.replace_one(key, {**doc_to_insert, **key}, upsert=True)
+                return content_hash
             result = raw_data_collection.insert_one(doc_to_insert)
             return result.inserted_id
-        except Exception:
+        except Exception as e:
+            print(f"Warnung: Zusammenfassung der Rohdaten konnte nicht gespeichert werden: {e}")
             return None
-    return None
\ No newline at end of file
+    return None
+
+def get_raw_data_snapshot(mongo_client: MongoClient, content_hash: str, pipeline_version: str):
+    """
+    Gibt den Snapshot für Dateiinhalt und Pipeline-Version zurück oder None.
+    """
+    if mongo_client and content_hash:
+        try:
+            raw_data_collection = _get_collection(mongo_client, "MONGO_COLLECTION_RAW_DATA", "raw_data_summaries")
+            return raw_data_collection.find_one({"content_hash": content_hash, "pipeline_version": pipeline_version}, {"_id": 0})
+        except Exception as e:
+            print(f"Warnung: Snapshot konnte nicht geladen werden: {e}")
+            return None
+    return None
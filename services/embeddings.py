@@ -0,0 +1,224 @@
+import math
+import os
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+
+# Dimension der Hashing-Vektoren; alle gespeicherten Embeddings müssen dieselbe Dimension haben
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "256"))
+# Wird mit jedem Insight gespeichert; Embeddings anderer Versionen werden beim Laden neu berechnet
+EMBEDDING_VERSION = f"hash-v1-{EMBEDDING_DIM}"
+# Mindestabstand (Sekunden) zwischen zwei inkrementellen Aktualisierungen des Index aus MongoDB
+VECTOR_INDEX_REFRESH_SECONDS = float(os.getenv("VECTOR_INDEX_REFRESH_SECONDS", "10"))
+# Mindestabstand (Sekunden) zwischen zwei vollständigen Neuladungen im Hintergrund
+VECTOR_INDEX_FULL_RELOAD_SECONDS = float(os.getenv("VECTOR_INDEX_FULL_RELOAD_SECONDS", "300"))
+# Textfelder eines Insights, aus denen das Embedding berechnet wird
+INSIGHT_TEXT_FIELDS = ["title", "type", "description", "affected_area", "period"]
+# Array-Felder, nach denen der Index filtern kann (Insights ohne das Feld passen zu jedem Filter darauf)
+INSIGHT_FILTER_FIELDS = ["countries", "payment_methods"]
+
+_TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def _hash_features(text: str):
+    tokens = _TOKEN_PATTERN.findall(str(text or "").lower())
+    features = tokens + [f"{left} {right}" for left, right in zip(tokens, tokens[1:])]
+    counts = {}
+    for feature in features:
+        # crc32 ist (anders als hash()) prozessübergreifend stabil
+        hashed = zlib.crc32(feature.encode("utf-8"))
+        bucket, sign = hashed % EMBEDDING_DIM, 1.0 if (hashed >> 31) & 1 else -1.0
+        counts[bucket] = counts.get(bucket, 0.0) + sign
+    return counts
+
+
+def embed_text(text: str) -> np.ndarray:
+    """
+    Berechnet offline ein Hashing-Embedding (Wörter und Wort-Bigramme, sublineare Gewichtung,
+    L2-normiert), sodass das Skalarprodukt zweier Embeddings ihrer Kosinus-Ähnlichkeit entspricht.
+    """
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    for bucket, count in _hash_features(text).items():
+        vector[bucket] = math.copysign(1.0 + math.log(abs(count)), count) if count else 0.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def insight_text(insight: dict) -> str:
+    return " ".join(str(insight.get(field) or "") for field in INSIGHT_TEXT_FIELDS)
+
+
+def embed_insight(insight: dict) -> dict:
+    """
+    Gibt die Felder zurück, die mit einem Insight gespeichert werden ("embedding" als float32-Bytes).
+    """
+    return {"embedding": embed_text(insight_text(insight)).tobytes(), "embedding_version": EMBEDDING_VERSION}
+
+
+class InsightVectorIndex:
+    """
+    In-Process-Index über die Embeddings aller gespeicherten Insights (Brute-Force-Kosinus mit NumPy).
+    Beim ersten Zugriff werden alle Embeddings geladen, danach nur Dokumente mit größerer _id
+    (inkrementell, höchstens alle VECTOR_INDEX_REFRESH_SECONDS). Alle VECTOR_INDEX_FULL_RELOAD_SECONDS
+    wird der Index in einem Hintergrund-Thread neu aufgebaut und anschließend ausgetauscht, sodass
+    search() nie auf ein vollständiges Neuladen wartet. Die Matrix wächst durch Verdopplung.
+    Für die Felder aus INSIGHT_FILTER_FIELDS wird je Wert eine boolesche Spalte gehalten (Wert None:
+    Insight ohne das Feld), sodass Filter als Maske ohne Rückfrage an MongoDB ausgewertet werden.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.vectors = np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+        self.ids = []
+        self.positions = {}
+        # Feld -> Wert -> Spalte bzw. Feld -> Matrix (Zeilen wie self.vectors, Spalten je Wert)
+        self.tag_columns = {field: {} for field in INSIGHT_FILTER_FIELDS}
+        self.tags = {field: np.zeros((0, 0), dtype=bool) for field in INSIGHT_FILTER_FIELDS}
+        self.last_id = None
+        self.last_refresh = 0.0
+        self.last_full_reload = time.monotonic()
+        self._reload_thread = None
+        self._lock = threading.Lock()
+
+    def _tag_rows(self, docs: list) -> dict:
+        """
+        Markiert die Werte der Filterfelder je Dokument; legt dabei fehlende Spalten an.
+        """
+        marks = {}
+        for field in INSIGHT_FILTER_FIELDS:
+            columns = self.tag_columns[field]
+            for row, doc in enumerate(docs):
+                values = doc.get(field)
+                for value in ([None] if values is None else values):
+                    marks.setdefault(field, []).append((row, columns.setdefault(value, len(columns))))
+        return marks
+
+    def _append(self, new_ids: list, new_vectors: list, new_docs: list):
+        size = len(self.ids)
+        needed = size + len(new_ids)
+        if needed > len(self.vectors):
+            grown = np.zeros((max(needed, 2 * len(self.vectors), 1024), EMBEDDING_DIM), dtype=np.float32)
+            grown[:size] = self.vectors[:size]
+            self.vectors = grown
+        self.vectors[size:needed] = np.vstack(new_vectors)
+        marks = self._tag_rows(new_docs)
+        for field, tags in self.tags.items():
+            width = len(self.tag_columns[field])
+            if tags.shape[0] < len(self.vectors) or tags.shape[1] < width:
+                grown = np.zeros((len(self.vectors), max(width, 2 * tags.shape[1])), dtype=bool)
+                grown[:size, :tags.shape[1]] = tags[:size]
+                self.tags[field] = tags = grown
+            if marks.get(field):
+                rows, columns = np.array(marks[field]).T
+                tags[size + rows, columns] = True
+        self.positions.update((_id, size + offset) for offset, _id in enumerate(new_ids))
+        self.ids.extend(new_ids)
+
+    def _load(self, query: dict):
+        projection = {field: 1 for field in INSIGHT_TEXT_FIELDS + INSIGHT_FILTER_FIELDS + ["embedding", "embedding_version"]}
+        new_ids, new_vectors, new_docs = [], [], []
+        for doc in self.collection.find(query, projection).sort([("_id", 1)]):
+            if doc.get("embedding_version") == EMBEDDING_VERSION and doc.get("embedding"):
+                vector = np.frombuffer(doc["embedding"], dtype=np.float32)
+            else:
+                # Ältere Insights ohne (aktuelles) Embedding: beim Laden berechnen
+                vector = embed_text(insight_text(doc))
+            new_ids.append(doc["_id"])
+            new_vectors.append(vector)
+            new_docs.append(doc)
+        if new_ids:
+            self._append(new_ids, new_vectors, new_docs)
+            self.last_id = new_ids[-1]
+
+    def refresh(self, force: bool = False):
+        """
+        Lädt neue Insights (größere _id) nach; Aufruf unter self._lock.
+        """
+        now = time.monotonic()
+        if not force and now - self.last_refresh < VECTOR_INDEX_REFRESH_SECONDS:
+            return
+        self._load({"_id": {"$gt": self.last_id}} if self.last_id is not None else {})
+        self.last_refresh = now
+
+    def _reload(self):
+        # Neuer Index ohne Sperre aufbauen; Suchen laufen währenddessen auf dem bisherigen weiter
+        fresh = InsightVectorIndex(self.collection)
+        try:
+            fresh.refresh(force=True)
+        except Exception as e:
+            print(f"Warnung: Vektorindex konnte nicht neu geladen werden: {e}")
+            return
+        with self._lock:
+            self.vectors, self.ids, self.positions = fresh.vectors, fresh.ids, fresh.positions
+            self.tag_columns, self.tags = fresh.tag_columns, fresh.tags
+            self.last_id, self.last_refresh = fresh.last_id, fresh.last_refresh
+
+    def _schedule_reload(self, now: float):
+        """
+        Startet das vollständige Neuladen (erfasst gelöschte Insights und Dokumente mit kleinerer _id,
+        z.B. von anderen Clients eingefügt) im Hintergrund, höchstens eines gleichzeitig.
+        """
+        if now - self.last_full_reload < VECTOR_INDEX_FULL_RELOAD_SECONDS:
+            return
+        if self._reload_thread is not None and self._reload_thread.is_alive():
+            return
+        self.last_full_reload = now
+        self._reload_thread = threading.Thread(target=self._reload, name="vector-index-reload", daemon=True)
+        self._reload_thread.start()
+
+    def remove(self, removed_ids):
+        """
+        Entfernt Insights aus dem Index (z.B. in MongoDB gelöschte); die letzte Zeile rückt jeweils nach.
+        """
+        with self._lock:
+            for _id in removed_ids:
+                position = self.positions.pop(_id, None)
+                if position is None:
+                    continue
+                last = len(self.ids) - 1
+                if position != last:
+                    self.vectors[position] = self.vectors[last]
+                    for tags in self.tags.values():
+                        tags[position] = tags[last]
+                    self.ids[position] = self.ids[last]
+                    self.positions[self.ids[position]] = position
+                for tags in self.tags.values():
+                    tags[last] = False
+                self.ids.pop()
+
+    def _filter_mask(self, filters: dict) -> np.ndarray:
+        """
+        Maske der Zeilen, die mindestens einen der Filter erfüllen (Feld -> zulässige Werte, ODER-verknüpft);
+        Insights ohne das gefilterte Feld erfüllen den Filter immer.
+        """
+        mask = np.zeros(len(self.ids), dtype=bool)
+        for field, values in filters.items():
+            columns = [self.tag_columns[field][value] for value in [None, *values] if value in self.tag_columns[field]]
+            if columns:
+                mask |= self.tags[field][:len(self.ids), columns].any(axis=1)
+        return mask
+
+    def search(self, query_text: str, limit: int, filters: dict = None) -> list:
+        """
+        Gibt bis zu `limit` Paare (_id, ähnlichkeit) absteigend nach Kosinus-Ähnlichkeit zurück,
+        optional nur unter den Insights, die `filters` erfüllen (Feld aus INSIGHT_FILTER_FIELDS -> Werte).
+        """
+        query_vector = embed_text(query_text)
+        filters = {field: values for field, values in (filters or {}).items() if values}
+        with self._lock:
+            self.refresh()
+            self._schedule_reload(time.monotonic())
+            if filters:
+                rows = np.flatnonzero(self._filter_mask(filters))
+            else:
+                rows = np.arange(len(self.ids))
+            if len(rows) == 0 or not query_vector.any():
+                return []
+            scores = self.vectors[rows] @ query_vector if filters else self.vectors[:len(rows)] @ query_vector
+            limit = min(limit, len(rows))
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            return [(self.ids[rows[position]], float(scores[position])) for position in top]
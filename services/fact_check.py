@@ -0,0 +1,351 @@
+import math
+import re
+import time
+from decimal import Decimal
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+from services.utils import AGGREGATION_MEASURES, KPI_RATIOS, KPI_SOURCE_COLUMNS, aggregate_finest_grain, safe_divide
+
+# Dimensionen, über die zitierte Datenpunkte den Zeilen des angereicherten DataFrames zugeordnet werden
+FACT_CHECK_DIMENSIONS = ["Country", "Payment Method", "Normalized_Month_For_Analysis"]
+# Relative Toleranz beim Vergleich zitierter mit tatsächlichen Werten (zusätzlich zur Rundung des Zitats)
+FACT_CHECK_RELATIVE_TOLERANCE = 0.005
+
+_MONTH_NUMBERS = {
+    "jan": 1, "feb": 2, "mar": 3, "mär": 3, "mrz": 3, "apr": 4, "may": 5, "mai": 5, "jun": 6,
+    "jul": 7, "aug": 8, "sep": 9, "oct": 10, "okt": 10, "nov": 11, "dec": 12, "dez": 12,
+}
+_MULTIPLIERS = {"mio": 1e6, "mrd": 1e9, "tsd": 1e3, "k": 1e3}
+_NUMBER_PATTERN = re.compile(r"[-+−]?\d[\d.,']*")
+# Summen aller Quellspalten pro Zelle; daraus werden alle Rollups und Quoten des Index abgeleitet
+FACT_CHECK_CELL_GROUPING = {"cells": FACT_CHECK_DIMENSIONS}
+FACT_CHECK_MEASURES = {col: col for col in KPI_SOURCE_COLUMNS}
+
+
+def aggregate_fact_check_cells(df_with_kpis: pd.DataFrame) -> pd.DataFrame:
+    """
+    Summiert alle KPI-Quellspalten pro Zelle (Land × Zahlungsmethode × Monat). Das Ergebnis ist
+    mergebar und kann auch chunkweise (Streaming-Modus) aufgebaut werden.
+    """
+    return aggregate_finest_grain(df_with_kpis, grouping_sets=FACT_CHECK_CELL_GROUPING, measures=FACT_CHECK_MEASURES)
+
+
+def _dimension_pattern(values: list, case_sensitive: bool):
+    alternatives = "|".join(re.escape(value) for value in sorted(values, key=len, reverse=True))
+    return re.compile(rf"(?<![A-Za-z0-9])({alternatives})(?![A-Za-z0-9])", 0 if case_sensitive else re.IGNORECASE)
+
+
+def build_fact_check_index(cell_sums: pd.DataFrame) -> dict:
+    """
+    Baut den Nachschlage-Index für zitierte Datenpunkte aus den Zellsummen (aggregate_fact_check_cells).
+    Für jede Teilmenge der Dimensionen (Zelle, Land × Zahlungsmethode, nur Land, ..., Gesamt) wird
+    ein Dict Schlüssel -> Wertezeile (Summen plus alle Quoten aus KPI_RATIOS) vorberechnet, sodass
+    eine Prüfung nur noch aus Dict-Zugriffen besteht.
+    """
+    started = time.perf_counter()
+    measure_cols = list(FACT_CHECK_MEASURES)
+    metric_positions = {("sum", col): position for position, col in enumerate(measure_cols)}
+    for offset, ratio_name in enumerate(KPI_RATIOS):
+        metric_positions[("ratio", ratio_name)] = len(measure_cols) + offset
+    numerator_idx = [measure_cols.index(numerator) for numerator, _, _ in KPI_RATIOS.values()]
+    denominator_idx = [measure_cols.index(denominator) for _, denominator, _ in KPI_RATIOS.values()]
+
+    levels = {}
+    for size in range(len(FACT_CHECK_DIMENSIONS) + 1):
+        for dims in combinations(FACT_CHECK_DIMENSIONS, size):
+            if dims:
+                grouped = cell_sums.groupby(list(dims), observed=True, sort=False)[measure_cols].sum()
+                keys = [key if isinstance(key, tuple) else (key,) for key in grouped.index]
+                sums = grouped.to_numpy(dtype="float64")
+            else:
+                keys = [()]
+                sums = cell_sums[measure_cols].to_numpy(dtype="float64").sum(axis=0, keepdims=True)
+            values = np.hstack([sums, safe_divide(sums[:, numerator_idx], sums[:, denominator_idx])])
+            levels[dims] = {tuple(str(part) for part in key): row for key, row in zip(keys, values)}
+
+    known_values = {dim: [str(value) for value in cell_sums[dim].dropna().unique()] for dim in FACT_CHECK_DIMENSIONS}
+    return {
+        "levels": levels,
+        "metric_positions": metric_positions,
+        "numeric_columns": measure_cols,
+        "country_pattern": _dimension_pattern(known_values["Country"], case_sensitive=True),
+        "payment_method_pattern": _dimension_pattern(known_values["Payment Method"], case_sensitive=False),
+        "payment_methods": {value.lower(): value for value in known_values["Payment Method"]},
+        "build_ms": round((time.perf_counter() - started) * 1000, 2),
+    }
+
+
+def _parse_month(text: str):
+    match = re.search(r"\b(\d{4})-(\d{1,2})(?:-\d{1,2})?\b", text)
+    if match:
+        return f"{match.group(1)}-{int(match.group(2)):02d}"
+    match = re.search(r"\b\d{1,2}\.(\d{1,2})\.(\d{4})\b", text)
+    if match:
+        return f"{match.group(2)}-{int(match.group(1)):02d}"
+    match = re.search(r"\b(\d{4})\s+([A-Za-zÄä]{3})", text)
+    if match and match.group(2).lower() in _MONTH_NUMBERS:
+        return f"{match.group(1)}-{_MONTH_NUMBERS[match.group(2).lower()]:02d}"
+    match = re.search(r"\b([A-Za-zÄä]{3})[a-zä]*\.?\s+(\d{4})\b", text)
+    if match and match.group(1).lower() in _MONTH_NUMBERS:
+        return f"{match.group(2)}-{_MONTH_NUMBERS[match.group(1).lower()]:02d}"
+    return None
+
+
+def parse_row_reference(reference, index: dict):
+    """
+    Ermittelt Land, Zahlungsmethode und Monat aus einer frei formulierten Zeilenreferenz
+    (z.B. "Country 'ES', Payment Method 'PayPal', Date '01.03.2024'").
+    Gibt ein Dict Dimension -> Wert zurück oder None, wenn eine Dimension mehrdeutig ist.
+    """
+    text = str(reference or "")
+    dims = {}
+    countries = set(index["country_pattern"].findall(text))
+    payment_methods = {index["payment_methods"][match.lower()] for match in index["payment_method_pattern"].findall(text)}
+    if len(countries) > 1 or len(payment_methods) > 1:
+        return None
+    if countries:
+        dims["Country"] = countries.pop()
+    if payment_methods:
+        dims["Payment Method"] = payment_methods.pop()
+    month = _parse_month(text)
+    if month:
+        dims["Normalized_Month_For_Analysis"] = month
+    return dims
+
+
+def resolve_metric(column_reference, numeric_columns: list):
+    """
+    Ordnet eine zitierte Spalte einer Kennzahl zu: ("ratio", name) für global_/calculated_-Quoten aus
+    KPI_RATIOS, ("sum", quellspalte) für Summen (total_* oder numerische Originalspalten), sonst None.
+    """
+    text = str(column_reference or "").strip().strip("`'\"").strip()
+    lower = text.lower()
+    ratio_names = {f"{prefix}{name}": name for name in KPI_RATIOS for prefix in ("global_", "calculated_")}
+    sum_names = {output.lower(): source for output, source in AGGREGATION_MEASURES.items()}
+    sum_names.update({col.lower(): col for col in numeric_columns if not col.startswith("calculated_")})
+    if lower in ratio_names:
+        return ("ratio", ratio_names[lower])
+    if lower in sum_names:
+        return ("sum", sum_names[lower])
+    # Spaltenname eingebettet in längeren Text (z.B. "Spalte `EUR Returns` in Tabelle ...")
+    for name in sorted(list(ratio_names) + list(sum_names), key=len, reverse=True):
+        if re.search(rf"(?<![\w.]){re.escape(name)}(?![\w.])", lower):
+            return ("ratio", ratio_names[name]) if name in ratio_names else ("sum", sum_names[name])
+    return None
+
+
+def _number_candidates(token: str):
+    """
+    Liest eine Zahl im deutschen oder englischen Format. Mehrdeutige Schreibweisen (z.B. "1.234")
+    liefern beide Lesarten. Gibt Paare (wert, nachkommastellen) zurück.
+    """
+    token = token.replace("−", "-").replace("'", "").rstrip(".,")
+    if "," in token and "." in token:
+        decimal_sep = "," if token.rfind(",") > token.rfind(".") else "."
+        thousands_sep = "." if decimal_sep == "," else ","
+        normalized = token.replace(thousands_sep, "").replace(decimal_sep, ".")
+        return [(float(normalized), len(normalized.split(".")[1]))]
+    for sep in (",", "."):
+        if sep in token:
+            parts = token.split(sep)
+            as_thousands = (float("".join(parts)), 0)
+            if len(parts) > 2:
+                return [as_thousands]
+            as_decimal = (float(token.replace(sep, ".")), len(parts[1]))
+            if len(parts[1]) == 3:
+                return [as_decimal, as_thousands]
+            return [as_decimal]
+    return [(float(token), 0)]
+
+
+def parse_cited_value(value) -> list:
+    """
+    Liest einen zitierten Wert (Zahl oder Text wie "8,1 %", "88.510.000", "1,2 Mio. EUR").
+    Gibt Kandidaten (wert, absolute_toleranz) zurück; die Toleranz ergibt sich aus der Rundung des Zitats.
+    """
+    if isinstance(value, bool) or value is None:
+        return []
+    if isinstance(value, float) and not math.isfinite(value):
+        return []
+    if isinstance(value, (int, float)):
+        # Nachkommastellen aus der kürzesten Darstellung, auch in Exponentialschreibweise (5e-05, 1e+20)
+        decimals = max(0, -Decimal(repr(value)).as_tuple().exponent) if isinstance(value, float) else 0
+        return [(float(value), 0.5 * 10 ** -decimals)]
+    text = str(value)
+    match = _NUMBER_PATTERN.search(text)
+    if not match:
+        return []
+    suffix = text[match.end():match.end() + 6].strip().lower()
+    multiplier = 1.0
+    if suffix.startswith("%"):
+        multiplier = 0.01
+    else:
+        for unit, factor in _MULTIPLIERS.items():
+            if re.match(rf"{unit}\b", suffix):
+                multiplier = factor
+                break
+    try:
+        candidates = _number_candidates(match.group(0))
+    except ValueError:
+        return []
+    return [(number * multiplier, 0.5 * 10 ** -decimals * multiplier) for number, decimals in candidates]
+
+
+def values_match(actual: float, candidates: list) -> bool:
+    for cited, tolerance in candidates:
+        if abs(actual - cited) <= max(tolerance, FACT_CHECK_RELATIVE_TOLERANCE * abs(actual)) + 1e-9:
+            return True
+    return False
+
+
+def _memoized(cache, key, compute_fn):
+    if cache is None:
+        return compute_fn()
+    if key not in cache:
+        cache[key] = compute_fn()
+    return cache[key]
+
+
+def verify_data_point(index: dict, data_point, _cache: dict = None) -> dict:
+    """
+    Prüft einen einzelnen supporting_data_point gegen den Index. Bei einer Referenz auf nur einen Teil
+    der Dimensionen (z.B. nur ein Land) wird der Wert des entsprechenden Rollups verwendet, wie in
+    den globalen Aggregationstabellen (Summen bzw. Quote aus den Summen).
+    Status: "verified", "mismatch" oder "unresolved" (Referenz, Spalte oder Wert nicht zuordenbar).
+    """
+    if not isinstance(data_point, dict):
+        return {"status": "unresolved", "reason": "Unerwartetes Format"}
+    # Zeilen- und Spaltenreferenzen wiederholen sich häufig; Auflösungen werden pro Prüflauf gemerkt
+    row_reference = str(data_point.get("row_reference") or "")
+    dims = _memoized(_cache, ("row", row_reference), lambda: parse_row_reference(row_reference, index))
+    if dims is None:
+        return {"status": "unresolved", "reason": "Mehrdeutige Zeilenreferenz"}
+    if not dims:
+        return {"status": "unresolved", "reason": "Keine Dimension in der Zeilenreferenz erkannt"}
+    column_reference = str(data_point.get("column_reference") or "")
+    metric = _memoized(_cache, ("column", column_reference), lambda: resolve_metric(column_reference, index["numeric_columns"]))
+    if metric is None:
+        return {"status": "unresolved", "reason": "Spalte nicht zuordenbar", "reference": dims}
+    candidates = parse_cited_value(data_point.get("value"))
+    if not candidates:
+        return {"status": "unresolved", "reason": "Kein Zahlenwert zitiert", "reference": dims}
+    level = tuple(dim for dim in FACT_CHECK_DIMENSIONS if dim in dims)
+    values = index["levels"][level].get(tuple(dims[dim] for dim in level))
+    if values is None:
+        return {"status": "unresolved", "reason": "Keine Daten zur Referenz", "reference": dims}
+
+    actual = float(values[index["metric_positions"][metric]])
+    return {
+        "status": "verified" if values_match(actual, candidates) else "mismatch",
+        "reference": dims,
+        "metric": metric[1] if metric[0] == "sum" else f"global_{metric[1]}",
+        "actual_value": round(actual, 6),
+    }
+
+
+def check_insights(index: dict, insights: list) -> dict:
+    """
+    Prüft alle supporting_data_points aller Erkenntnisse. Gibt Zähler pro Status, die Einzelergebnisse
+    (mit insight_index und data_point_index) sowie Latenzkennzahlen zurück.
+    """
+    started = time.perf_counter()
+    cache = {}
+    report = {"checked": 0, "verified": 0, "mismatch": 0, "unresolved": 0, "items": []}
+    for insight_index, insight in enumerate(insights or []):
+        if not isinstance(insight, dict):
+            continue
+        for data_point_index, data_point in enumerate(insight.get("supporting_data_points") or []):
+            result = verify_data_point(index, data_point, cache)
+            report["checked"] += 1
+            report[result["status"]] += 1
+            report["items"].append({"insight_index": insight_index, "data_point_index": data_point_index, **result})
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    report["latency"] = {
+        "index_build_ms": index["build_ms"],
+        "verify_ms": round(elapsed_ms, 3),
+        "per_data_point_us": round(elapsed_ms * 1000 / report["checked"], 1) if report["checked"] else None,
+    }
+    return report
+
+
+def annotate_insights(insights: list, report: dict):
+    """
+    Vermerkt das Prüfergebnis an jedem Datenpunkt ("verification_status", ggf. "actual_value") und an jeder
+    Erkenntnis ("verification": "verified", "mismatch" oder "unverified" plus Zähler).
+    """
+    per_insight = {}
+    for item in report["items"]:
+        insight = insights[item["insight_index"]]
+        data_point = insight["supporting_data_points"][item["data_point_index"]]
+        if isinstance(data_point, dict):
+            data_point["verification_status"] = item["status"]
+            if item["status"] == "mismatch":
+                data_point["actual_value"] = item["actual_value"]
+        counts = per_insight.setdefault(item["insight_index"], {"verified": 0, "mismatch": 0, "unresolved": 0})
+        counts[item["status"]] += 1
+    for insight_index, insight in enumerate(insights or []):
+        if not isinstance(insight, dict):
+            continue
+        counts = per_insight.get(insight_index, {"verified": 0, "mismatch": 0, "unresolved": 0})
+        status = "mismatch" if counts["mismatch"] else ("verified" if counts["verified"] else "unverified")
+        insight["verification"] = {"status": status, **counts}
+
+
+def tag_insight_dimensions(index: dict, insights: list):
+    """
+    Setzt "countries" und "payment_methods" jeder Erkenntnis auf die in affected_area und den Zeilenreferenzen
+    genannten Länder bzw. Zahlungsmethoden (als Array-Felder für indexgestützte Abfragen in MongoDB).
+    """
+    for insight in insights or []:
+        if not isinstance(insight, dict):
+            continue
+        texts = [str(insight.get("affected_area") or "")] + [
+            str(data_point.get("row_reference") or "")
+            for data_point in insight.get("supporting_data_points") or [] if isinstance(data_point, dict)
+        ]
+        text = " | ".join(texts)
+        insight["countries"] = sorted(set(index["country_pattern"].findall(text)))
+        insight["payment_methods"] = sorted({
+            index["payment_methods"][match.lower()] for match in index["payment_method_pattern"].findall(text)
+        })
+
+
+def disputed_insights(insights: list, report: dict) -> list:
+    """
+    Stellt die Erkenntnisse mit abweichenden Datenpunkten samt den tatsächlichen Werten zusammen.
+    """
+    disputed = {}
+    for item in report["items"]:
+        if item["status"] != "mismatch":
+            continue
+        insight = insights[item["insight_index"]]
+        entry = disputed.setdefault(item["insight_index"], {"insight": insight, "disputed_data_points": []})
+        entry["disputed_data_points"].append({
+            "data_point": insight["supporting_data_points"][item["data_point_index"]],
+            "reference": item["reference"],
+            "metric": item["metric"],
+            "actual_value": item["actual_value"],
+        })
+    return list(disputed.values())
+
+
+def merge_corrected_insights(results: dict, corrected_insights: list) -> dict:
+    """
+    Ersetzt Erkenntnisse anhand ihrer insight_id durch die korrigierten Fassungen;
+    Erkenntnisse mit "discard": true werden entfernt.
+    """
+    corrections = {
+        insight.get("insight_id"): insight
+        for insight in corrected_insights or [] if isinstance(insight, dict) and insight.get("insight_id")
+    }
+    merged_insights = []
+    for insight in results.get("insights", []):
+        correction = corrections.get(insight.get("insight_id")) if isinstance(insight, dict) else None
+        if correction is None:
+            merged_insights.append(insight)
+        elif not correction.get("discard"):
+            merged_insights.append({key: value for key, value in correction.items() if key != "discard"})
+    return {**results, "insights": merged_insights}
@@ -0,0 +1,453 @@
+import base64
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:  # optional; ohne pyarrow werden Teilaggregate nicht auf der Platte abgelegt
+    pa = None
+
+from services.fact_check import FACT_CHECK_CELL_GROUPING, FACT_CHECK_MEASURES
+from services.stage_cache import dataframe_fingerprint
+from services.streaming import StreamingSummary, StreamingAggregator, StreamingAnomalyCandidates, \
+                               NumericColumnAccumulator, CategoricalColumnAccumulator
+from services.utils import add_calculated_kpis_to_df, parse_export_dates, statistical_anomalies_from_cells, \
+                           ANOMALY_CELL_GROUPING
+
+# Inkrementeller Modus für vollständig geladene Exporte: Teilaggregate pro Monat wiederverwenden
+# (Oberfläche und Batch-Lauf, dort auch per --incremental)
+INCREMENTAL_MODE = os.getenv("INCREMENTAL_MODE", "0") != "0"
+# Anzahl Monats-Teilaggregate, die maximal auf der Platte vorgehalten werden
+INCREMENTAL_MAX_PARTITIONS = int(os.getenv("INCREMENTAL_MAX_PARTITIONS", "512"))
+INCREMENTAL_CACHE_DIR = os.getenv(
+    "INCREMENTAL_CACHE_DIR",
+    os.path.join(os.path.dirname(__file__), '../.cache/incremental')
+)
+# Erhöhen, wenn sich Inhalt oder Berechnung der Teilaggregate ändert (alte Dateien werden dann ignoriert)
+PARTIAL_FORMAT_VERSION = "3"
+# Ein Teilaggregat ist ein Verzeichnis aus JSON (Zähler, Momente) und Parquet-Tabellen (Summen, Kandidaten);
+# bewusst kein pickle, da beim Entpickeln beliebiger Code aus dem Cache-Verzeichnis ausgeführt würde
+PARTIAL_METADATA_FILENAME = "partial.json"
+PARTIAL_TABLES = {
+    "aggregator": "aggregations.parquet",
+    "cell_aggregator": "cells.parquet",
+    "fact_check_aggregator": "fact_check_cells.parquet",
+}
+PARTIAL_CANDIDATES_FILENAME = "candidates.parquet"
+PARTIAL_SAMPLES_FILENAME = "samples.parquet"
+# Rohdaten-Schlüssel -> Schlüssel des Teilaggregats (je eine kleine Textdatei)
+PARTIAL_ALIAS_DIRNAME = "aliases"
+
+
+class MonthPartial:
+    """
+    Mergebare Teilergebnisse eines Monats: Profil-Akkumulatoren (Zählungen, Momente, Stichproben),
+    Summen auf der feinsten Ebene der Grouping Sets, Zellsummen für die statistische Anomalieerkennung
+    und die Datenpunkt-Prüfung sowie die Kandidatenzeilen der Top-N-Anomalien (mit Position im Monat).
+    """
+
+    def __init__(self, month: str, n: int):
+        self.format_version = PARTIAL_FORMAT_VERSION
+        self.month = month
+        self.num_rows = 0
+        self.summary = StreamingSummary()
+        self.aggregator = StreamingAggregator()
+        self.cell_aggregator = StreamingAggregator(grouping_sets=ANOMALY_CELL_GROUPING)
+        self.fact_check_aggregator = StreamingAggregator(grouping_sets=FACT_CHECK_CELL_GROUPING, measures=FACT_CHECK_MEASURES)
+        self.anomaly_candidates = StreamingAnomalyCandidates(n)
+
+    def update(self, partition: pd.DataFrame):
+        # Positionsindex, damit die Kandidaten unabhängig von der Lage des Monats in der Datei bleiben
+        partition_with_kpis = add_calculated_kpis_to_df(partition.reset_index(drop=True))
+        self.num_rows += len(partition_with_kpis)
+        self.summary.update(partition_with_kpis)
+        self.aggregator.update(partition_with_kpis)
+        self.cell_aggregator.update(partition_with_kpis)
+        self.fact_check_aggregator.update(partition_with_kpis)
+        self.anomaly_candidates.update(partition_with_kpis)
+
+
+def split_by_month(df: pd.DataFrame) -> dict:
+    """
+    Ordnet jedem Monat (wie Normalized_Month_For_Analysis, "NaT" für ungültige Datumswerte)
+    die Zeilenpositionen in `df` zu, in Reihenfolge des ersten Auftretens.
+    """
+    dates = parse_export_dates(df['Date'])
+    # Monate als Ganzzahl (Jahr * 12 + Monat); Text erst für die eindeutigen Monate
+    years = dates.dt.year.to_numpy(dtype="float64", na_value=np.nan)
+    month_numbers = np.where(
+        np.isnan(years), -1, np.nan_to_num(years) * 12 + dates.dt.month.to_numpy(dtype="float64", na_value=1) - 1
+    ).astype("int64")
+    uniques, first_positions, codes = np.unique(month_numbers, return_index=True, return_inverse=True)
+    order = np.argsort(codes, kind="stable")
+    bounds = np.cumsum(np.bincount(codes, minlength=len(uniques)))[:-1]
+    positions_by_code = np.split(order, bounds)
+    labels = ["NaT" if number < 0 else f"{number // 12:04d}-{number % 12 + 1:02d}" for number in uniques.tolist()]
+    return {labels[code]: positions_by_code[code] for code in np.argsort(first_positions, kind="stable")}
+
+
+def _canonical_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Wandelt jede Spalte in einen kanonischen Typ (Zahlen float64, Datumswerte datetime64[ns], sonst Text),
+    damit der Fingerabdruck eines Monats nicht vom Speichertyp abhängt. Die Typverdichtung beim Laden richtet
+    sich nach dem Wertebereich der ganzen Datei; ein neuer Monat mit größeren Werten ändert daher den Typ
+    (z.B. int8 -> int16), ohne dass sich die Werte älterer Monate ändern.
+    """
+    columns = {}
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_bool_dtype(series) or pd.api.types.is_numeric_dtype(series):
+            columns[col] = pd.Series(series.to_numpy(dtype="float64", na_value=np.nan), index=df.index)
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            columns[col] = series.astype("datetime64[ns]")
+        else:
+            columns[col] = series.astype(str)
+    return pd.DataFrame(columns, index=df.index)
+
+
+def _column_kinds(df: pd.DataFrame) -> list:
+    kinds = []
+    for col, dtype in df.dtypes.items():
+        if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_numeric_dtype(dtype):
+            kinds.append((str(col), "numeric"))
+        elif pd.api.types.is_datetime64_any_dtype(dtype):
+            kinds.append((str(col), "datetime"))
+        else:
+            kinds.append((str(col), "text"))
+    return kinds
+
+
+def _row_hashes(df: pd.DataFrame):
+    """
+    Zeilen-Hashes (ohne Index) der kanonischen Werte; None bei nicht hashbaren Zellwerten.
+    """
+    try:
+        return pd.util.hash_pandas_object(_canonical_frame(df), index=False).to_numpy()
+    except TypeError:
+        return None
+
+
+def _partition_key(month_df: pd.DataFrame, n: int) -> str:
+    """
+    Schlüssel des Teilaggregats eines Monats aus seinen kanonischen Werten. Hängt nicht vom verdichteten
+    Speichertyp ab, kostet aber eine Typumwandlung des Monats und wird daher nur bei unbekanntem
+    Rohdaten-Schlüssel (siehe _raw_partition_key) berechnet.
+    """
+    hasher = hashlib.sha256()
+    # Nur Spaltennamen und logische Art, nicht der verdichtete Speichertyp
+    hasher.update(repr(_column_kinds(month_df)).encode("utf-8"))
+    row_hashes = _row_hashes(month_df)
+    if row_hashes is not None:
+        hasher.update(row_hashes.tobytes())
+    else:
+        hasher.update(dataframe_fingerprint(month_df.reset_index(drop=True)).encode("utf-8"))
+    return f"{hasher.hexdigest()[:32]}-n{n}-v{PARTIAL_FORMAT_VERSION}"
+
+
+def _raw_row_hashes(df: pd.DataFrame):
+    """
+    Zeilen-Hashes der gespeicherten Werte ohne Typumwandlung (kategorische Spalten über ihre
+    Kategorien, daher etwa zehnmal günstiger als _row_hashes); None bei nicht hashbaren Zellwerten.
+    """
+    try:
+        return pd.util.hash_pandas_object(df, index=False).to_numpy()
+    except TypeError:
+        return None
+
+
+def _raw_partition_key(df: pd.DataFrame, positions: np.ndarray, raw_hashes, n: int):
+    """
+    Günstiger Schlüssel eines Monats aus den Rohdaten-Hashes inklusive Speichertypen. Ändert sich nur der
+    Speichertyp (z.B. int8 -> int16), ändert sich dieser Schlüssel, der kanonische aber nicht.
+    """
+    if raw_hashes is None:
+        return None
+    hasher = hashlib.sha256()
+    hasher.update(repr([(str(col), str(dtype)) for col, dtype in df.dtypes.items()]).encode("utf-8"))
+    hasher.update(raw_hashes[positions].tobytes())
+    return f"{hasher.hexdigest()[:32]}-n{n}-v{PARTIAL_FORMAT_VERSION}"
+
+
+def _alias_path(raw_key: str) -> str:
+    return os.path.join(INCREMENTAL_CACHE_DIR, PARTIAL_ALIAS_DIRNAME, raw_key)
+
+
+def _read_alias(raw_key: str):
+    try:
+        with open(_alias_path(raw_key), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def _write_alias(raw_key: str, key: str):
+    # Eine Datei pro Rohdaten-Schlüssel, atomar ersetzt: parallele Batch-Prozesse überschreiben sich nicht halb
+    path = _alias_path(raw_key)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(key)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Warnung: Schlüssel des Monats-Teilaggregats konnte nicht gespeichert werden: {e}")
+
+
+def _partial_path(key: str) -> str:
+    return os.path.join(INCREMENTAL_CACHE_DIR, key)
+
+
+def _encode_value(value):
+    # JSON-taugliche Darstellung von Kategoriewerten; Zeitstempel bleiben als solche erkennbar
+    if isinstance(value, pd.Timestamp):
+        return {"timestamp": value.isoformat()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict) and "timestamp" in value:
+        return pd.Timestamp(value["timestamp"])
+    return value
+
+
+def _summary_to_json(summary: StreamingSummary) -> tuple:
+    """
+    Zerlegt ein StreamingSummary in JSON-Metadaten und eine Tabelle der Quartil-Stichproben.
+    """
+    numeric = {
+        col: {"count": acc.count, "mean": acc.mean, "m2": acc.m2, "min": acc.min, "max": acc.max}
+        for col, acc in summary.numeric.items()
+    }
+    categorical = {
+        col: {
+            "counts": [[_encode_value(value), count] for value, count in acc.counts.items()],
+            "has_missing": acc.has_missing,
+            "first_seen": [_encode_value(value) for value in acc.first_seen],
+            "approximate": acc.approximate,
+            "registers": base64.b64encode(acc.registers.tobytes()).decode("ascii") if acc.registers is not None else None,
+        }
+        for col, acc in summary.categorical.items()
+    }
+    samples = pd.DataFrame({
+        "column": np.repeat([str(col) for col in summary.numeric], [acc.sample.size for acc in summary.numeric.values()]),
+        "value": np.concatenate([acc.sample for acc in summary.numeric.values()]) if summary.numeric else np.empty(0),
+    })
+    metadata = {
+        "num_rows": summary.num_rows,
+        "column_names": summary.column_names,
+        "column_dtypes": summary.column_dtypes,
+        "numeric": numeric,
+        "categorical": categorical,
+    }
+    return metadata, samples
+
+
+def _summary_from_json(metadata: dict, samples: pd.DataFrame) -> StreamingSummary:
+    summary = StreamingSummary()
+    summary.num_rows = metadata["num_rows"]
+    summary.column_names = metadata["column_names"]
+    summary.column_dtypes = metadata["column_dtypes"]
+    sample_values = {col: group.to_numpy(dtype="float64") for col, group in samples.groupby("column", sort=False)["value"]}
+    for col, state in metadata["numeric"].items():
+        acc = NumericColumnAccumulator()
+        acc.count, acc.mean, acc.m2 = state["count"], state["mean"], state["m2"]
+        acc.min = np.nan if state["min"] is None else state["min"]
+        acc.max = np.nan if state["max"] is None else state["max"]
+        acc.sample = sample_values.get(col, np.empty(0, dtype="float64"))
+        summary.numeric[col] = acc
+    for col, state in metadata["categorical"].items():
+        acc = CategoricalColumnAccumulator()
+        acc.counts = {_decode_value(value): count for value, count in state["counts"]}
+        acc.has_missing = state["has_missing"]
+        acc.first_seen = [_decode_value(value) for value in state["first_seen"]]
+        acc.approximate = state["approximate"]
+        if state["registers"] is not None:
+            acc.registers = np.frombuffer(base64.b64decode(state["registers"]), dtype=np.uint8).copy()
+        summary.categorical[col] = acc
+    return summary
+
+
+def _load_partial(key: str):
+    path = _partial_path(key)
+    metadata_path = os.path.join(path, PARTIAL_METADATA_FILENAME)
+    if pa is None or not os.path.exists(metadata_path):
+        return None
+    try:
+        with open(metadata_path, "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+        if metadata.get("format_version") != PARTIAL_FORMAT_VERSION:
+            return None
+        partial = MonthPartial(metadata["month"], metadata["n"])
+        partial.num_rows = metadata["num_rows"]
+        partial.summary = _summary_from_json(metadata["summary"], pd.read_parquet(os.path.join(path, PARTIAL_SAMPLES_FILENAME)))
+        for name, filename in PARTIAL_TABLES.items():
+            if name in metadata["tables"]:
+                getattr(partial, name).finest_agg = pd.read_parquet(os.path.join(path, filename))
+        if metadata["has_candidates"]:
+            partial.anomaly_candidates.candidates = pd.read_parquet(os.path.join(path, PARTIAL_CANDIDATES_FILENAME))
+        os.utime(metadata_path)  # mtime dient als LRU-Zeitstempel für das Aufräumen
+    except Exception as e:
+        print(f"Warnung: Monats-Teilaggregat {path} konnte nicht gelesen werden: {e}")
+        return None
+    return partial
+
+
+def _store_partial(key: str, partial: MonthPartial):
+    if pa is None:
+        return
+    path = _partial_path(key)
+    # Prozess-ID im Namen, da Batch-Worker denselben Monat gleichzeitig schreiben können
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(tmp_path, exist_ok=True)
+        summary_metadata, samples = _summary_to_json(partial.summary)
+        samples.to_parquet(os.path.join(tmp_path, PARTIAL_SAMPLES_FILENAME), index=False)
+        tables = []
+        for name, filename in PARTIAL_TABLES.items():
+            finest_agg = getattr(partial, name).finest_agg
+            if finest_agg is not None:
+                finest_agg.to_parquet(os.path.join(tmp_path, filename), index=False)
+                tables.append(name)
+        candidates = partial.anomaly_candidates.candidates
+        if candidates is not None:
+            # Index = Position im Monat, wird für die Zuordnung zum Gesamtindex benötigt
+            candidates.to_parquet(os.path.join(tmp_path, PARTIAL_CANDIDATES_FILENAME), index=True)
+        metadata = {
+            "format_version": PARTIAL_FORMAT_VERSION,
+            "month": partial.month,
+            "n": partial.anomaly_candidates.n,
+            "num_rows": partial.num_rows,
+            "summary": summary_metadata,
+            "tables": tables,
+            "has_candidates": candidates is not None,
+        }
+        with open(os.path.join(tmp_path, PARTIAL_METADATA_FILENAME), "w", encoding="utf-8") as f:
+            json.dump(metadata, f, ensure_ascii=False)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"Warnung: Monats-Teilaggregat konnte nicht gespeichert werden: {e}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _prune_partials():
+    try:
+        paths = [
+            os.path.join(INCREMENTAL_CACHE_DIR, name) for name in os.listdir(INCREMENTAL_CACHE_DIR)
+            if os.path.exists(os.path.join(INCREMENTAL_CACHE_DIR, name, PARTIAL_METADATA_FILENAME))
+        ]
+        paths.sort(key=lambda path: os.path.getmtime(os.path.join(path, PARTIAL_METADATA_FILENAME)), reverse=True)
+        for path in paths[INCREMENTAL_MAX_PARTITIONS:]:
+            shutil.rmtree(path, ignore_errors=True)
+        # Verweise auf verdrängte Teilaggregate entfernen
+        alias_dir = os.path.join(INCREMENTAL_CACHE_DIR, PARTIAL_ALIAS_DIRNAME)
+        for name in os.listdir(alias_dir) if os.path.isdir(alias_dir) else []:
+            key = _read_alias(name)
+            if key is None or not os.path.exists(os.path.join(_partial_path(key), PARTIAL_METADATA_FILENAME)):
+                try:
+                    os.remove(os.path.join(alias_dir, name))
+                except OSError:
+                    pass
+    except OSError as e:
+        print(f"Warnung: Teilaggregate konnten nicht aufgeräumt werden: {e}")
+
+
+def merge_month_partials(partials: list, row_positions: list, index: pd.Index, n: int) -> dict:
+    """
+    Führt Monats-Teilaggregate zu den Stufenergebnissen (wie in perform_llm_analysis) zusammen:
+    globale Rollups aus den summierten feinsten Aggregaten, Anomalie-Baselines aus den Zellsummen
+    aller Monate, Top-N-Anomalien aus den vereinigten Kandidaten. `row_positions[i]` sind die Zeilen-
+    positionen des Monats `partials[i]` im DataFrame mit Index `index`; daraus wird der Index der
+    Kandidaten wiederhergestellt, sodass Reihenfolge und Gleichstände wie bei der Vollberechnung bleiben.
+    """
+    summary = StreamingSummary()
+    aggregator = StreamingAggregator()
+    cell_aggregator = StreamingAggregator(grouping_sets=ANOMALY_CELL_GROUPING)
+    fact_check_aggregator = StreamingAggregator(grouping_sets=FACT_CHECK_CELL_GROUPING, measures=FACT_CHECK_MEASURES)
+    anomaly_candidates = StreamingAnomalyCandidates(n)
+    candidates = []
+    for partial, positions in zip(partials, row_positions):
+        summary.merge(partial.summary)
+        month_candidates = partial.anomaly_candidates.candidates
+        if month_candidates is not None:
+            candidates.append(month_candidates.set_axis(index[positions[month_candidates.index.to_numpy()]]))
+    # Alle Monate in einem Durchlauf zusammenführen statt paarweise
+    for merged, name in ((aggregator, "aggregator"), (cell_aggregator, "cell_aggregator"),
+                         (fact_check_aggregator, "fact_check_aggregator")):
+        tables = [getattr(partial, name).finest_agg for partial in partials if getattr(partial, name).finest_agg is not None]
+        if tables:
+            merged.finest_agg = pd.concat(tables, ignore_index=True)
+            merged.regroup()
+    if candidates:
+        # Die Vereinigung ist eine Obermenge der Top-N-Kandidaten; get_top_n_anomalies wählt daraus aus
+        anomaly_candidates.merge_candidates(pd.concat(candidates).sort_index(kind="stable"))
+
+    return {
+        "summary": summary.to_summary_dict(),
+        "aggregations": aggregator.to_aggregations_dict(),
+        "anomalies": anomaly_candidates.to_anomalies_dict(),
+        "statistical_anomalies": (
+            statistical_anomalies_from_cells(cell_aggregator.finest_agg)
+            if cell_aggregator.finest_agg is not None else {}
+        ),
+        "fact_check_cells": fact_check_aggregator.finest_agg,
+    }
+
+
+def analyze_incrementally(df: pd.DataFrame, n: int = 7) -> dict:
+    """
+    Berechnet die Datenstufen eines vollständigen Exports inkrementell: Die Daten werden nach Monat
+    aufgeteilt, jeder Monat über seinen Inhalts-Fingerabdruck erkannt, und nur neue oder geänderte
+    Monate durchlaufen KPIs und Aggregation. Unveränderte Monate kommen als Teilaggregat von der Platte.
+    Gibt die Stufenergebnisse zurück; summary["incremental"] beschreibt wiederverwendete und neu
+    berechnete Monate (Quartile sind wie im Streaming-Modus geschätzt).
+    """
+    started = time.perf_counter()
+    months = split_by_month(df)
+    partials, row_positions, computed, reused = [], [], [], []
+    raw_hashes = _raw_row_hashes(df)
+    for month, positions in months.items():
+        raw_key = _raw_partition_key(df, positions, raw_hashes, n)
+        key = _read_alias(raw_key) if raw_key else None
+        partial = _load_partial(key) if key else None
+        if partial is None:
+            # Neuer oder geänderter Monat (oder nur anderer Speichertyp): nur diesen Monat kanonisch hashen
+            month_df = df.iloc[positions]
+            key = _partition_key(month_df, n)
+            partial = _load_partial(key)
+            if partial is None:
+                partial = MonthPartial(month, n)
+                partial.update(month_df)
+                _store_partial(key, partial)
+                computed.append(month)
+            else:
+                reused.append(month)
+            if raw_key:
+                _write_alias(raw_key, key)
+        else:
+            reused.append(month)
+        partials.append(partial)
+        row_positions.append(positions)
+    if computed:
+        _prune_partials()
+
+    stages = merge_month_partials(partials, row_positions, df.index, n)
+    # Wiederverwendete Monate kennen nur den Speichertyp ihrer damaligen Datei
+    stages["summary"]["column_dtypes"].update({col: str(dtype) for col, dtype in df.dtypes.items()})
+    stages["summary"]["incremental"] = {
+        "months": len(months),
+        "reused_months": sorted(reused),
+        "computed_months": sorted(computed),
+        "quantiles_approximate": True,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    return stages
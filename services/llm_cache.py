@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+# Lokaler Antwort-Cache für LLM-Aufrufe (SQLite-Datei)
+LLM_CACHE_PATH = os.getenv(
+    "LLM_CACHE_PATH",
+    os.path.join(os.path.dirname(__file__), '../.cache/llm_responses.sqlite')
+)
+# Gültigkeitsdauer eines Eintrags in Sekunden (Standard: 7 Tage)
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+# Maximale Anzahl Einträge; darüber werden die am längsten nicht genutzten verdrängt
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "500"))
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") != "0"
+
+
+def llm_request_key(messages: list, **params) -> str:
+    """
+    Berechnet den Cache-Schlüssel aus der exakten Nachrichtenliste und den Modellparametern
+    (model, temperature, seed, max_tokens, ...).
+    """
+    payload = json.dumps({"messages": messages, "params": params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _connect() -> sqlite3.Connection:
+    # Eine Verbindung pro Aufruf, da Streamlit Reruns in wechselnden Threads ausführt
+    os.makedirs(os.path.dirname(os.path.abspath(LLM_CACHE_PATH)), exist_ok=True)
+    connection = sqlite3.connect(LLM_CACHE_PATH, timeout=10)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS llm_responses ("
+        "key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, last_used_at REAL NOT NULL)"
+    )
+    return connection
+
+
+def get_cached_response(key: str):
+    """
+    Gibt die gespeicherte Antwort für den Schlüssel zurück oder None (kein Eintrag, abgelaufen, Fehler).
+    """
+    if not LLM_CACHE_ENABLED:
+        return None
+    now = time.time()
+    try:
+        with closing(_connect()) as connection, connection:
+            row = connection.execute(
+                "SELECT response, created_at FROM llm_responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > LLM_CACHE_TTL_SECONDS:
+                connection.execute("DELETE FROM llm_responses WHERE key = ?", (key,))
+                return None
+            connection.execute("UPDATE llm_responses SET last_used_at = ? WHERE key = ?", (now, key))
+            return row[0]
+    except (sqlite3.Error, OSError) as e:
+        print(f"Warnung: LLM-Cache konnte nicht gelesen werden: {e}")
+        return None
+
+
+def store_response(key: str, response: str):
+    """
+    Speichert eine Antwort und verdrängt abgelaufene sowie überzählige (am längsten ungenutzte) Einträge.
+    """
+    if not LLM_CACHE_ENABLED:
+        return
+    now = time.time()
+    try:
+        with closing(_connect()) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO llm_responses (key, response, created_at, last_used_at) VALUES (?, ?, ?, ?)",
+                (key, response, now, now)
+            )
+            connection.execute("DELETE FROM llm_responses WHERE created_at < ?", (now - LLM_CACHE_TTL_SECONDS,))
+            connection.execute(
+                "DELETE FROM llm_responses WHERE key NOT IN "
+                "(SELECT key FROM llm_responses ORDER BY last_used_at DESC LIMIT ?)",
+                (LLM_CACHE_MAX_ENTRIES,)
+            )
+    except (sqlite3.Error, OSError) as e:
+        print(f"Warnung: LLM-Antwort konnte nicht im Cache abgelegt werden: {e}")
+
+
+def cached_chat_completion(openai_client, messages: list, on_delta=None, cache_tag: str = None, **params):
+    """
+    Führt chat.completions.create aus, sofern für identische Nachrichten und Parameter
+    keine gültige Antwort im Cache liegt. Gibt (antwort_text, cache_hit) zurück.
+    Mit on_delta wird die Antwort gestreamt (stream=True) und jedes Textfragment sofort
+    an on_delta übergeben; bei einem Cache-Treffer erhält on_delta die ganze Antwort auf einmal.
+    cache_tag (z.B. die Version der Prompt-Vorlagen) fließt nur in den Cache-Schlüssel ein.
+    Fehler der API werden unverändert weitergereicht.
+    """
+    key = llm_request_key(messages, **params) if cache_tag is None else llm_request_key(messages, cache_tag=cache_tag, **params)
+    cached = get_cached_response(key)
+    if cached is not None:
+        if on_delta:
+            on_delta(cached)
+        return cached, True
+
+    if on_delta:
+        parts = []
+        for chunk in openai_client.chat.completions.create(messages=messages, stream=True, **params):
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                on_delta(delta)
+        content = "".join(parts) if parts else None
+    else:
+        completion = openai_client.chat.completions.create(messages=messages, **params)
+        content = completion.choices[0].message.content
+    if content is not None:
+        store_response(key, content)
+    return content, False
+
+
+def clear_llm_cache():
+    """
+    Löscht alle Einträge des LLM-Antwort-Caches.
+    """
+    try:
+        with closing(_connect()) as connection, connection:
+            connection.execute("DELETE FROM llm_responses")
+    except (sqlite3.Error, OSError) as e:
+        print(f"Warnung: LLM-Cache konnte nicht geleert werden: {e}")
@@ -0,0 +1,238 @@
+import csv
+import hashlib
+import io
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from services.utils import parse_export_dates
+from services.dataset_store import write_partitioned_dataset, read_partitioned_dataset, prune_dataset_store
+
+# Anzahl geparster DataFrames, die im Arbeitsspeicher gehalten werden
+PARSED_CACHE_MAX_ENTRIES = int(os.getenv("PARSED_CACHE_MAX_ENTRIES", "4"))
+
+SUPPORTED_TABULAR_EXTENSIONS = ("xlsx", "csv")
+
+# Niedrig-kardinale Dimensionsspalten der Exporte, die als Kategorie gespeichert werden
+DIMENSION_COLUMNS = ["Country", "Payment Method", "Month"]
+DATE_COLUMN = "Date"
+
+_parsed_frames = OrderedDict()
+
+
+def compute_content_hash(data: bytes) -> str:
+    """
+    Berechnet einen Inhalts-Hash (SHA-256) über die Rohbytes einer hochgeladenen Datei.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def compute_stream_content_hash(stream, block_size: int = 1024 * 1024) -> str:
+    """
+    Wie compute_content_hash, liest ein Dateiobjekt aber blockweise vom Anfang (danach steht es wieder am Anfang).
+    """
+    hasher = hashlib.sha256()
+    stream.seek(0)
+    for block in iter(lambda: stream.read(block_size), b""):
+        hasher.update(block)
+    stream.seek(0)
+    return hasher.hexdigest()
+
+
+def sniff_csv_delimiter(data: bytes) -> str:
+    """
+    Ermittelt das Trennzeichen einer CSV-Datei anhand der ersten 2048 Bytes.
+    """
+    sample = data[:2048].decode("utf-8", errors="ignore")
+    return csv.Sniffer().sniff(sample).delimiter
+
+
+def get_file_extension(filename: str) -> str:
+    return filename.split('.')[-1].lower()
+
+
+def _cache_key(content_hash: str, extension: str, delimiter: str = None) -> str:
+    if delimiter is None:
+        return f"{content_hash}-{extension}"
+    # Trennzeichen als Codepoint, damit der Schlüssel dateinamentauglich bleibt
+    return f"{content_hash}-{extension}-{ord(delimiter)}"
+
+
+def _remember_frame(key: str, df: pd.DataFrame):
+    _parsed_frames[key] = df
+    _parsed_frames.move_to_end(key)
+    while len(_parsed_frames) > PARSED_CACHE_MAX_ENTRIES:
+        _parsed_frames.popitem(last=False)
+
+
+def _downcast_numeric(series: pd.Series) -> pd.Series:
+    """
+    Verkleinert eine numerische Spalte auf den kleinsten verlustfreien Typ.
+    Ganzzahlen werden auf int8/16/32 reduziert, Gleitkommazahlen nur dann auf float32,
+    wenn sich dabei kein Wert ändert.
+    """
+    if pd.api.types.is_bool_dtype(series):
+        return series
+    if pd.api.types.is_integer_dtype(series):
+        return pd.to_numeric(series, downcast="integer")
+    if pd.api.types.is_float_dtype(series):
+        values = series.to_numpy(dtype="float64", na_value=np.nan)
+        # Ganzzahlige Werte ohne Lücken (z.B. aus Excel) zuerst als Integer versuchen
+        if not np.isnan(values).any() and np.array_equal(values, np.round(values)):
+            return pd.to_numeric(series.astype("int64"), downcast="integer")
+        as_float32 = values.astype("float32")
+        if np.array_equal(as_float32.astype("float64"), values, equal_nan=True):
+            return series.astype("float32")
+    return series
+
+
+def _parse_numeric_text(series: pd.Series):
+    """
+    Versucht, eine Textspalte als Zahlen zu lesen (auch im deutschen Format 1.234,56).
+    Gibt None zurück, wenn nicht alle vorhandenen Werte konvertierbar sind.
+    """
+    non_null = series.notna()
+    if not non_null.any():
+        return None
+    converted = pd.to_numeric(series, errors="coerce")
+    if converted[non_null].notna().all():
+        return converted
+    text = series.astype("string").str.strip()
+    german = pd.to_numeric(text.str.replace(".", "", regex=False).str.replace(",", ".", regex=False), errors="coerce")
+    if german[non_null].notna().all():
+        return german
+    return None
+
+
+def normalize_dataframe_schema(df: pd.DataFrame):
+    """
+    Verdichtet die Spaltentypen direkt nach dem Laden:
+    - bekannte Dimensionsspalten (DIMENSION_COLUMNS) werden zu 'category',
+    - 'Date' wird einmalig als dd.mm.yyyy geparst,
+    - Textspalten, die vollständig aus Zahlen bestehen, werden numerisch,
+    - numerische Spalten werden auf den kleinsten verlustfreien Typ reduziert.
+    Gibt den normalisierten DataFrame und einen Bericht über Typänderungen und Speicherersparnis zurück.
+    """
+    memory_before = int(df.memory_usage(deep=True).sum())
+    normalized = []
+    converted_columns = {}
+    for position, col in enumerate(df.columns):
+        series = df.iloc[:, position]
+        if col == DATE_COLUMN:
+            new_series = parse_export_dates(series)
+        elif col in DIMENSION_COLUMNS:
+            new_series = series if isinstance(series.dtype, pd.CategoricalDtype) else series.astype("category")
+        elif pd.api.types.is_numeric_dtype(series):
+            new_series = _downcast_numeric(series)
+        elif pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+            parsed = _parse_numeric_text(series)
+            new_series = _downcast_numeric(parsed) if parsed is not None else series
+        else:
+            new_series = series
+        normalized.append(new_series)
+        if new_series.dtype != series.dtype:
+            converted_columns[str(col)] = f"{series.dtype} -> {new_series.dtype}"
+
+    result = pd.concat(normalized, axis=1) if normalized else df.copy()
+    result.columns = df.columns
+    memory_after = int(result.memory_usage(deep=True).sum())
+    report = {
+        "memory_before_bytes": memory_before,
+        "memory_after_bytes": memory_after,
+        "memory_saved_bytes": memory_before - memory_after,
+        "converted_columns": converted_columns,
+    }
+    return result, report
+
+
+def _parse_tabular_bytes(data: bytes, extension: str, delimiter: str = None) -> pd.DataFrame:
+    if extension == "xlsx":
+        return pd.read_excel(io.BytesIO(data))
+    return pd.read_csv(io.BytesIO(data), sep=delimiter)
+
+
+def load_tabular_file(data: bytes, filename: str, months: list = None, countries: list = None,
+                      columns: list = None) -> pd.DataFrame:
+    """
+    Parst eine hochgeladene Excel- oder CSV-Datei und cached das Ergebnis.
+    Schlüssel ist der Inhalts-Hash der Datei (plus erkanntes CSV-Trennzeichen), sodass
+    Streamlit-Reruns und erneute Uploads identischer Dateien den DataFrame sofort erhalten.
+    Reihenfolge: In-Memory-LRU -> nach Monat/Land partitioniertes Parquet-Dataset -> Parsen.
+    Frisch geparste Daten werden mit normalize_dataframe_schema verdichtet; der Bericht
+    liegt in df.attrs["schema_report"], der Inhalts-Hash in df.attrs["content_hash"].
+    Mit `months` ("2024-06"), `countries` oder `columns` werden nur die passenden Partitionen und
+    Spalten aus dem Dataset gelesen (Ergebnis wird nicht im Arbeitsspeicher gecached).
+    """
+    extension = get_file_extension(filename)
+    if extension not in SUPPORTED_TABULAR_EXTENSIONS:
+        raise ValueError(f"Nicht unterstütztes Dateiformat für Analyse: .{extension}")
+
+    delimiter = sniff_csv_delimiter(data) if extension == "csv" else None
+    content_hash = compute_content_hash(data)
+    key = _cache_key(content_hash, extension, delimiter)
+    filtered = months is not None or countries is not None or columns is not None
+
+    df = _parsed_frames.get(key)
+    if df is not None and not filtered:
+        _parsed_frames.move_to_end(key)
+        return df
+
+    if filtered:
+        df = read_partitioned_dataset(key, months=months, countries=countries, columns=columns)
+        if df is not None:
+            return df
+    df = read_partitioned_dataset(key)
+    if df is None:
+        df, schema_report = normalize_dataframe_schema(_parse_tabular_bytes(data, extension, delimiter))
+        df.attrs["schema_report"] = schema_report
+        df.attrs["content_hash"] = content_hash
+        if write_partitioned_dataset(key, df, filename=filename) and filtered:
+            # None, wenn ein anderer Prozess den Datensatz inzwischen aus dem Speicher verdrängt hat
+            filtered_df = read_partitioned_dataset(key, months=months, countries=countries, columns=columns)
+            if filtered_df is not None:
+                return filtered_df
+    df.attrs["content_hash"] = content_hash
+    _remember_frame(key, df)
+    if filtered:
+        # Ohne Parquet-Speicher (z.B. fehlendes pyarrow): im Arbeitsspeicher filtern
+        return filter_loaded_frame(df, months=months, countries=countries, columns=columns)
+    return df
+
+
+def filter_loaded_frame(df: pd.DataFrame, months: list = None, countries: list = None,
+                        columns: list = None) -> pd.DataFrame:
+    """
+    Wendet dieselben Filter wie read_partitioned_dataset auf einen geladenen DataFrame an.
+    """
+    keep = pd.Series(True, index=df.index)
+    if months is not None and DATE_COLUMN in df.columns:
+        keep &= parse_export_dates(df[DATE_COLUMN]).dt.strftime("%Y-%m").isin([str(month) for month in months])
+    if countries is not None and "Country" in df.columns:
+        keep &= df["Country"].astype(str).isin([str(country) for country in countries])
+    result = df[keep]
+    if columns is not None:
+        result = result[[col for col in columns if col in df.columns]]
+    return result
+
+
+def load_stored_dataset(key: str):
+    """
+    Lädt einen zuvor hochgeladenen Datensatz aus dem Parquet-Speicher (siehe list_stored_datasets).
+    """
+    df = _parsed_frames.get(key)
+    if df is None:
+        df = read_partitioned_dataset(key)
+        if df is not None:
+            _remember_frame(key, df)
+    return df
+
+
+def clear_parsed_cache(include_disk: bool = False):
+    """
+    Leert den In-Memory-Cache und optional den Parquet-Speicher auf der Platte.
+    """
+    _parsed_frames.clear()
+    if include_disk:
+        prune_dataset_store(max_entries=0)
@@ -0,0 +1,225 @@
+import io
+import json
+import math
+import os
+import re
+
+import pandas as pd
+
+try:
+    import tiktoken
+except ImportError:  # optional; ohne tiktoken wird die Tokenanzahl geschätzt
+    tiktoken = None
+
+# Gesamtbudget (Tokens) für alle Datenabschnitte eines Prompts
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "20000"))
+PROMPT_TOKEN_ENCODING = os.getenv("PROMPT_TOKEN_ENCODING", "o200k_base")
+# Nachkommastellen für Gleitkommazahlen im kompakten JSON
+PROMPT_JSON_DECIMALS = 4
+
+# Abschnitt -> (Art, Priorität, max. Tokens, Sortierspalte beim Kürzen).
+# Niedrige Priorität = wichtiger; bei Budgetüberschreitung wird zuerst der unwichtigste Abschnitt gekürzt.
+# Das Maximum pro Abschnitt lässt sich über PROMPT_BUDGET_<ABSCHNITT> überschreiben.
+PROMPT_SECTIONS = {
+    "data_summary": ("json", 1, 5000, None),
+    "statistical_anomalies": ("csv", 2, 2500, None),
+    "agg_country_payment_method": ("csv", 3, 5000, None),
+    "agg_country": ("csv", 4, 1500, None),
+    "agg_payment_method": ("csv", 4, 1000, None),
+    "write_offs": ("csv", 5, 2000, "EUR Write-Offs"),
+    "historical_insights": ("text", 6, 1500, None),
+    # Vergleichsanalyse mehrerer Dateien; Delta-Tabellen sind bereits nach |delta_pct| sortiert
+    "comparison_sources": ("json", 1, 1500, None),
+    "comparison_totals": ("csv", 1, 1500, None),
+    "delta_total": ("csv", 1, 1000, None),
+    "delta_by_country": ("csv", 2, 3000, None),
+    "delta_by_payment_method": ("csv", 2, 2000, None),
+    "delta_by_country_payment_method": ("csv", 3, 6000, None),
+}
+# Unter diese Größe wird ein Abschnitt beim Verteilen des Gesamtbudgets nicht gekürzt
+PROMPT_SECTION_MIN_TOKENS = 200
+
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding(PROMPT_TOKEN_ENCODING)
+        except Exception as e:
+            print(f"Warnung: tiktoken-Encoding {PROMPT_TOKEN_ENCODING} nicht verfügbar, Tokenanzahl wird geschätzt: {e}")
+            # Fehlschlag merken (z.B. offline), damit nicht jeder Aufruf den Download erneut versucht
+            _encoding = False
+    return _encoding or None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Zählt die Tokens eines Textes offline mit tiktoken; ohne tiktoken wird konservativ geschätzt
+    (Wörter/Zahlen und Satzzeichen einzeln bzw. etwa 4 Zeichen pro Token, der größere Wert zählt).
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return max(len(re.findall(r"\w+|[^\w\s]", text)), math.ceil(len(text) / 4))
+
+
+def _round_floats(value, decimals: int):
+    if isinstance(value, float):
+        return round(value, decimals) if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: _round_floats(item, decimals) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_round_floats(item, decimals) for item in value]
+    return value
+
+
+def compact_json(data, decimals: int = PROMPT_JSON_DECIMALS) -> str:
+    """
+    Serialisiert Daten ohne Einrückung und Leerzeichen, Gleitkommazahlen auf `decimals` Stellen gerundet.
+    """
+    return json.dumps(_round_floats(data, decimals), separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def _shrink_summary(summary: dict, level: int) -> dict:
+    """
+    Verdichtet die Daten-Summary stufenweise: 1 = ohne Beispielwerte, 2 = numerische Statistik
+    nur noch mit count/mean/min/max, 3 = zusätzlich ohne Top-Werte der Textspalten.
+    """
+    shrunk = dict(summary)
+    if level >= 1 and isinstance(summary.get("categorical_summary"), dict):
+        shrunk["categorical_summary"] = {
+            col: {key: value for key, value in stats.items() if key != "unique_sample"} if isinstance(stats, dict) else stats
+            for col, stats in summary["categorical_summary"].items()
+        }
+    if level >= 2 and isinstance(summary.get("numerical_summary"), dict):
+        shrunk["numerical_summary"] = {
+            col: {key: value for key, value in stats.items() if key in ("count", "mean", "min", "max")} if isinstance(stats, dict) else stats
+            for col, stats in summary["numerical_summary"].items()
+        }
+    if level >= 3 and isinstance(shrunk.get("categorical_summary"), dict):
+        shrunk["categorical_summary"] = {
+            col: {key: value for key, value in stats.items() if key != "top_values"} if isinstance(stats, dict) else stats
+            for col, stats in shrunk["categorical_summary"].items()
+        }
+    return shrunk
+
+
+def _fit_json(data, max_tokens: int) -> str:
+    text = compact_json(data)
+    if not isinstance(data, dict):
+        return text
+    for level in (1, 2, 3):
+        if count_tokens(text) <= max_tokens:
+            break
+        text = compact_json(_shrink_summary(data, level))
+    return text
+
+
+def _fit_csv(text: str, max_tokens: int, sort_by: str = None) -> str:
+    """
+    Kürzt eine CSV-Tabelle auf die wichtigsten Zeilen, die ins Budget passen (per Binärsuche),
+    optional nach `sort_by` absteigend priorisiert, und vermerkt die Anzahl ausgelassener Zeilen.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    try:
+        table = pd.read_csv(io.StringIO(text))
+    except Exception:
+        return _fit_text(text, max_tokens)
+    if table.empty:
+        return text
+    if sort_by in table.columns:
+        table = table.sort_values(sort_by, ascending=False, kind="stable")
+
+    def render(num_rows: int) -> str:
+        omitted = len(table) - num_rows
+        note = f"# ... {omitted} weitere Zeilen aus Platzgründen ausgelassen"
+        if sort_by in table.columns:
+            note += f" (sortiert nach {sort_by}, absteigend)"
+        return table.head(num_rows).to_csv(index=False) + note + "\n"
+
+    low, high = 0, len(table)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(render(middle)) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return render(low)
+
+
+def _fit_text(text: str, max_tokens: int) -> str:
+    if count_tokens(text) <= max_tokens:
+        return text
+    lines = text.splitlines(keepends=True)
+    low, high = 0, len(lines)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens("".join(lines[:middle])) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return "".join(lines[:low]) + "... (aus Platzgründen gekürzt)\n"
+
+
+def _fit_section(kind: str, value, max_tokens: int, sort_by: str = None) -> str:
+    if kind == "json":
+        return _fit_json(value, max_tokens)
+    if kind == "csv":
+        return _fit_csv(value, max_tokens, sort_by)
+    return _fit_text(value, max_tokens)
+
+
+def _section_limit(name: str, default: int) -> int:
+    return int(os.getenv(f"PROMPT_BUDGET_{name.upper()}", str(default)))
+
+
+def build_prompt_sections(values: dict, budget: int = None) -> tuple:
+    """
+    Bereitet die Datenabschnitte eines Prompts token-budgetiert auf.
+    `values` bildet Abschnittsnamen aus PROMPT_SECTIONS auf Rohdaten ab (dict für JSON, sonst Text).
+    1. JSON wird kompakt serialisiert, jeder Abschnitt auf sein eigenes Maximum gekürzt.
+    2. Überschreitet die Summe das Gesamtbudget, werden Abschnitte von der niedrigsten Priorität
+       an weiter gekürzt (nicht unter PROMPT_SECTION_MIN_TOKENS).
+    Gibt (abschnitte, bericht) zurück; der Bericht enthält die Tokenanzahl pro Abschnitt vor und nach dem Kürzen.
+    """
+    budget = budget or PROMPT_TOKEN_BUDGET
+    sections, report = {}, {"budget": budget, "sections": {}}
+    for name, value in values.items():
+        kind, _, max_tokens, sort_by = PROMPT_SECTIONS[name]
+        # Referenz für den Bericht: die bisherige Darstellung (JSON mit indent=2)
+        raw_text = json.dumps(value, indent=2, ensure_ascii=False, default=str) if kind == "json" else (value or "")
+        sections[name] = _fit_section(kind, value if kind == "json" else raw_text, _section_limit(name, max_tokens), sort_by)
+        report["sections"][name] = {"raw_tokens": count_tokens(raw_text), "tokens": count_tokens(sections[name])}
+
+    overflow = sum(item["tokens"] for item in report["sections"].values()) - budget
+    for name in sorted(sections, key=lambda section: PROMPT_SECTIONS[section][1], reverse=True):
+        if overflow <= 0:
+            break
+        kind, _, _, sort_by = PROMPT_SECTIONS[name]
+        current = report["sections"][name]["tokens"]
+        target = max(PROMPT_SECTION_MIN_TOKENS, current - overflow)
+        if target >= current:
+            continue
+        sections[name] = _fit_section(kind, values[name] if kind == "json" else (values[name] or ""), target, sort_by)
+        report["sections"][name]["tokens"] = count_tokens(sections[name])
+        overflow -= current - report["sections"][name]["tokens"]
+
+    report["total_tokens"] = sum(item["tokens"] for item in report["sections"].values())
+    report["tokenizer"] = "tiktoken" if _get_encoding() is not None else "heuristic"
+    return sections, report
+
+
+def format_token_report(report: dict) -> str:
+    """
+    Einzeilige Darstellung des Token-Berichts für Log und UI.
+    """
+    parts = ", ".join(
+        f"{name} {item['tokens']}" + (f"/{item['raw_tokens']}" if item["tokens"] != item["raw_tokens"] else "")
+        for name, item in report["sections"].items()
+    )
+    return f"Prompt-Tokens ({report['tokenizer']}): {parts} | gesamt {report['total_tokens']} von {report['budget']}"
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import threading
+from string import Formatter
+
+PROMPT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "prompts")
+
+# Vorlage -> (Datei, erwartete Platzhalter). None = Text wird unverändert verwendet (enthält z.B. JSON-Beispiele
+# mit geschweiften Klammern); sonst müssen die Platzhalter der Datei exakt diesen Kontext-Keys entsprechen.
+PROMPT_TEMPLATES = {
+    "system_initial": ("system_prompt_initial.txt", None),
+    "system_follow_up": ("system_prompt_follow_up.txt", None),
+    "user_initial": ("user_content_init.txt", {
+        "detailed_data_summary_dict", "global_agg_country_pm_csv", "global_agg_country_csv",
+        "global_agg_pm_csv", "statistical_anomalies_csv", "all_write_offs_csv",
+    }),
+    "user_follow_up": ("user_content.txt", {
+        "data_summary_json", "agg_country_payment_csv", "statistical_anomalies_csv",
+        "all_write_offs_csv", "prev_insights_summary", "follow_up_question",
+    }),
+    "review_system": ("review_system_prompt.txt", None),
+    "review_user": ("review_user_prompt_content.txt", {
+        "detailed_data_summary_dict", "global_agg_country_pm_csv", "global_agg_country_csv",
+        "global_agg_pm_csv", "statistical_anomalies_csv", "all_write_offs_gt_0",
+    }),
+    "review_delta_system": ("review_delta_system_prompt.txt", None),
+    "review_delta_user": ("review_delta_user_prompt.txt", {"num_checked", "num_disputed", "disputed_items_json"}),
+    "system_comparison": ("system_prompt_comparison.txt", None),
+    "user_comparison": ("user_content_comparison.txt", {
+        "reference_source", "comparison_sources_json", "comparison_totals_csv", "delta_total_csv",
+        "delta_country_csv", "delta_pm_csv", "delta_country_pm_csv",
+    }),
+}
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class PromptTemplate:
+    """
+    Eine geladene Prompt-Vorlage. Der Text wird beim Laden einmal zerlegt (Formatter.parse),
+    sodass render() nur noch die Teile zusammensetzt. `version` ist ein kurzer Hash des Dateiinhalts.
+    """
+
+    def __init__(self, name: str, text: str, expected_fields: set = None, mtime: float = None):
+        self.name = name
+        self.text = text
+        self.mtime = mtime
+        self.version = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+        self.parts = None
+        if expected_fields is None:
+            return
+
+        self.parts = []
+        for literal, field, format_spec, conversion in Formatter().parse(text):
+            if field is not None and (format_spec or conversion or not field.isidentifier()):
+                raise ValueError(f"Prompt-Vorlage '{name}': nicht unterstützter Platzhalter '{{{field}}}'.")
+            self.parts.append((literal, field))
+        fields = {field for _, field in self.parts if field is not None}
+        if fields != set(expected_fields):
+            missing = ", ".join(sorted(set(expected_fields) - fields)) or "-"
+            unknown = ", ".join(sorted(fields - set(expected_fields))) or "-"
+            raise ValueError(f"Prompt-Vorlage '{name}': Platzhalter passen nicht (fehlend: {missing}; unbekannt: {unknown}).")
+
+    def render(self, **context) -> str:
+        if self.parts is None:
+            return self.text
+        missing = [field for _, field in self.parts if field is not None and field not in context]
+        if missing:
+            raise KeyError(f"Prompt-Vorlage '{self.name}': Kontext ohne {', '.join(sorted(set(missing)))}.")
+        return "".join(literal + (str(context[field]) if field is not None else "") for literal, field in self.parts)
+
+
+def _load_template(name: str) -> PromptTemplate:
+    filename, expected_fields = PROMPT_TEMPLATES[name]
+    path = os.path.join(PROMPT_DIR, filename)
+    mtime = os.stat(path).st_mtime
+    with open(path, "r", encoding="utf-8") as f:
+        return PromptTemplate(name, f.read(), expected_fields, mtime)
+
+
+def get_prompt_template(name: str) -> PromptTemplate:
+    """
+    Gibt die geladene Vorlage zurück. Die Datei wird nur neu gelesen, wenn sich ihr Änderungszeitpunkt
+    geändert hat; sonst kostet ein Aufruf einen einzelnen stat().
+    """
+    path = os.path.join(PROMPT_DIR, PROMPT_TEMPLATES[name][0])
+    with _registry_lock:
+        template = _registry.get(name)
+        if template is None or os.stat(path).st_mtime != template.mtime:
+            template = _load_template(name)
+            _registry[name] = template
+        return template
+
+
+def load_prompt_templates() -> dict:
+    """
+    Lädt und validiert alle Vorlagen (beim Start aufrufen, damit fehlerhafte Platzhalter sofort auffallen).
+    Gibt Vorlage -> Version zurück.
+    """
+    return {name: get_prompt_template(name).version for name in PROMPT_TEMPLATES}
+
+
+def render_prompt(name: str, **context) -> tuple:
+    """
+    Füllt eine Vorlage mit dem Kontext. Gibt (text, version) zurück.
+    """
+    template = get_prompt_template(name)
+    return template.render(**context), template.version
+
+
+def combined_prompt_version(versions: dict) -> str:
+    """
+    Fasst die Versionen mehrerer Vorlagen zu einem Hash zusammen (z.B. für Cache-Schlüssel und gespeicherte Insights).
+    """
+    payload = "|".join(f"{name}={version}" for name, version in sorted(versions.items()))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:12]
@@ -0,0 +1,118 @@
+import hashlib
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+# Anzahl zwischengespeicherter Stufenergebnisse (über alle DataFrames hinweg)
+STAGE_CACHE_MAX_ENTRIES = int(os.getenv("STAGE_CACHE_MAX_ENTRIES", "32"))
+# Obergrenze für den geschätzten Speicherbedarf aller Stufenergebnisse (z.B. DataFrames mit KPIs großer Exporte)
+STAGE_CACHE_MAX_BYTES = int(os.getenv("STAGE_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+_stage_results = OrderedDict()
+# Schlüssel -> geschätzte Größe des Ergebnisses in Bytes
+_stage_sizes = {}
+_stage_stats = {"hits": 0, "misses": 0, "by_stage": {}}
+# Schützt Cache und Zähler, da Stufen gleichzeitig in Worker-Threads laufen (core/pipeline.py)
+_stage_lock = threading.Lock()
+
+
+def dataframe_fingerprint(df: pd.DataFrame) -> str:
+    """
+    Berechnet einen inhaltsbasierten Fingerabdruck eines DataFrames
+    (Werte, Index, Spaltennamen und Datentypen).
+    """
+    hasher = hashlib.sha256()
+    hasher.update(repr([(str(col), str(dtype)) for col, dtype in df.dtypes.items()]).encode("utf-8"))
+    try:
+        row_hashes = pd.util.hash_pandas_object(df, index=True).to_numpy()
+        hasher.update(row_hashes.tobytes())
+    except TypeError:
+        # Nicht hashbare Zellwerte (z.B. Listen) -> langsamer, aber sicherer Fallback
+        hasher.update(pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL))
+    return hasher.hexdigest()
+
+
+def _stage_key(stage_name: str, fingerprint: str, params: dict = None) -> tuple:
+    return (stage_name, fingerprint, tuple(sorted((params or {}).items())))
+
+
+def _result_nbytes(result) -> int:
+    """
+    Schätzt den Speicherbedarf eines Stufenergebnisses (DataFrames inklusive Textwerten).
+    """
+    if isinstance(result, pd.DataFrame):
+        return int(result.memory_usage(deep=True, index=True).sum())
+    if isinstance(result, pd.Series):
+        return int(result.memory_usage(deep=True, index=True))
+    if isinstance(result, dict):
+        return sys.getsizeof(result) + sum(_result_nbytes(key) + _result_nbytes(value) for key, value in result.items())
+    if isinstance(result, (list, tuple, set)):
+        return sys.getsizeof(result) + sum(_result_nbytes(item) for item in result)
+    return int(getattr(result, "nbytes", 0)) or sys.getsizeof(result)
+
+
+def _count(stage_name: str, outcome: str):
+    _stage_stats[outcome] += 1
+    stage_stats = _stage_stats["by_stage"].setdefault(stage_name, {"hits": 0, "misses": 0})
+    stage_stats[outcome] += 1
+
+
+def run_cached_stage(stage_name: str, fingerprint: str, compute_fn, params: dict = None):
+    """
+    Führt eine Pipeline-Stufe aus oder gibt deren zwischengespeichertes Ergebnis zurück.
+    Der Cache-Schlüssel besteht aus Stufenname, DataFrame-Fingerabdruck und Stufenparametern (z.B. n).
+    Die Ergebnisse werden geteilt und dürfen von Aufrufern nicht verändert werden. Verdrängt wird
+    nach LRU, sobald STAGE_CACHE_MAX_ENTRIES Einträge oder STAGE_CACHE_MAX_BYTES überschritten sind.
+    """
+    key = _stage_key(stage_name, fingerprint, params)
+    with _stage_lock:
+        if key in _stage_results:
+            _stage_results.move_to_end(key)
+            _count(stage_name, "hits")
+            return _stage_results[key]
+        _count(stage_name, "misses")
+
+    # Berechnung außerhalb der Sperre, damit unabhängige Stufen parallel laufen
+    result = compute_fn()
+    size = _result_nbytes(result)
+    if size > STAGE_CACHE_MAX_BYTES:
+        # Passt allein nicht ins Budget: nicht cachen, statt alle anderen Einträge zu verdrängen
+        return result
+    with _stage_lock:
+        _stage_results[key] = result
+        _stage_sizes[key] = size
+        while len(_stage_results) > STAGE_CACHE_MAX_ENTRIES or sum(_stage_sizes.values()) > STAGE_CACHE_MAX_BYTES:
+            evicted, _ = _stage_results.popitem(last=False)
+            _stage_sizes.pop(evicted, None)
+    return result
+
+
+def get_stage_cache_stats() -> dict:
+    """
+    Gibt die Treffer-/Fehlzähler des Stufen-Caches zurück (gesamt und pro Stufe).
+    """
+    with _stage_lock:
+        return {
+            "hits": _stage_stats["hits"],
+            "misses": _stage_stats["misses"],
+            "entries": len(_stage_results),
+            "bytes": sum(_stage_sizes.values()),
+            "by_stage": {name: dict(counts) for name, counts in _stage_stats["by_stage"].items()},
+        }
+
+
+def clear_stage_cache(reset_stats: bool = False):
+    """
+    Leert den Stufen-Cache und setzt auf Wunsch die Zähler zurück.
+    """
+    with _stage_lock:
+        _stage_results.clear()
+        _stage_sizes.clear()
+        if reset_stats:
+            _stage_stats["hits"] = 0
+            _stage_stats["misses"] = 0
+            _stage_stats["by_stage"] = {}
@@ -0,0 +1,383 @@
+import io
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from services.utils import add_calculated_kpis_to_df, aggregate_finest_grain, rollup_grouping_sets, \
+                           get_top_n_anomalies, is_categorical_like, select_extreme_positions, \
+                           statistical_anomalies_from_cells, AGGREGATION_MEASURES, ANOMALY_SORT_COLUMNS, ANOMALY_CELL_GROUPING
+from services.fact_check import FACT_CHECK_CELL_GROUPING, FACT_CHECK_MEASURES
+from services.loader import compute_stream_content_hash, sniff_csv_delimiter
+from services.sketches import hash_values, hyperloglog_registers, hyperloglog_estimate
+
+# CSV-Dateien oberhalb dieser Größe werden im Streaming-Modus verarbeitet
+CSV_STREAMING_THRESHOLD_MB = int(os.getenv("CSV_STREAMING_THRESHOLD_MB", "200"))
+# Zeilen pro Chunk beim Einlesen
+CSV_CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", "200000"))
+# Größe der Stichprobe, aus der die Quartile im Streaming-Modus geschätzt werden
+QUANTILE_SAMPLE_SIZE = 10000
+PREVIEW_ROWS = 100
+# Maximale Anzahl exakt gezählter Werte je kategorischer Spalte; darüber Misra-Gries und HyperLogLog
+STREAMING_CATEGORY_CAPACITY = int(os.getenv("STREAMING_CATEGORY_CAPACITY", "1000"))
+# HyperLogLog-Präzision der Kardinalitätsschätzung (2**12 Register, ca. 1.6 % Standardfehler)
+STREAMING_HLL_PRECISION = 12
+
+
+class NumericColumnAccumulator:
+    """
+    Inkrementelle Kennzahlen einer numerischen Spalte (count, mean, std, min, max)
+    nach dem parallelen Algorithmus von Chan et al. Quartile werden aus einer
+    gleichverteilten Stichprobe fester Größe geschätzt. Zwei Akkumulatoren lassen sich mergen.
+    """
+
+    def __init__(self, sample_size: int = QUANTILE_SAMPLE_SIZE, seed: int = 123):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.nan
+        self.max = np.nan
+        self.sample_size = sample_size
+        self.sample = np.empty(0, dtype="float64")
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, values):
+        values = np.asarray(values, dtype="float64")
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return
+        other = NumericColumnAccumulator(self.sample_size)
+        other.count = values.size
+        other.mean = float(values.mean())
+        other.m2 = float(((values - other.mean) ** 2).sum())
+        other.min = float(values.min())
+        other.max = float(values.max())
+        if values.size > self.sample_size:
+            values = self._rng.choice(values, self.sample_size, replace=False)
+        other.sample = values
+        self.merge(other)
+
+    def merge(self, other: "NumericColumnAccumulator"):
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.min, self.max, self.sample = other.min, other.max, other.sample
+            return
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / total
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        # Gleichverteilte Stichprobe der Vereinigung: Anteil aus jeder Seite hypergeometrisch ziehen
+        target = min(self.sample_size, total)
+        from_self = self._rng.hypergeometric(self.count, other.count, target)
+        self.sample = np.concatenate([
+            self._rng.choice(self.sample, min(from_self, self.sample.size), replace=False),
+            self._rng.choice(other.sample, min(target - from_self, other.sample.size), replace=False),
+        ])
+        self.count = total
+
+    def to_describe_dict(self) -> dict:
+        """
+        Gibt die Kennzahlen im Format von Series.describe() zurück (JSON-serialisierbar).
+        """
+        if self.count == 0:
+            return {"count": 0.0, "mean": None, "std": None, "min": None, "25%": None, "50%": None, "75%": None, "max": None}
+        std = np.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else None
+        q25, q50, q75 = np.quantile(self.sample, [0.25, 0.5, 0.75])
+        desc = {
+            "count": self.count, "mean": self.mean, "std": std, "min": self.min,
+            "25%": q25, "50%": q50, "75%": q75, "max": self.max,
+        }
+        # Gleiche Rundung wie in get_basic_dataframe_summary
+        return {k: (round(float(v), 2) if v is not None else None) for k, v in desc.items()}
+
+
+class CategoricalColumnAccumulator:
+    """
+    Inkrementelle Häufigkeiten einer kategorischen Spalte sowie die ersten eindeutigen Werte
+    in Reihenfolge ihres Auftretens (für die Stichprobe im Daten-Summary).
+    Gezählt wird exakt, solange die Spalte höchstens `capacity` verschiedene Werte hat; danach bleiben
+    nur die häufigsten Zähler (Misra-Gries, Untergrenzen) und die Anzahl eindeutiger Werte wird per
+    HyperLogLog geschätzt. Der Speicherbedarf ist so unabhängig von der Kardinalität der Spalte.
+    """
+
+    def __init__(self, sample_limit: int = 10, capacity: int = None):
+        self.counts = {}
+        self.has_missing = False
+        self.sample_limit = sample_limit
+        self.capacity = capacity or STREAMING_CATEGORY_CAPACITY
+        self.first_seen = []
+        self.approximate = False
+        self.registers = None
+
+    def _add_counts(self, counts: dict, registers: np.ndarray):
+        for value, count in counts.items():
+            self.counts[value] = self.counts.get(value, 0) + count
+        self.registers = registers if self.registers is None else np.maximum(self.registers, registers)
+        if len(self.counts) > self.capacity:
+            # Misra-Gries: den (capacity + 1)-größten Zähler von allen abziehen, nicht positive verwerfen
+            threshold = sorted(self.counts.values(), reverse=True)[self.capacity]
+            self.counts = {value: count - threshold for value, count in self.counts.items() if count > threshold}
+            self.approximate = True
+
+    def update(self, series: pd.Series):
+        value_counts = series.value_counts(dropna=True)
+        # Eindeutige Werte des Chunks genügen für HyperLogLog
+        registers = hyperloglog_registers(
+            hash_values(pd.Series(value_counts.index, dtype=series.dtype)), STREAMING_HLL_PRECISION
+        )
+        self._add_counts({value: int(count) for value, count in value_counts.items()}, registers)
+        self.has_missing = self.has_missing or bool(series.isna().any())
+        if len(self.first_seen) <= self.sample_limit:
+            seen = set(self.first_seen)
+            for value in pd.unique(series):
+                if len(self.first_seen) > self.sample_limit:
+                    break
+                key = "nan" if pd.isna(value) else value
+                if key not in seen:
+                    seen.add(key)
+                    self.first_seen.append(key)
+
+    def merge(self, other: "CategoricalColumnAccumulator"):
+        if other.registers is not None:
+            self._add_counts(other.counts, other.registers)
+        self.approximate = self.approximate or other.approximate
+        self.has_missing = self.has_missing or other.has_missing
+        for value in other.first_seen:
+            if len(self.first_seen) > self.sample_limit:
+                break
+            if value not in self.first_seen:
+                self.first_seen.append(value)
+
+    def to_summary_dict(self) -> dict:
+        unique_values_list = [
+            value.isoformat() if isinstance(value, pd.Timestamp) else str(value)
+            for value in self.first_seen[:self.sample_limit]
+        ]
+        unique_count = hyperloglog_estimate(self.registers) if self.approximate else len(self.counts)
+        if unique_count + int(self.has_missing) > self.sample_limit:
+            unique_values_list.append('...')
+        top_values = pd.Series(self.counts, dtype="int64").nlargest(5) if self.counts else pd.Series(dtype="int64")
+        summary = {
+            "unique_count": unique_count,
+            "top_values": {
+                str(k.isoformat() if isinstance(k, pd.Timestamp) else k): int(v) for k, v in top_values.items()
+            },
+            "unique_sample": unique_values_list,
+        }
+        if self.approximate:
+            summary["approximate"] = True
+        return summary
+
+
+class StreamingSummary:
+    """
+    Baut das Daten-Summary (Format wie get_basic_dataframe_summary) chunkweise auf.
+    """
+
+    def __init__(self):
+        self.num_rows = 0
+        self.column_names = None
+        self.column_dtypes = None
+        self.numeric = {}
+        self.categorical = {}
+
+    def update(self, df: pd.DataFrame):
+        if self.column_names is None:
+            self.column_names = df.columns.tolist()
+            self.column_dtypes = {col: str(df[col].dtype) for col in df.columns}
+        self.num_rows += len(df)
+        for col in df.columns:
+            if pd.api.types.is_numeric_dtype(df[col]):
+                self.numeric.setdefault(col, NumericColumnAccumulator()).update(df[col].to_numpy(dtype="float64", na_value=np.nan))
+            elif is_categorical_like(df[col]):
+                self.categorical.setdefault(col, CategoricalColumnAccumulator()).update(df[col])
+
+    def merge(self, other: "StreamingSummary"):
+        if other.column_names is None:
+            return
+        if self.column_names is None:
+            self.column_names, self.column_dtypes = list(other.column_names), dict(other.column_dtypes)
+        self.num_rows += other.num_rows
+        for col, acc in other.numeric.items():
+            self.numeric.setdefault(col, NumericColumnAccumulator()).merge(acc)
+        for col, acc in other.categorical.items():
+            self.categorical.setdefault(col, CategoricalColumnAccumulator()).merge(acc)
+
+    def to_summary_dict(self) -> dict:
+        column_names = self.column_names or []
+        return {
+            "num_rows": self.num_rows,
+            "num_cols": len(column_names),
+            "column_names": column_names,
+            "column_dtypes": self.column_dtypes or {},
+            "numerical_summary": {col: acc.to_describe_dict() for col, acc in self.numeric.items()},
+            "categorical_summary": {col: acc.to_summary_dict() for col, acc in self.categorical.items()},
+        }
+
+
+class StreamingAggregator:
+    """
+    Hält die Summenkennzahlen auf der feinsten Aggregationsebene und merged sie chunkweise.
+    Das Zwischenergebnis bleibt so klein wie die Anzahl der Dimensionskombinationen.
+    """
+
+    def __init__(self, grouping_sets: dict = None, measures: dict = None):
+        self.grouping_sets = grouping_sets
+        self.measures = measures or AGGREGATION_MEASURES
+        self.finest_agg = None
+
+    def update(self, df_with_kpis: pd.DataFrame):
+        self.merge_finest(aggregate_finest_grain(df_with_kpis, grouping_sets=self.grouping_sets, measures=self.measures))
+
+    def merge_finest(self, chunk_agg: pd.DataFrame):
+        """
+        Addiert eine bereits auf der feinsten Ebene aggregierte Tabelle (z.B. eines anderen Akkumulators).
+        """
+        if chunk_agg is None:
+            return
+        if self.finest_agg is None:
+            self.finest_agg = chunk_agg
+            return
+        self.finest_agg = pd.concat([self.finest_agg, chunk_agg], ignore_index=True)
+        self.regroup()
+
+    def regroup(self):
+        """
+        Fasst mehrfach vorkommende Dimensionskombinationen der feinsten Ebene zusammen.
+        """
+        dims = [col for col in self.finest_agg.columns if col not in self.measures]
+        self.finest_agg = self.finest_agg.groupby(
+            dims, dropna=False, observed=True, sort=False
+        )[list(self.measures)].sum().reset_index()
+
+    def to_aggregations_dict(self) -> dict:
+        if self.finest_agg is None:
+            return {}
+        return {key: rolled.to_csv(index=False) for key, rolled in rollup_grouping_sets(self.finest_agg).items()}
+
+
+def select_anomaly_candidates(df_with_kpis: pd.DataFrame, n: int) -> pd.DataFrame:
+    """
+    Reduziert einen DataFrame auf alle Zeilen, die in einer der Anomalie-Tabellen von
+    get_top_n_anomalies landen können: höchstens n Zeilen je KPI (Gleichstände wie dort nach
+    Zeilenposition aufgelöst) sowie alle Write-Offs > 0. Die ursprüngliche Zeilenreihenfolge (Index)
+    bleibt erhalten, sodass die Auflösung von Gleichständen über Chunks hinweg gleich bleibt.
+    """
+    keep = (df_with_kpis['EUR Write-Offs'] > 0).to_numpy(copy=True)
+    for col, is_largest in ANOMALY_SORT_COLUMNS.items():
+        if col in df_with_kpis.columns and pd.api.types.is_numeric_dtype(df_with_kpis[col]):
+            values = df_with_kpis[col].to_numpy(dtype="float64", na_value=np.nan)
+            keep[select_extreme_positions(values, n, is_largest)] = True
+    return df_with_kpis[keep]
+
+
+class StreamingAnomalyCandidates:
+    """
+    Führt die Kandidatenzeilen für die Top-N-Anomalien über alle Chunks mit,
+    ohne mehr als die Kandidaten selbst im Speicher zu halten.
+    """
+
+    def __init__(self, n: int):
+        self.n = n
+        self.candidates = None
+
+    def update(self, df_with_kpis: pd.DataFrame):
+        self.merge_candidates(select_anomaly_candidates(df_with_kpis, self.n))
+
+    def merge_candidates(self, chunk_candidates: pd.DataFrame):
+        if chunk_candidates is None:
+            return
+        if self.candidates is not None:
+            chunk_candidates = select_anomaly_candidates(pd.concat([self.candidates, chunk_candidates]), self.n)
+        self.candidates = chunk_candidates
+
+    def to_anomalies_dict(self) -> dict:
+        if self.candidates is None:
+            return {"n": self.n}
+        return get_top_n_anomalies(self.candidates, n=self.n)
+
+
+def analyze_csv_in_chunks(source, delimiter: str, n: int = 7, chunk_rows: int = None) -> dict:
+    """
+    Liest eine CSV-Datei in Chunks begrenzter Größe und berechnet dabei inkrementell
+    Daten-Summary, Aggregationen, Top-N- und statistische Anomalien. Der Speicherbedarf hängt nur von der
+    Chunk-Größe und der Anzahl der Dimensionskombinationen ab, nicht von der Dateigröße.
+    Gibt die Stufenergebnisse (wie in perform_llm_analysis) plus eine Vorschau der ersten Zeilen zurück.
+    """
+    summary = StreamingSummary()
+    aggregator = StreamingAggregator()
+    anomaly_candidates = StreamingAnomalyCandidates(n)
+    # Zellen Land × Zahlungsmethode × Monat für die statistische Anomalieerkennung
+    cell_aggregator = StreamingAggregator(grouping_sets=ANOMALY_CELL_GROUPING)
+    # Summen aller Quellspalten pro Zelle für die lokale Prüfung zitierter Datenpunkte
+    fact_check_aggregator = StreamingAggregator(grouping_sets=FACT_CHECK_CELL_GROUPING, measures=FACT_CHECK_MEASURES)
+    preview = None
+    num_chunks = 0
+
+    for chunk in pd.read_csv(source, sep=delimiter, chunksize=chunk_rows or CSV_CHUNK_ROWS):
+        if preview is None:
+            preview = chunk.head(PREVIEW_ROWS)
+        chunk_with_kpis = add_calculated_kpis_to_df(chunk)
+        summary.update(chunk_with_kpis)
+        aggregator.update(chunk_with_kpis)
+        anomaly_candidates.update(chunk_with_kpis)
+        cell_aggregator.update(chunk_with_kpis)
+        fact_check_aggregator.update(chunk_with_kpis)
+        num_chunks += 1
+
+    summary_dict = summary.to_summary_dict()
+    summary_dict["streaming"] = {"chunks": num_chunks, "quantiles_approximate": True}
+    return {
+        "summary": summary_dict,
+        "aggregations": aggregator.to_aggregations_dict(),
+        "anomalies": anomaly_candidates.to_anomalies_dict(),
+        "statistical_anomalies": (
+            statistical_anomalies_from_cells(cell_aggregator.finest_agg)
+            if cell_aggregator.finest_agg is not None else {}
+        ),
+        "fact_check_cells": fact_check_aggregator.finest_agg,
+        "preview": preview if preview is not None else pd.DataFrame(),
+    }
+
+
+def _sniff_stream_delimiter(stream) -> str:
+    stream.seek(0)
+    delimiter = sniff_csv_delimiter(stream.read(2048))
+    stream.seek(0)
+    return delimiter
+
+
+def read_csv_preview(stream) -> pd.DataFrame:
+    """
+    Liest nur die ersten PREVIEW_ROWS Zeilen einer hochgeladenen CSV-Datei (Dateiobjekt).
+    """
+    return pd.read_csv(stream, sep=_sniff_stream_delimiter(stream), nrows=PREVIEW_ROWS)
+
+
+_streamed_stages = OrderedDict()
+STREAMED_STAGES_MAX_ENTRIES = 2
+
+
+def analyze_csv_stream_in_chunks(stream, content_hash: str = None, n: int = 7, chunk_rows: int = None) -> dict:
+    """
+    Wie analyze_csv_in_chunks für eine hochgeladene Datei, die direkt aus dem Dateiobjekt gelesen wird
+    (ohne die Bytes vorher zu kopieren). Ergebnisse werden über den Inhalts-Hash gecached, damit
+    Streamlit-Reruns die Datei nicht erneut streamen.
+    """
+    content_hash = content_hash or compute_stream_content_hash(stream)
+    delimiter = _sniff_stream_delimiter(stream)
+    key = (content_hash, delimiter, n)
+    if key in _streamed_stages:
+        _streamed_stages.move_to_end(key)
+        return _streamed_stages[key]
+
+    stages = analyze_csv_in_chunks(stream, delimiter, n=n, chunk_rows=chunk_rows)
+    _streamed_stages[key] = stages
+    while len(_streamed_stages) > STREAMED_STAGES_MAX_ENTRIES:
+        _streamed_stages.popitem(last=False)
+    return stages
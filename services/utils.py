@@ -1,25 +1,315 @@
+import json
 import re
+import warnings
 import pandas as pd
 import numpy as np
 
+
+try:
+    import orjson
+except ImportError:  # optional; ohne orjson wird die Standardbibliothek verwendet
+    orjson = None
+
+# Tokens des JSON-Scanners innerhalb eines Objekts: ganze Strings (inkl. Escape-Sequenzen) in einem Schritt,
+# Klammern einzeln; ein einzelnes " ist ein nicht geschlossener String (abgeschnittene Antwort)
+_JSON_SCAN_TOKENS = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}"]')
+_JSON_FENCE = re.compile(r"```json\s*")
+_JSON_DECODER = json.JSONDecoder()
+# Fehlversuche des schnellen Pfads (gültiges JSON an einem "{"), bevor der Klammer-Scanner übernimmt
+JSON_DECODE_MAX_ATTEMPTS = 4
+
+
+def loads_json(text):
+    """
+    Parst JSON mit orjson, falls installiert, sonst mit json.loads.
+    Fehler sind in beiden Fällen json.JSONDecodeError (orjson.JSONDecodeError ist davon abgeleitet).
+    """
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def _outermost_spans(spans: list) -> list:
+    """
+    Filtert (anfang, ende)-Paare korrekt verschachtelter Objekte (in Reihenfolge ihres Schließens)
+    auf die nicht in einem anderen enthaltenen, aufsteigend nach Anfang.
+    """
+    outermost = []
+    for span in reversed(spans):
+        # Ein später geschlossenes Objekt mit kleinerem Anfang enthält alle danach beginnenden
+        if not outermost or span[0] < outermost[-1][0]:
+            outermost.append(span)
+    return outermost[::-1]
+
+
+def _scan_json_objects(text: str, start: int = 0):
+    """
+    Liefert (anfang, ende) jedes vollständigen Objekts auf oberster Ebene ab `start` in einem Durchlauf.
+    Klammern innerhalb von Strings zählen nicht; außerhalb von Objekten wird nur nach "{" gesucht
+    (Anführungszeichen im Fließtext stören nicht). Wird ein Objekt nie geschlossen (einzelnes "{" im
+    Fließtext oder abgeschnittene Antwort), gelten die darin vollständig geschlossenen Objekte als oberste
+    Ebene – wie bei einem Neustart am nächsten "{", aber ohne den Rest des Textes erneut zu lesen.
+    """
+    begin = text.find("{", start)
+    while begin != -1:
+        openers, closed = [], []
+        match = _JSON_SCAN_TOKENS.search(text, begin)
+        while match is not None:
+            char = text[match.start()]
+            if char == "{":
+                openers.append(match.start())
+            elif char == "}":
+                opened = openers.pop()
+                if not openers:
+                    break
+                closed.append((opened, match.end()))
+            elif match.end() - match.start() == 1:
+                match = None
+                break
+            match = _JSON_SCAN_TOKENS.search(text, match.end())
+        if match is None:
+            yield from _outermost_spans(closed)
+            return
+        yield begin, match.end()
+        begin = text.find("{", match.end())
+
+
+def _decode_json_objects(text: str, start: int = 0):
+    """
+    Schneller Pfad: versucht an jedem "{" ab `start` ein gültiges JSON-Objekt zu dekodieren (C-Parser)
+    und liefert (anfang, ende) der gefundenen Objekte auf oberster Ebene. Nach mehr als
+    JSON_DECODE_MAX_ATTEMPTS Fehlversuchen wird abgebrochen (Rückgabe None), da jeder Versuch bis ans
+    Textende lesen kann; dann übernimmt der lineare Scanner.
+    """
+    spans, failures = [], 0
+    begin = text.find("{", start)
+    while begin != -1:
+        try:
+            obj, end = _JSON_DECODER.raw_decode(text, begin)
+        except ValueError:
+            failures += 1
+            if failures > JSON_DECODE_MAX_ATTEMPTS:
+                return None
+            begin = text.find("{", begin + 1)
+            continue
+        if isinstance(obj, dict):
+            spans.append((begin, end))
+        begin = text.find("{", end)
+    return spans
+
+
 def extract_json_from_string(text):
     """
     Extrahiert einen JSON-Block aus einem gegebenen String.
     Nützlich, wenn das LLM zusätzlichen Text um das JSON herum ausgibt.
+    Bevorzugt wird das erste vollständige Objekt nach einem ```json-Block, sonst das längste Objekt auf
+    oberster Ebene (statt Klammerpaaren aus dem Fließtext). Gültiges JSON wird direkt mit dem C-Parser
+    erkannt; erst wenn das nicht gelingt (z.B. abgeschnittene Antwort), zählt der lineare Scanner Klammern.
     Gibt den JSON-String zurück oder None, falls kein JSON gefunden wurde.
     """
-    match = re.search(r"```json\s*(\{.*?})\s*```", text, re.DOTALL)
-    if match:
-        return match.group(1)
-    match = re.search(r"(\{.*?})", text, re.DOTALL)
-    if match:
-        return match.group(1)
-    return None
+    if not text:
+        return None
+    fence = _JSON_FENCE.search(text)
+    if fence:
+        spans = _decode_json_objects(text, fence.end())
+        if spans:
+            begin, end = spans[0]
+            return text[begin:end]
+        for begin, end in _scan_json_objects(text, fence.end()):
+            return text[begin:end]
+    spans = _decode_json_objects(text) or list(_scan_json_objects(text))
+    if not spans:
+        return None
+    begin, end = max(spans, key=lambda span: span[1] - span[0])
+    return text[begin:end]
+
+
+# Erwartete Felder einer Erkenntnis (siehe Ausgabeformat in prompts/system_prompt_initial.txt)
+INSIGHT_TEXT_FIELDS = [
+    "insight_id", "title", "type", "description", "affected_area", "period",
+    "quantitative_impact", "confidence_level",
+]
+INSIGHT_LIST_FIELDS = ["supporting_data_points"]
+
+
+def validate_insight_results(results) -> list:
+    """
+    Prüft eine geparste LLM-Antwort gegen das Insight-Schema und bereinigt sie in place:
+    Einträge in "insights", die keine Objekte sind, werden entfernt, fehlende insight_ids ergänzt.
+    Gibt die Liste der Abweichungen zurück (leer, wenn die Antwort dem Schema entspricht).
+    Ist die Antwort kein Objekt oder "insights" keine Liste, ist sie nicht verwendbar (ValueError).
+    """
+    if not isinstance(results, dict):
+        raise ValueError("Die LLM-Antwort ist kein JSON-Objekt.")
+    insights = results.get("insights")
+    if not isinstance(insights, list):
+        raise ValueError("Die LLM-Antwort enthält keine Liste 'insights'.")
+
+    problems = []
+    valid_insights = []
+    for index, insight in enumerate(insights):
+        if not isinstance(insight, dict):
+            problems.append(f"insights[{index}]: kein Objekt, verworfen")
+            continue
+        insight.setdefault("insight_id", f"insight_{index + 1}")
+        missing = [field for field in INSIGHT_TEXT_FIELDS if field not in insight]
+        if missing:
+            problems.append(f"{insight['insight_id']}: fehlende Felder {', '.join(missing)}")
+        for field in INSIGHT_LIST_FIELDS:
+            if field in insight and not isinstance(insight[field], list):
+                problems.append(f"{insight['insight_id']}: '{field}' ist keine Liste")
+                insight[field] = [insight[field]]
+        valid_insights.append(insight)
+    results["insights"] = valid_insights
+    for field in ("overall_summary", "potential_next_questions"):
+        if field not in results:
+            problems.append(f"fehlendes Feld {field}")
+    return problems
+
+class IncrementalInsightParser:
+    """
+    Parst die JSON-Antwort des LLM, während sie tokenweise eintrifft.
+    feed() scannt nur den neu hinzugekommenen Text (Klammer- und String-bewusst) und gibt
+    jedes Objekt im Array "insights" zurück, sobald seine schließende Klammer empfangen wurde.
+    """
+
+    def __init__(self, array_key: str = "insights"):
+        self.array_key = array_key
+        self.buffer = ""
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.string_start = None
+        self.last_key = None
+        self.array_depth = None
+        self.object_start = None
+
+    def feed(self, text: str) -> list:
+        self.buffer += text or ""
+        completed = []
+        buffer = self.buffer
+        for i in range(self.position, len(buffer)):
+            char = buffer[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        self.last_key = buffer[self.string_start + 1:i]
+                continue
+            if char == '"':
+                self.in_string = True
+                self.string_start = i
+            elif char in "{[":
+                if char == "[" and self.depth == 1 and self.last_key == self.array_key and self.array_depth is None:
+                    self.array_depth = self.depth + 1
+                elif char == "{" and self.array_depth is not None and self.depth == self.array_depth:
+                    self.object_start = i
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if char == "}" and self.object_start is not None and self.depth == self.array_depth:
+                    try:
+                        completed.append(loads_json(buffer[self.object_start:i + 1]))
+                    except json.JSONDecodeError:
+                        pass
+                    self.object_start = None
+                elif char == "]" and self.array_depth is not None and self.depth == self.array_depth - 1:
+                    self.array_depth = -1  # Array abgeschlossen, keine weiteren Insights erwarten
+        self.position = len(buffer)
+        return completed
+
+
+# Anzahl Beispielwerte und Top-Werte pro kategorischer Spalte
+PROFILE_SAMPLE_SIZE = 10
+PROFILE_TOP_K = 5
+
+
+def is_categorical_like(series: pd.Series) -> bool:
+    """
+    True für Spalten, die im Daten-Summary kategorisch beschrieben werden (Text, object, category).
+    """
+    return (
+        pd.api.types.is_object_dtype(series)
+        or pd.api.types.is_string_dtype(series)
+        or isinstance(series.dtype, pd.CategoricalDtype)
+    )
+
+
+def _to_json_scalar(value):
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    return str(value)
+
+
+def _profile_numeric_columns(df: pd.DataFrame, numeric_cols: list) -> dict:
+    """
+    Berechnet die describe()-Kennzahlen aller numerischen Spalten in einem vektorisierten
+    Durchlauf über eine gemeinsame float64-Matrix.
+    """
+    values = np.column_stack([df[col].to_numpy(dtype="float64", na_value=np.nan) for col in numeric_cols])
+    with np.errstate(invalid="ignore", divide="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        stats = {
+            "count": np.count_nonzero(~np.isnan(values), axis=0).astype("float64"),
+            "mean": np.nanmean(values, axis=0),
+            "std": np.nanstd(values, axis=0, ddof=1),
+            "min": np.nanmin(values, axis=0),
+        }
+        q25, q50, q75 = np.nanquantile(values, [0.25, 0.5, 0.75], axis=0)
+        stats.update({"25%": q25, "50%": q50, "75%": q75, "max": np.nanmax(values, axis=0)})
+
+    numerical_summary = {}
+    for position, col in enumerate(numeric_cols):
+        # JSON-serialisierbare Werte, NaN -> None
+        numerical_summary[col] = {
+            stat: (None if np.isnan(col_values[position]) else round(float(col_values[position]), 2))
+            for stat, col_values in stats.items()
+        }
+    return numerical_summary
+
+
+def _profile_categorical_column(series: pd.Series) -> dict:
+    """
+    Kardinalität, Top-Werte und Beispielwerte einer Spalte aus einem einzigen Hash-Durchlauf (factorize).
+    """
+    codes, uniques = pd.factorize(series, sort=False)
+    valid_codes = codes[codes >= 0]
+    counts = np.bincount(valid_codes, minlength=len(uniques))
+
+    # Top-K per argpartition; bei Gleichstand gewinnt der zuerst aufgetretene Wert
+    top_k = min(PROFILE_TOP_K, len(uniques))
+    top_positions = np.argpartition(-counts, top_k - 1)[:top_k] if top_k else np.array([], dtype=int)
+    top_positions = top_positions[np.lexsort((top_positions, -counts[top_positions]))]
+    top_values = {_to_json_scalar(uniques[pos]): int(counts[pos]) for pos in top_positions}
+
+    # Beispielwerte in Reihenfolge des Auftretens, fehlende Werte an ihrer ersten Position als 'nan'
+    unique_values_list = [_to_json_scalar(value) for value in uniques[:PROFILE_SAMPLE_SIZE + 1]]
+    missing_positions = np.flatnonzero(codes < 0)
+    if missing_positions.size:
+        codes_before_missing = codes[:missing_positions[0]]
+        insert_at = int(codes_before_missing.max()) + 1 if codes_before_missing.size else 0
+        unique_values_list.insert(insert_at, "nan")
+    if len(unique_values_list) > PROFILE_SAMPLE_SIZE:
+        unique_values_list = unique_values_list[:PROFILE_SAMPLE_SIZE] + ['...']
+
+    return {
+        "unique_count": len(uniques),
+        "top_values": top_values,
+        "unique_sample": unique_values_list
+    }
+
 
 def get_basic_dataframe_summary(df):
     """
     Erstellt eine Zusammenfassung eines DataFrames mit Infos zu Zeilen, Spalten,
     Datentypen, numerischen und kategorischen Spalten.
+    Numerische Kennzahlen werden für alle Spalten gemeinsam berechnet, kategorische Spalten
+    mit einem Hash-Durchlauf pro Spalte.
     Gibt ein Dictionary mit den wichtigsten Kennzahlen zurück.
     """
     summary = {
@@ -30,97 +320,174 @@ def get_basic_dataframe_summary(df):
         "numerical_summary": {},
         "categorical_summary": {}
     }
+    numeric_cols = [col for col in df.columns if pd.api.types.is_numeric_dtype(df[col])]
+    if numeric_cols:
+        summary["numerical_summary"] = _profile_numeric_columns(df, numeric_cols)
+
     for col in df.columns:
-        if pd.api.types.is_numeric_dtype(df[col]):
-            desc = df[col].describe().to_dict()
-            # Ensure all values in desc are JSON serializable
-            for k, v in desc.items():
-                if pd.isna(v):
-                    desc[k] = None
-                elif isinstance(v, (np.integer, np.int64)): # Handle numpy integers
-                    desc[k] = int(v)
-                elif isinstance(v, (np.floating, np.float64)): # Handle numpy floats
-                    desc[k] = float(v)
-                elif isinstance(v, (float, int)): # Standard types
-                    desc[k] = round(v, 2) if isinstance(v, float) else v
-                # Add other type checks if necessary
-            summary["numerical_summary"][col] = desc
-        elif pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_categorical_dtype(df[col]):
-            unique_values_list = []
-            # Check for Timestamps or other non-serializable types in unique values
-            for val in df[col].unique():
-                if isinstance(val, pd.Timestamp):
-                    unique_values_list.append(val.isoformat())
-                else:
-                    unique_values_list.append(str(val)) # Convert all to string as a fallback
-
-            if len(unique_values_list) > 10:
-                unique_values_list = unique_values_list[:10] + ['...']
-            
-            top_vals_dict = {}
-            # Ensure keys and values in top_values are JSON serializable
-            for k, v in df[col].value_counts().nlargest(5).to_dict().items():
-                key_str = str(k.isoformat() if isinstance(k, pd.Timestamp) else k)
-                val_item = int(v) if isinstance(v, np.integer) else (float(v) if isinstance(v, np.floating) else v)
-                top_vals_dict[key_str] = val_item
-
-            summary["categorical_summary"][col] = {
-                "unique_count": df[col].nunique(),
-                "top_values": top_vals_dict,
-                "unique_sample": unique_values_list
-            }
+        if col in summary["numerical_summary"] or not is_categorical_like(df[col]):
+            continue
+        summary["categorical_summary"][col] = _profile_categorical_column(df[col])
     return summary
 
+# --- Registry für Kennzahlen und Aggregationsebenen ---
+# Summenkennzahlen der Aggregationen: Ausgabespalte -> Quellspalte im DataFrame
+AGGREGATION_MEASURES = {
+    "total_gross_sales": "EUR Gross Sales",
+    "total_returns_eur": "EUR Returns",
+    "total_orders": "No Orders",
+    "total_chargebacks_eur": "EUR Chargebacks.1",
+    "total_write_offs_eur": "EUR Write-Offs",
+    "total_dunning_level1_eur": "EUR Net Dunning Level 1",
+    "total_dunning_level2_eur": "EUR Net Dunning Level 2",
+}
+
+# Quoten/Durchschnitte: Name -> (Zähler-Quellspalte, Nenner-Quellspalte, Nachkommastellen)
+# Auf aggregierter Ebene entstehen daraus die Spalten "global_<name>".
+KPI_RATIOS = {
+    "return_rate_eur": ("EUR Returns", "EUR Gross Sales", 4),
+    "avg_order_value": ("EUR Gross Sales", "No Orders", 2),
+    "chargeback_rate_eur": ("EUR Chargebacks.1", "EUR Gross Sales", 4),
+    "dunning_level1_ratio": ("EUR Net Dunning Level 1", "EUR Gross Sales", 4),
+    "dunning_level2_ratio": ("EUR Net Dunning Level 2", "EUR Gross Sales", 4),
+    "write_off_ratio": ("EUR Write-Offs", "EUR Gross Sales", 4),
+}
+
+# Grouping Sets: Ergebnisschlüssel -> Dimensionen. Neue Ebenen (z.B. ["Country", "Normalized_Month_For_Analysis"])
+# werden aus derselben feinsten Aggregation abgeleitet und erfordern keinen weiteren Durchlauf über die Rohdaten.
+GROUPING_SETS = {
+    "by_country_payment_method": ["Country", "Payment Method"],
+    "by_country": ["Country"],
+    "by_payment_method": ["Payment Method"],
+}
+
+
+def safe_divide(numerator, denominator, decimals: int = None) -> np.ndarray:
+    """
+    Vektorisierte Division über float64-Arrays. Division durch 0 oder NaN ergibt 0.
+    """
+    numerator = np.asarray(numerator, dtype="float64")
+    denominator = np.asarray(denominator, dtype="float64")
+    result = np.zeros(np.broadcast_shapes(numerator.shape, denominator.shape), dtype="float64")
+    np.divide(numerator, denominator, out=result, where=(denominator != 0) & ~np.isnan(denominator))
+    result[np.isnan(result)] = 0.0
+    if decimals is not None:
+        result = np.round(result, decimals)
+    return result
+
+
+# Datumsformat der Exporte (siehe tests/data/Dummy Data.csv)
+EXPORT_DATE_FORMAT = "%d.%m.%Y"
+
+def parse_export_dates(values: pd.Series) -> pd.Series:
+    """
+    Parst die Date-Spalte der Exporte im Format dd.mm.yyyy. Bereits geparste Datumswerte
+    bleiben unverändert, abweichende Formate werden mit dayfirst=True interpretiert.
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    dates = pd.to_datetime(values, format=EXPORT_DATE_FORMAT, errors='coerce')
+    unparsed = dates.isna() & values.notna()
+    if unparsed.any():
+        dates[unparsed] = pd.to_datetime(values[unparsed], format="mixed", dayfirst=True, errors='coerce')
+    return dates
+
 # --- NEUE FUNKTION: KPIs zum DataFrame hinzufügen ---
-def add_calculated_kpis_to_df(df: pd.DataFrame) -> pd.DataFrame:
+# Numerische Quellspalten der KPI-Berechnung
+KPI_SOURCE_COLUMNS = [
+    'No Orders', 'EUR Gross Sales', 'No Returns', 'EUR Returns',
+    'EUR Write-Offs', 'EUR Chargebacks', 'EUR Chargebacks.1',
+    'EUR Net Dunning Level 1', 'EUR Net Dunning Level 2'
+]
+
+def add_calculated_kpis_to_df(df: pd.DataFrame, kpis_only: bool = False) -> pd.DataFrame:
     """
     Berechnet wichtige KPIs pro Zeile des DataFrames und fügt sie als neue Spalten hinzu.
+    Alle Quoten aus KPI_RATIOS werden in einem gemeinsamen NumPy-Durchlauf über float64-Arrays
+    berechnet. Der Eingabe-DataFrame wird nicht verändert und nicht vollständig kopiert.
+    Mit kpis_only=True werden nur die KPI-Spalten (plus Normalized_Month_For_Analysis)
+    als eigener DataFrame mit demselben Index zurückgegeben.
     """
-    # Defensive Kopie, um SettingWithCopyWarning zu vermeiden
-    df_copy = df.copy()
-    print(df_copy.columns.tolist())
-    # Stellen sicher, dass relevante Spalten numerisch sind
-    numeric_cols = [
-        'No Orders', 'EUR Gross Sales', 'No Returns', 'EUR Returns',
-        'EUR Write-Offs', 'EUR Chargebacks', 'EUR Chargebacks.1',
-        'EUR Net Dunning Level 1', 'EUR Net Dunning Level 2'
-    ]
-    for col in numeric_cols:
-        df_copy[col] = pd.to_numeric(df_copy[col], errors='coerce').fillna(0) # Standard 0 bei Konvertierungsfehler
-
-    # Berechne Quoten/Durchschnitte, Vermeidung von Division durch Null
-    # Verwende temporäre Spalten für saubere Division
-    df_copy['EUR Gross Sales_clean'] = df_copy['EUR Gross Sales'].replace(0, pd.NA)
-    df_copy['No Orders_clean'] = df_copy['No Orders'].replace(0, pd.NA)
-
-    # KPIs pro Zeile berechnen
-    df_copy['calculated_return_rate_eur'] = (df_copy['EUR Returns'] / df_copy['EUR Gross Sales_clean']).fillna(0).round(4)
-    df_copy['calculated_avg_order_value'] = (df_copy['EUR Gross Sales_clean'] / df_copy['No Orders_clean']).fillna(0).round(2)
-    df_copy['calculated_chargeback_rate_eur'] = (df_copy['EUR Chargebacks.1'] / df_copy['EUR Gross Sales_clean']).fillna(0).round(4)
-    df_copy['calculated_dunning_level1_ratio'] = (df_copy['EUR Net Dunning Level 1'] / df_copy['EUR Gross Sales_clean']).fillna(0).round(4)
-    df_copy['calculated_dunning_level2_ratio'] = (df_copy['EUR Net Dunning Level 2'] / df_copy['EUR Gross Sales_clean']).fillna(0).round(4)
-    df_copy['calculated_write_off_ratio'] = (df_copy['EUR Write-Offs'] / df_copy['EUR Gross Sales_clean']).fillna(0).round(4)
+    # Nur Spalten, die nicht numerisch sind oder Lücken haben, werden bereinigt (Standard 0 bei Konvertierungsfehler)
+    cleaned_cols = {}
+    for col in KPI_SOURCE_COLUMNS:
+        if not pd.api.types.is_numeric_dtype(df[col]) or df[col].isna().any():
+            cleaned_cols[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+
+    def source_values(col):
+        return (cleaned_cols[col] if col in cleaned_cols else df[col]).to_numpy(dtype="float64")
+
+    # Zähler- und Nennermatrix für alle Quoten, Division durch Null ergibt 0
+    ratio_names = list(KPI_RATIOS)
+    numerators = np.column_stack([source_values(KPI_RATIOS[name][0]) for name in ratio_names])
+    denominators = np.column_stack([source_values(KPI_RATIOS[name][1]) for name in ratio_names])
+    kpi_values = safe_divide(numerators, denominators)
+    for decimals in set(ratio[2] for ratio in KPI_RATIOS.values()):
+        col_positions = [i for i, name in enumerate(ratio_names) if KPI_RATIOS[name][2] == decimals]
+        kpi_values[:, col_positions] = np.round(kpi_values[:, col_positions], decimals)
+
+    kpis = pd.DataFrame(kpi_values, index=df.index, columns=[f"calculated_{name}" for name in ratio_names])
 
     # Zeitliche Normalisierung für Aggregation/Analyse
-    df_copy['Date'] = pd.to_datetime(df_copy['Date'], errors='coerce')
-    df_copy['Normalized_Month_For_Analysis'] = df_copy['Date'].dt.to_period('M').astype(str)
+    dates = parse_export_dates(df['Date'])
+    kpis['Normalized_Month_For_Analysis'] = dates.dt.to_period('M').astype(str)
+    if kpis_only:
+        return kpis
+
+    # Flache Kopie: unveränderte Spalten werden mit dem Eingabe-DataFrame geteilt
+    df_with_kpis = df.copy(deep=False)
+    for col, values in cleaned_cols.items():
+        df_with_kpis[col] = values
+    df_with_kpis['Date'] = dates
+    for col in kpis.columns:
+        df_with_kpis[col] = kpis[col]
+    return df_with_kpis
+
+def aggregate_finest_grain(df: pd.DataFrame, grouping_sets: dict = None, measures: dict = None) -> pd.DataFrame:
+    """
+    Aggregiert die Summenkennzahlen in einem einzigen Durchlauf auf der feinsten Ebene,
+    d.h. über die Vereinigung aller Dimensionen der Grouping Sets.
+    Fehlende Dimensionswerte bleiben als eigene Gruppe erhalten, damit gröbere Ebenen korrekt abgeleitet werden.
+    """
+    grouping_sets = grouping_sets or GROUPING_SETS
+    measures = measures or AGGREGATION_MEASURES
+    finest_dims = list(dict.fromkeys(dim for dims in grouping_sets.values() for dim in dims))
+    return df.groupby(finest_dims, dropna=False, observed=True, sort=False).agg(
+        **{output_col: (source_col, "sum") for output_col, source_col in measures.items()}
+    ).reset_index()
+
 
-    # Entferne temporäre Hilfsspalten
-    df_copy = df_copy.drop(columns=['EUR Gross Sales_clean', 'No Orders_clean'], errors='ignore')
+def rollup_grouping_sets(finest_agg: pd.DataFrame, grouping_sets: dict = None, measures: dict = None,
+                         ratios: dict = None) -> dict:
+    """
+    Leitet alle Grouping Sets aus der feinsten Aggregation ab und ergänzt die "global_"-Quoten.
+    Gibt ein Dict Ergebnisschlüssel -> DataFrame zurück.
+    """
+    grouping_sets = grouping_sets or GROUPING_SETS
+    measures = measures or AGGREGATION_MEASURES
+    ratios = ratios or KPI_RATIOS
+    measure_by_source = {source_col: output_col for output_col, source_col in measures.items()}
+
+    rollups = {}
+    for key, dims in grouping_sets.items():
+        rolled = finest_agg.groupby(dims, observed=True)[list(measures)].sum().reset_index()
+        for ratio_name, (numerator_col, denominator_col, decimals) in ratios.items():
+            rolled[f"global_{ratio_name}"] = safe_divide(
+                rolled[measure_by_source[numerator_col]], rolled[measure_by_source[denominator_col]], decimals
+            )
+        rollups[key] = rolled
+    return rollups
 
-    return df_copy
 
 # --- NEUE FUNKTION: Höher aggregierte KPIs (z.B. über alle Monate) ---
 def get_higher_level_aggregations(df_with_kpis: pd.DataFrame) -> dict:
     """
     Erstellt höher aggregierte KPIs (z.B. über alle Monate hinweg)
     für globale Vergleiche nach Land, Zahlungsmethode und deren Kombinationen.
+    Die Rohdaten werden nur einmal auf der feinsten Ebene aggregiert, alle Grouping Sets
+    (siehe GROUPING_SETS) werden aus diesem kleinen Zwischenergebnis abgeleitet.
     """
-    kpi_cols = [
-        'EUR Gross Sales', 'EUR Returns', 'No Orders', 'EUR Chargebacks.1',
-        'EUR Write-Offs', 'EUR Net Dunning Level 1', 'EUR Net Dunning Level 2'
-    ]
-    for col in kpi_cols:
+    for col in AGGREGATION_MEASURES.values():
         if col not in df_with_kpis.columns:
             print(f"Warnung: Spalte {col} fehlt für höhere Aggregation.")
             # Im Fehlerfall leere Dicts zurückgeben, damit der Hauptprozess weiterlaufen kann
@@ -130,101 +497,105 @@ def get_higher_level_aggregations(df_with_kpis: pd.DataFrame) -> dict:
                 "by_payment_method": "Keine Aggregation nach Zahlungsmethode verfügbar."
             }
 
-    aggregations = {}
-
-    # Aggregation nach Land UND Zahlungsmethode (bestehend)
-    global_agg_country_pm = df_with_kpis.groupby(['Country', 'Payment Method']).agg(
-        total_gross_sales=('EUR Gross Sales', 'sum'),
-        total_returns_eur=('EUR Returns', 'sum'),
-        total_orders=('No Orders', 'sum'),
-        total_chargebacks_eur=('EUR Chargebacks.1', 'sum'),
-        total_write_offs_eur=('EUR Write-Offs', 'sum'),
-        total_dunning_level1_eur=('EUR Net Dunning Level 1', 'sum'),
-        total_dunning_level2_eur=('EUR Net Dunning Level 2', 'sum')
-    ).reset_index()
+    finest_agg = aggregate_finest_grain(df_with_kpis)
+    rollups = rollup_grouping_sets(finest_agg)
+    return {key: rolled.to_csv(index=False) for key, rolled in rollups.items()}
 
-    global_agg_country_pm['global_return_rate_eur'] = (global_agg_country_pm['total_returns_eur'] / global_agg_country_pm['total_gross_sales'].replace(0, pd.NA)).fillna(0).round(4)
-    global_agg_country_pm['global_avg_order_value'] = (global_agg_country_pm['total_gross_sales'] / global_agg_country_pm['total_orders'].replace(0, pd.NA)).fillna(0).round(2)
-    global_agg_country_pm['global_chargeback_rate_eur'] = (global_agg_country_pm['total_chargebacks_eur'] / global_agg_country_pm['total_gross_sales'].replace(0, pd.NA)).fillna(0).round(4)
-    # ... (weitere globale Quoten für Country/PM)
-    global_agg_country_pm['global_dunning_level1_ratio'] = (global_agg_country_pm['total_dunning_level1_eur'] / global_agg_country_pm['total_gross_sales'].replace(0, pd.NA)).fillna(0).round(4)
-    global_agg_country_pm['global_dunning_level2_ratio'] = (global_agg_country_pm['total_dunning_level2_eur'] / global_agg_country_pm['total_gross_sales'].replace(0, pd.NA)).fillna(0).round(4)
-    global_agg_country_pm['global_write_off_ratio'] = (global_agg_country_pm['total_write_offs_eur'] / global_agg_country_pm['total_gross_sales'].replace(0, pd.NA)).fillna(0).round(4)
-    aggregations["by_country_payment_method"] = global_agg_country_pm.to_csv(index=False)
-
-    # NEU: Aggregation nur nach Land
-    global_agg_country = df_with_kpis.groupby(['Country']).agg(
-        total_gross_sales=('EUR Gross Sales', 'sum'),
-        total_returns_eur=('EUR Returns', 'sum'),
-        total_orders=('No Orders', 'sum'),
-        total_chargebacks_eur=('EUR Chargebacks.1', 'sum'),
-        total_write_offs_eur=('EUR Write-Offs', 'sum'),
-        total_dunning_level1_eur=('EUR Net Dunning Level 1', 'sum'),
-        total_dunning_level2_eur=('EUR Net Dunning Level 2', 'sum')
-    ).reset_index()
-    global_agg_country['global_return_rate_eur'] = (global_agg_country['total_returns_eur'] / global_agg_country['total_gross_sales'].replace(0, pd.NA)).fillna(0).round(4)
-    global_agg_country['global_avg_order_value'] = (global_agg_country['total_gross_sales'] / global_agg_country['total_orders'].replace(0, pd.NA)).fillna(0).round(2)
-    global_agg_country['global_chargeback_rate_eur'] = (global_agg_country['total_chargebacks_eur'] / global_agg_country['total_gross_sales'].replace(0, pd.NA)).fillna(0).round(4)
-    # ... (weitere globale Quoten für Country)
-    global_agg_country['global_dunning_level1_ratio'] = (global_agg_country['total_dunning_level1_eur'] / global_agg_country['total_gross_sales'].replace(0, pd.NA)).fillna(0).round(4)
-    global_agg_country['global_dunning_level2_ratio'] = (global_agg_country['total_dunning_level2_eur'] / global_agg_country['total_gross_sales'].replace(0, pd.NA)).fillna(0).round(4)
-    global_agg_country['global_write_off_ratio'] = (global_agg_country['total_write_offs_eur'] / global_agg_country['total_gross_sales'].replace(0, pd.NA)).fillna(0).round(4)
-    aggregations["by_country"] = global_agg_country.to_csv(index=False)
-
-    # NEU: Aggregation nur nach Zahlungsmethode
-    global_agg_pm = df_with_kpis.groupby(['Payment Method']).agg(
-        total_gross_sales=('EUR Gross Sales', 'sum'),
-        total_returns_eur=('EUR Returns', 'sum'),
-        total_orders=('No Orders', 'sum'),
-        total_chargebacks_eur=('EUR Chargebacks.1', 'sum'),
-        total_write_offs_eur=('EUR Write-Offs', 'sum'),
-        total_dunning_level1_eur=('EUR Net Dunning Level 1', 'sum'),
-        total_dunning_level2_eur=('EUR Net Dunning Level 2', 'sum')
-    ).reset_index()
-    global_agg_pm['global_return_rate_eur'] = (global_agg_pm['total_returns_eur'] / global_agg_pm['total_gross_sales'].replace(0, pd.NA)).fillna(0).round(4)
-    global_agg_pm['global_avg_order_value'] = (global_agg_pm['total_gross_sales'] / global_agg_pm['total_orders'].replace(0, pd.NA)).fillna(0).round(2)
-    global_agg_pm['global_chargeback_rate_eur'] = (global_agg_pm['total_chargebacks_eur'] / global_agg_pm['total_gross_sales'].replace(0, pd.NA)).fillna(0).round(4)
-    # ... (weitere globale Quoten für PM)
-    global_agg_pm['global_dunning_level1_ratio'] = (global_agg_pm['total_dunning_level1_eur'] / global_agg_pm['total_gross_sales'].replace(0, pd.NA)).fillna(0).round(4)
-    global_agg_pm['global_dunning_level2_ratio'] = (global_agg_pm['total_dunning_level2_eur'] / global_agg_pm['total_gross_sales'].replace(0, pd.NA)).fillna(0).round(4)
-    global_agg_pm['global_write_off_ratio'] = (global_agg_pm['total_write_offs_eur'] / global_agg_pm['total_gross_sales'].replace(0, pd.NA)).fillna(0).round(4)
-    aggregations["by_payment_method"] = global_agg_pm.to_csv(index=False)
 
-    return aggregations
+# --- NEUE FUNKTION: Top N Anomalien extrahieren ---
+# Liste der KPI-Spalten, die für die nlargest/nsmallest Operationen verwendet werden
+# Füge hier nur Spalten hinzu, die direkt im DataFrame existieren und numerisch sind
+ANOMALY_SORT_COLUMNS = {
+    'EUR Gross Sales': True, # True for nlargest
+    'calculated_return_rate_eur': True,
+    'calculated_chargeback_rate_eur': True,
+    'EUR Net Dunning Level 2': True,
+    'calculated_avg_order_value': False # False for nsmallest (lowest avg order value)
+}
+
+def select_extreme_positions(values: np.ndarray, n: int, largest: bool) -> np.ndarray:
+    """
+    Positionen der n größten bzw. kleinsten Nicht-NaN-Werte per argpartition in O(Zeilen).
+    Reihenfolge und Gleichstände wie bei nlargest/nsmallest(keep='first'):
+    sortiert nach Wert, bei Gleichstand nach ursprünglicher Position.
+    """
+    valid_positions = np.flatnonzero(~np.isnan(values))
+    if n <= 0 or valid_positions.size == 0:
+        return np.empty(0, dtype=np.int64)
+    # Auswahl immer aufsteigend; für die größten Werte wird das Vorzeichen gedreht
+    keyed = -values[valid_positions] if largest else values[valid_positions]
+    if valid_positions.size > n:
+        kth_value = keyed[np.argpartition(keyed, n - 1)[n - 1]]
+        below = keyed < kth_value
+        ties = np.flatnonzero(keyed == kth_value)[:n - int(below.sum())]
+        chosen = np.concatenate([np.flatnonzero(below), ties])
+    else:
+        chosen = np.arange(valid_positions.size)
+    chosen = chosen[np.lexsort((chosen, keyed[chosen]))]
+    return valid_positions[chosen]
+
+
+def _serialize_rows_once(df: pd.DataFrame, positions: np.ndarray):
+    """
+    Serialisiert alle ausgewählten Zeilen in einem einzigen to_csv-Aufruf.
+    Gibt (Kopfzeile, Dict Position -> CSV-Zeile) zurück oder None, wenn Textwerte
+    Zeilenumbrüche enthalten und die Zeilen daher nicht sicher getrennt werden können.
+    """
+    selected = df.iloc[positions]
+    for col in selected.columns:
+        if is_categorical_like(selected[col]) and selected[col].astype(str).str.contains("[\r\n]").any():
+            return None
+    header = df.iloc[:0].to_csv(index=False)
+    lines = selected.to_csv(index=False, header=False).splitlines(keepends=True)
+    if len(lines) != len(positions):
+        return None
+    return header, dict(zip(positions.tolist(), lines))
 
 
-# --- NEUE FUNKTION: Top N Anomalien extrahieren ---
 def get_top_n_anomalies(df_with_kpis: pd.DataFrame, n: int = 5) -> dict:
     """
     Identifiziert und extrahiert die Top N auffälligsten Zeilen
     basierend auf verschiedenen KPIs aus dem angereicherten DataFrame.
     Stellt sicher, dass die benötigten KPI-Spalten existieren.
+    Alle KPIs werden als gemeinsame float64-Matrix per argpartition ausgewertet; jede ausgewählte
+    Zeile wird nur einmal serialisiert, auch wenn sie in mehreren Tabellen vorkommt.
     """
     anomalies = {"n": n} # Speichert n für den Prompt
 
-    # Liste der KPI-Spalten, die für die nlargest/nsmallest Operationen verwendet werden
-    # Füge hier nur Spalten hinzu, die direkt im DataFrame existieren und numerisch sind
-    sort_cols = {
-        'EUR Gross Sales': True, # True for nlargest
-        'calculated_return_rate_eur': True,
-        'calculated_chargeback_rate_eur': True,
-        'EUR Net Dunning Level 2': True,
-        'calculated_avg_order_value': False # False for nsmallest (lowest avg order value)
+    # Zeilen mit Write-Offs > 0 (nicht Top N, sondern alle relevanten)
+    write_off_positions = np.flatnonzero((df_with_kpis['EUR Write-Offs'] > 0).to_numpy())
+
+    # Gemeinsame KPI-Matrix über alle verfügbaren numerischen Sortierspalten
+    ranked_cols = [
+        col for col in ANOMALY_SORT_COLUMNS
+        if col in df_with_kpis.columns and pd.api.types.is_numeric_dtype(df_with_kpis[col])
+    ]
+    kpi_matrix = (
+        np.column_stack([df_with_kpis[col].to_numpy(dtype="float64", na_value=np.nan) for col in ranked_cols])
+        if ranked_cols else np.empty((len(df_with_kpis), 0))
+    )
+    selected_positions = {
+        col: select_extreme_positions(kpi_matrix[:, i], n, ANOMALY_SORT_COLUMNS[col])
+        for i, col in enumerate(ranked_cols)
     }
 
-    # Filter für Write-Offs > 0 (nicht Top N, sondern alle relevanten)
-    write_offs_df = df_with_kpis[df_with_kpis['EUR Write-Offs'] > 0]
-    anomalies['all_write_offs_gt_0'] = write_offs_df.to_csv(index=False) if not write_offs_df.empty else "Keine spezifischen Write-Offs gefunden."
-
-    for col, is_largest in sort_cols.items():
-        if col in df_with_kpis.columns and pd.api.types.is_numeric_dtype(df_with_kpis[col]):
-            # Filtern NaN-Werte für Sortierung, falls vorhanden
-            temp_df = df_with_kpis.dropna(subset=[col])
-            if not temp_df.empty:
-                if is_largest:
-                    anomalies[f'top_{col.lower().replace(" ", "_")}'] = temp_df.nlargest(n, col).to_csv(index=False)
-                else:
-                    anomalies[f'lowest_{col.lower().replace(" ", "_")}'] = temp_df.nsmallest(n, col).to_csv(index=False)
+    all_positions = np.unique(np.concatenate([write_off_positions, *selected_positions.values()])).astype(np.int64)
+    serialized = _serialize_rows_once(df_with_kpis, all_positions) if all_positions.size else None
+
+    def rows_to_csv(positions):
+        if serialized is None:
+            return df_with_kpis.iloc[positions].to_csv(index=False)
+        header, lines = serialized
+        return header + "".join(lines[pos] for pos in positions.tolist())
+
+    anomalies['all_write_offs_gt_0'] = rows_to_csv(write_off_positions) if write_off_positions.size else "Keine spezifischen Write-Offs gefunden."
+
+    for col, is_largest in ANOMALY_SORT_COLUMNS.items():
+        if col in selected_positions:
+            positions = selected_positions[col]
+            if positions.size:
+                prefix = 'top' if is_largest else 'lowest'
+                anomalies[f'{prefix}_{col.lower().replace(" ", "_")}'] = rows_to_csv(positions)
             else:
                 anomalies[f'top_{col.lower().replace(" ", "_")}'] = "Nicht genügend Daten für diese Anomalie."
         else:
@@ -235,4 +606,110 @@ def get_top_n_anomalies(df_with_kpis: pd.DataFrame, n: int = 5) -> dict:
     # Könnte hier analysiert werden, wenn sie konsistent Werte > 0 hat, die nicht in Chargebacks.1 sind
     # For now, it's covered by the general "Umgang mit unbekannten/irrelevanten Spalten" in the prompt.
 
-    return anomalies
\ No newline at end of file
+    return anomalies
+
+
+# --- Statistische Anomalieerkennung pro Zelle (Land × Zahlungsmethode × Monat) ---
+ANOMALY_CELL_DIMENSIONS = ["Country", "Payment Method"]
+ANOMALY_TIME_COLUMN = "Normalized_Month_For_Analysis"
+ANOMALY_CELL_GROUPING = {"cells": ANOMALY_CELL_DIMENSIONS + [ANOMALY_TIME_COLUMN]}
+# Bewertete Kennzahlen je Zelle: Volumen plus alle Quoten aus KPI_RATIOS
+ANOMALY_SCORED_METRICS = ["total_gross_sales"] + [f"global_{name}" for name in KPI_RATIOS]
+# Rollierendes Fenster (Monate) und Mindesthistorie, ab der eine Zelle bewertet wird
+ANOMALY_ROLLING_WINDOW = 6
+ANOMALY_MIN_HISTORY = 3
+# Anzahl der bestbewerteten Zellen, die in den Prompt gehen
+ANOMALY_TOP_K_CELLS = 15
+
+
+def aggregate_anomaly_cells(df_with_kpis: pd.DataFrame) -> pd.DataFrame:
+    """
+    Summiert die Kennzahlen pro Zelle (Land × Zahlungsmethode × Monat) in einem Durchlauf.
+    Das Ergebnis ist mergebar (Summen) und kann z.B. chunkweise aufgebaut werden.
+    """
+    return aggregate_finest_grain(df_with_kpis, grouping_sets=ANOMALY_CELL_GROUPING)
+
+
+def _drop_group_levels(rolled: pd.DataFrame, num_levels: int, index) -> pd.DataFrame:
+    return rolled.reset_index(level=list(range(num_levels)), drop=True).reindex(index)
+
+
+def score_cell_anomalies(cell_sums: pd.DataFrame, window: int = ANOMALY_ROLLING_WINDOW,
+                         min_history: int = ANOMALY_MIN_HISTORY) -> pd.DataFrame:
+    """
+    Bewertet jede Zelle gegen die eigene Historie ihrer Land/Zahlungsmethoden-Kombination:
+    - rollierender z-Score gegen die vorherigen `window` Monate,
+    - robuster z-Score gegen Median und MAD der gesamten Historie,
+    - Veränderung zum Vormonat.
+    Alle Kennzahlen werden gemeinsam per groupby-shift/rolling/transform berechnet.
+    Gibt alle bewertbaren Zellen absteigend nach anomaly_score sortiert zurück.
+    """
+    dims = ANOMALY_CELL_DIMENSIONS
+    cells = rollup_grouping_sets(cell_sums, grouping_sets=ANOMALY_CELL_GROUPING)["cells"]
+    cells = cells[cells[ANOMALY_TIME_COLUMN].astype(str) != "NaT"]
+    cells = cells.sort_values(dims + [ANOMALY_TIME_COLUMN]).reset_index(drop=True)
+    if cells.empty:
+        return cells
+
+    values = cells[ANOMALY_SCORED_METRICS].astype("float64")
+    keys = [cells[dim] for dim in dims]
+    grouped = values.groupby(keys, observed=True, sort=False)
+    prior = grouped.shift(1)
+    prior_rolling = prior.groupby(keys, observed=True, sort=False).rolling(window, min_periods=min_history)
+    rolling_mean = _drop_group_levels(prior_rolling.mean(), len(dims), cells.index)
+    rolling_std = _drop_group_levels(prior_rolling.std(), len(dims), cells.index)
+    rolling_z = (values - rolling_mean) / rolling_std.where(rolling_std > 0)
+
+    median = grouped.transform("median")
+    mad = (values - median).abs().groupby(keys, observed=True, sort=False).transform("median")
+    robust_z = 0.6745 * (values - median) / mad.where(mad > 0)
+    robust_z = robust_z.where(grouped.transform("count") > min_history)
+
+    mom_delta = (values - prior) / prior.abs().where(prior != 0)
+
+    rolling_abs = rolling_z.abs().to_numpy()
+    robust_abs = robust_z.abs().to_numpy()
+    combined = np.fmax(rolling_abs, robust_abs)
+    scorable = ~np.all(np.isnan(combined), axis=1)
+    cells, combined = cells[scorable].reset_index(drop=True), combined[scorable]
+    if cells.empty:
+        return cells
+    rows = np.arange(len(cells))
+    driver = np.nanargmax(combined, axis=1)
+    use_rolling = np.nan_to_num(rolling_abs[scorable][rows, driver], nan=-1) >= np.nan_to_num(robust_abs[scorable][rows, driver], nan=-1)
+
+    scored = cells[dims + [ANOMALY_TIME_COLUMN, "total_gross_sales", "total_orders"]].copy()
+    scored["anomaly_score"] = np.round(combined[rows, driver], 2)
+    scored["driver_kpi"] = np.asarray(ANOMALY_SCORED_METRICS)[driver]
+    scored["driver_value"] = np.round(values.to_numpy()[scorable][rows, driver], 4)
+    scored["driver_baseline"] = np.round(np.where(
+        use_rolling, rolling_mean.to_numpy()[scorable][rows, driver], median.to_numpy()[scorable][rows, driver]
+    ), 4)
+    scored["driver_zscore"] = np.round(np.where(
+        use_rolling, rolling_z.to_numpy()[scorable][rows, driver], robust_z.to_numpy()[scorable][rows, driver]
+    ), 2)
+    scored["driver_mom_delta"] = np.round(mom_delta.to_numpy()[scorable][rows, driver], 4)
+    return scored.sort_values("anomaly_score", ascending=False, kind="stable").reset_index(drop=True)
+
+
+def statistical_anomalies_from_cells(cell_sums: pd.DataFrame, top_k: int = ANOMALY_TOP_K_CELLS) -> dict:
+    """
+    Bewertet vorab aggregierte Zellen und gibt die top_k auffälligsten als CSV für den Prompt zurück.
+    """
+    scored = score_cell_anomalies(cell_sums)
+    if scored.empty:
+        return {"top_k": top_k, "scored_cells": "Nicht genügend Monatshistorie für eine statistische Anomalieerkennung."}
+    return {"top_k": top_k, "scored_cells": scored.head(top_k).to_csv(index=False)}
+
+
+def get_statistical_anomalies(df_with_kpis: pd.DataFrame, top_k: int = ANOMALY_TOP_K_CELLS) -> dict:
+    """
+    Statistische Anomalien statt reiner Top-N-Werte: bewertet jede Zelle
+    (Land × Zahlungsmethode × Monat) gegen ihre eigene Historie, sodass auch kleine Länder
+    mit echten Ausreißern auffallen und nicht nur die umsatzstärksten.
+    """
+    for col in ANOMALY_CELL_DIMENSIONS + [ANOMALY_TIME_COLUMN] + list(AGGREGATION_MEASURES.values()):
+        if col not in df_with_kpis.columns:
+            print(f"Warnung: Spalte {col} fehlt für die statistische Anomalieerkennung.")
+            return {"top_k": top_k, "scored_cells": "Statistische Anomalieerkennung nicht verfügbar."}
+    return statistical_anomalies_from_cells(aggregate_anomaly_cells(df_with_kpis), top_k)
@@ -0,0 +1,57 @@
+import json
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("pymongo")
+
+import core.batch as batch
+
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), "data", "Dummy Data.csv")
+
+
+@pytest.fixture
+def input_dir(tmp_path):
+    directory = tmp_path / "input"
+    directory.mkdir()
+    shutil.copy(DATA_PATH, directory / "Dummy Data.csv")
+    (directory / "notizen.txt").write_text("wird ignoriert", encoding="utf-8")
+    return directory
+
+
+@pytest.fixture(autouse=True)
+def no_dotenv(monkeypatch):
+    monkeypatch.setattr(batch, "load_dotenv", lambda *args, **kwargs: None)
+
+
+def read_manifest(output_dir) -> dict:
+    with open(os.path.join(output_dir, batch.MANIFEST_FILENAME), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_manifest_written_without_openai_client(input_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, "get_openai_client_internal", lambda: None)
+    output_dir = tmp_path / "output"
+
+    assert batch.main([str(input_dir), str(output_dir), "--cpu-workers", "1"]) == 1
+
+    manifest = read_manifest(output_dir)
+    assert "OpenAI" in manifest["error"]
+    assert manifest["files"] == {"Dummy Data.csv": {"status": "pending"}}
+    assert os.listdir(output_dir) == [batch.MANIFEST_FILENAME]
+
+
+def test_manifest_written_when_mongodb_unavailable(input_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, "get_openai_client_internal", lambda: object())
+    monkeypatch.setattr(batch, "get_mongo_client", lambda *args, **kwargs: None)
+    output_dir = tmp_path / "output"
+
+    assert batch.main([str(input_dir), str(output_dir), "--cpu-workers", "1", "--use-mongodb"]) == 1
+
+    manifest = read_manifest(output_dir)
+    assert "MongoDB" in manifest["error"]
+    assert manifest["settings"]["use_mongodb"] is True
+    assert manifest["files"]["Dummy Data.csv"]["status"] == "pending"
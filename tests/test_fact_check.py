@@ -0,0 +1,24 @@
+import math
+
+import pytest
+
+from services.fact_check import parse_cited_value
+
+
+@pytest.mark.parametrize("value, expected, tolerance", [
+    (0.00005, 0.00005, 0.5e-5),
+    (5e-05, 5e-05, 0.5e-5),
+    (1.5e-07, 1.5e-07, 0.5e-8),
+    (1e+20, 1e+20, 0.5),
+    (0.25, 0.25, 0.005),
+    (42, 42.0, 0.5),
+])
+def test_parse_cited_value_numbers(value, expected, tolerance):
+    [(number, tol)] = parse_cited_value(value)
+    assert number == expected
+    assert math.isclose(tol, tolerance)
+
+
+@pytest.mark.parametrize("value", [float("inf"), float("-inf"), float("nan"), None, True])
+def test_parse_cited_value_unusable(value):
+    assert parse_cited_value(value) == []
@@ -0,0 +1,98 @@
+import os
+
+import pandas as pd
+import pytest
+
+import services.dataset_store as dataset_store
+import services.incremental as incremental
+from services.fact_check import aggregate_fact_check_cells
+from services.incremental import analyze_incrementally, split_by_month
+from services.loader import load_tabular_file, clear_parsed_cache
+from services.utils import add_calculated_kpis_to_df, get_higher_level_aggregations, get_top_n_anomalies, \
+    get_statistical_anomalies, parse_export_dates, ANOMALY_TOP_K_CELLS
+
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), "data", "Dummy Data.csv")
+TOP_N = 7
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(incremental, "INCREMENTAL_CACHE_DIR", str(tmp_path / "incremental"))
+    monkeypatch.setattr(dataset_store, "DATASET_STORE_DIR", str(tmp_path / "datasets"))
+    clear_parsed_cache()
+    yield
+    clear_parsed_cache()
+
+
+@pytest.fixture
+def df():
+    with open(DATA_PATH, "rb") as f:
+        return load_tabular_file(f.read(), "Dummy Data.csv")
+
+
+def full_stages(df: pd.DataFrame) -> dict:
+    df_with_kpis = add_calculated_kpis_to_df(df)
+    return {
+        "aggregations": get_higher_level_aggregations(df_with_kpis),
+        "anomalies": get_top_n_anomalies(df_with_kpis, n=TOP_N),
+        "statistical_anomalies": get_statistical_anomalies(df_with_kpis, top_k=ANOMALY_TOP_K_CELLS),
+        "fact_check_cells": aggregate_fact_check_cells(df_with_kpis),
+    }
+
+
+def assert_same_stages(incremental_stages: dict, expected: dict):
+    assert incremental_stages["aggregations"] == expected["aggregations"]
+    assert incremental_stages["anomalies"] == expected["anomalies"]
+    assert incremental_stages["statistical_anomalies"] == expected["statistical_anomalies"]
+    # Zellsummen dienen nur als Nachschlagetabelle: Zeilenreihenfolge ist egal
+    pd.testing.assert_frame_equal(
+        sorted_cells(incremental_stages["fact_check_cells"]), sorted_cells(expected["fact_check_cells"]),
+        check_dtype=False, check_categorical=False,
+    )
+
+
+def sorted_cells(cells: pd.DataFrame) -> pd.DataFrame:
+    cells = cells.astype({col: str for col in cells.columns if not pd.api.types.is_numeric_dtype(cells[col])})
+    return cells.sort_values(list(cells.columns)).reset_index(drop=True)
+
+
+def test_split_by_month_covers_every_row_once(df):
+    months = split_by_month(df)
+    positions = sorted(position for month_positions in months.values() for position in month_positions.tolist())
+    assert positions == list(range(len(df)))
+    labels = parse_export_dates(df["Date"]).dt.strftime("%Y-%m")
+    for month, month_positions in months.items():
+        assert set(labels.iloc[month_positions]) == {month}
+
+
+def test_incremental_matches_full_aggregation(df):
+    stages = analyze_incrementally(df, n=TOP_N)
+
+    assert_same_stages(stages, full_stages(df))
+    assert stages["summary"]["num_rows"] == len(df)
+    assert stages["summary"]["incremental"]["reused_months"] == []
+
+
+def test_rerun_reuses_all_months(df):
+    first = analyze_incrementally(df, n=TOP_N)
+    second = analyze_incrementally(df, n=TOP_N)
+
+    assert second["summary"]["incremental"]["computed_months"] == []
+    assert second["summary"]["incremental"]["reused_months"] == first["summary"]["incremental"]["computed_months"]
+    assert second["aggregations"] == first["aggregations"]
+    assert second["anomalies"] == first["anomalies"]
+
+
+def test_changed_month_is_recomputed_and_still_matches_full(df):
+    analyze_incrementally(df, n=TOP_N)
+    months = parse_export_dates(df["Date"]).dt.strftime("%Y-%m")
+    last_month = months.max()
+    changed = df.copy()
+    changed["EUR Gross Sales"] = changed["EUR Gross Sales"].astype("int64")
+    changed.loc[(months == last_month).to_numpy(), "EUR Gross Sales"] *= 2
+
+    stages = analyze_incrementally(changed, n=TOP_N)
+
+    assert stages["summary"]["incremental"]["computed_months"] == [last_month]
+    assert_same_stages(stages, full_stages(changed))
@@ -0,0 +1,28 @@
+import json
+
+import pytest
+
+from services.utils import extract_json_from_string
+
+ANSWER = {"insights": [{"insight_id": "insight_1", "title": "Retouren {DE} \"hoch\" }"}], "overall_summary": "s"}
+
+
+@pytest.mark.parametrize("text", [
+    "```json\n" + json.dumps(ANSWER) + "\n```",
+    "Hier ist {kurz} die Analyse:\n```json\n" + json.dumps(ANSWER, indent=2) + "\n```\nDanke",
+    "Vorwort {a} und dann " + json.dumps(ANSWER) + " Ende",
+    "Hinweis: Werte in {EUR gerundet.\n" + json.dumps(ANSWER),
+    "{ { {\n" + json.dumps(ANSWER) + "\n{",
+])
+def test_extract_json_finds_answer(text):
+    assert json.loads(extract_json_from_string(text)) == ANSWER
+
+
+def test_extract_json_prefers_longest_object_outside_unclosed_brace():
+    text = 'x { {"a": 1} y {"b": {"c": [1, 2, 3]}} z'
+    assert json.loads(extract_json_from_string(text)) == {"b": {"c": [1, 2, 3]}}
+
+
+@pytest.mark.parametrize("text", [None, "", "kein json", "{" * 100, '```json\n{"a": "nicht geschlossen'])
+def test_extract_json_without_complete_object(text):
+    assert extract_json_from_string(text) is None
@@ -0,0 +1,88 @@
+import os
+
+import pandas as pd
+import pytest
+
+import services.dataset_store as dataset_store
+from services.loader import load_tabular_file, normalize_dataframe_schema, compute_content_hash, clear_parsed_cache
+
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), "data", "Dummy Data.csv")
+
+
+@pytest.fixture
+def csv_bytes():
+    with open(DATA_PATH, "rb") as f:
+        return f.read()
+
+
+@pytest.fixture(autouse=True)
+def isolated_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(dataset_store, "DATASET_STORE_DIR", str(tmp_path / "datasets"))
+    clear_parsed_cache()
+    yield
+    clear_parsed_cache()
+
+
+def test_normalize_dataframe_schema_compacts_types():
+    df = pd.DataFrame({
+        "Date": ["01.01.2024", "01.02.2024", "kein Datum"],
+        "Country": ["DE", "AT", "DE"],
+        "Payment Method": ["invoice", "credit card", "invoice"],
+        "No Orders": [10, 20, 30],
+        "EUR Returns": ["1.5", "2", None],
+        "Comment": ["a", "b", "c"],
+    })
+    normalized, report = normalize_dataframe_schema(df)
+
+    assert pd.api.types.is_datetime64_any_dtype(normalized["Date"])
+    assert normalized["Date"].isna().tolist() == [False, False, True]
+    assert isinstance(normalized["Country"].dtype, pd.CategoricalDtype)
+    assert isinstance(normalized["Payment Method"].dtype, pd.CategoricalDtype)
+    assert normalized["No Orders"].dtype.itemsize < df["No Orders"].dtype.itemsize
+    assert pd.api.types.is_float_dtype(normalized["EUR Returns"])
+    assert normalized["EUR Returns"].iloc[:2].tolist() == [1.5, 2.0]
+    assert not pd.api.types.is_numeric_dtype(normalized["Comment"])
+    assert list(normalized.columns) == list(df.columns)
+    assert set(report["converted_columns"]) == {"Date", "Country", "Payment Method", "No Orders", "EUR Returns"}
+    assert report["memory_saved_bytes"] == report["memory_before_bytes"] - report["memory_after_bytes"]
+
+
+def test_normalize_dataframe_schema_keeps_values():
+    df = pd.DataFrame({"No Orders": [0, 120, 70000], "EUR Gross Sales": [-5, 0, 3000000000]})
+    normalized, _ = normalize_dataframe_schema(df)
+    assert normalized["No Orders"].tolist() == df["No Orders"].tolist()
+    assert normalized["EUR Gross Sales"].tolist() == df["EUR Gross Sales"].tolist()
+
+
+def test_load_tabular_file_attaches_report_and_hash(csv_bytes):
+    df = load_tabular_file(csv_bytes, "Dummy Data.csv")
+    raw = pd.read_csv(DATA_PATH, sep=";")
+
+    assert len(df) == len(raw)
+    assert df.attrs["content_hash"] == compute_content_hash(csv_bytes)
+    report = df.attrs["schema_report"]
+    assert report["memory_after_bytes"] < report["memory_before_bytes"]
+    assert "Date" in report["converted_columns"]
+    assert isinstance(df["Country"].dtype, pd.CategoricalDtype)
+    assert df["EUR Gross Sales"].astype("int64").sum() == raw["EUR Gross Sales"].sum()
+
+
+def test_load_tabular_file_reuses_parsed_frame(csv_bytes):
+    first = load_tabular_file(csv_bytes, "Dummy Data.csv")
+    assert load_tabular_file(csv_bytes, "Kopie.csv") is first
+
+
+def test_load_tabular_file_filters_months_and_countries(csv_bytes):
+    full = load_tabular_file(csv_bytes, "Dummy Data.csv")
+    filtered = load_tabular_file(csv_bytes, "Dummy Data.csv", months=["2024-09"], countries=["CH"])
+
+    expected = full[(full["Date"].dt.strftime("%Y-%m") == "2024-09") & (full["Country"].astype(str) == "CH")]
+    assert len(filtered) == len(expected) > 0
+    assert set(filtered["Country"].astype(str)) == {"CH"}
+    assert int(filtered["EUR Gross Sales"].astype("int64").sum()) == int(expected["EUR Gross Sales"].astype("int64").sum())
+
+
+def test_load_tabular_file_rejects_unknown_extension(csv_bytes):
+    with pytest.raises(ValueError):
+        load_tabular_file(csv_bytes, "Dummy Data.txt")
@@ -0,0 +1,68 @@
+import io
+import os
+
+import pandas as pd
+import pytest
+
+from services.loader import sniff_csv_delimiter
+from services.streaming import analyze_csv_in_chunks, analyze_csv_stream_in_chunks, CategoricalColumnAccumulator
+from services.utils import add_calculated_kpis_to_df, get_higher_level_aggregations, get_top_n_anomalies, \
+    get_statistical_anomalies, ANOMALY_TOP_K_CELLS
+
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), "data", "Dummy Data.csv")
+TOP_N = 7
+
+
+@pytest.fixture(scope="module")
+def csv_bytes():
+    with open(DATA_PATH, "rb") as f:
+        return f.read()
+
+
+@pytest.fixture(scope="module")
+def in_memory_kpis(csv_bytes):
+    return add_calculated_kpis_to_df(pd.read_csv(io.BytesIO(csv_bytes), sep=sniff_csv_delimiter(csv_bytes)))
+
+
+@pytest.mark.parametrize("chunk_rows", [50, 333, 100000])
+def test_streaming_matches_in_memory_stages(csv_bytes, in_memory_kpis, chunk_rows):
+    stages = analyze_csv_in_chunks(io.BytesIO(csv_bytes), sniff_csv_delimiter(csv_bytes), n=TOP_N, chunk_rows=chunk_rows)
+
+    assert stages["anomalies"] == get_top_n_anomalies(in_memory_kpis, n=TOP_N)
+    assert stages["aggregations"] == get_higher_level_aggregations(in_memory_kpis)
+    assert stages["statistical_anomalies"] == get_statistical_anomalies(in_memory_kpis, top_k=ANOMALY_TOP_K_CELLS)
+    assert stages["summary"]["num_rows"] == len(in_memory_kpis)
+    assert stages["summary"]["streaming"]["chunks"] == -(-len(in_memory_kpis) // chunk_rows)
+
+
+def test_stream_reads_file_object_and_caches_by_hash(csv_bytes):
+    stream = io.BytesIO(csv_bytes)
+    first = analyze_csv_stream_in_chunks(stream, n=TOP_N, chunk_rows=200)
+    expected = analyze_csv_in_chunks(io.BytesIO(csv_bytes), sniff_csv_delimiter(csv_bytes), n=TOP_N, chunk_rows=200)
+
+    assert first["anomalies"] == expected["anomalies"]
+    assert analyze_csv_stream_in_chunks(io.BytesIO(csv_bytes), n=TOP_N) is first
+
+
+def test_categorical_accumulator_is_exact_below_capacity():
+    accumulator = CategoricalColumnAccumulator(capacity=5)
+    accumulator.update(pd.Series(["DE", "AT", "DE", None]))
+    accumulator.update(pd.Series(["CH", "DE"]))
+
+    summary = accumulator.to_summary_dict()
+    assert summary["unique_count"] == 3
+    assert summary["top_values"] == {"DE": 3, "AT": 1, "CH": 1}
+    assert "approximate" not in summary
+
+
+def test_categorical_accumulator_stays_bounded_above_capacity():
+    accumulator = CategoricalColumnAccumulator(capacity=50)
+    for chunk in range(20):
+        accumulator.update(pd.Series([f"v{value}" for value in range(chunk * 1000, chunk * 1000 + 1000)] + ["top"] * 30))
+
+    summary = accumulator.to_summary_dict()
+    assert len(accumulator.counts) <= 50
+    assert summary["approximate"] is True
+    assert next(iter(summary["top_values"])) == "top"
+    assert abs(summary["unique_count"] - 20001) / 20001 < 0.1